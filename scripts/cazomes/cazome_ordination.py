@@ -0,0 +1,662 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Ordinate CAZome compositions using PCA and single-linkage clustering, folding new genomes into existing fits"""
+
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+
+# columns in the CAZy family frequency dataframe that do not contain family frequencies
+META_COLUMNS = ["Genome", "Lineage", "Genus", "Species"]
+MODEL_FILE = "ordination_model.npz"
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    args.output_dir.mkdir(exist_ok=True, parents=True)
+
+    fam_freq_df = load_fam_freqs(args.fam_freqs)
+
+    if args.subcommand == "fit":
+        model = fit(fam_freq_df, args)
+
+    else:
+        model = load_model(args.output_dir / MODEL_FILE)
+        model = update(model, fam_freq_df, args)
+
+    save_model(model, args.output_dir / MODEL_FILE)
+    write_outputs(model, args.output_dir)
+
+
+def load_fam_freqs(fam_freq_path):
+    """Load the genome x CAZy family frequency matrix
+
+    :param fam_freq_path: Path to CSV file, one row per genome and one column per family,
+        with the Genome, Genus and Species (and optionally Lineage) of each genome
+
+    Return pandas df
+    """
+    fam_freq_df = pd.read_csv(fam_freq_path, index_col=0)
+
+    for col in ["Genome", "Genus", "Species"]:
+        if col not in fam_freq_df.columns:
+            raise ValueError(f"Column '{col}' not found in {fam_freq_path}")
+
+    if "Lineage" not in fam_freq_df.columns:
+        fam_freq_df["Lineage"] = ""
+
+    fam_freq_df = fam_freq_df.drop_duplicates(subset="Genome", keep="last")
+
+    return fam_freq_df.reset_index(drop=True)
+
+
+def get_family_matrix(fam_freq_df, families):
+    """Get family frequencies as a float matrix with the columns in the given order
+
+    Families absent from the df are given a frequency of 0.
+
+    :param fam_freq_df: pandas df of genome x family frequencies
+    :param families: list of CAZy families, defines the column order
+
+    Return numpy array (genomes x families)
+    """
+    matrix = fam_freq_df.reindex(columns=families, fill_value=0)
+    return matrix.fillna(0).to_numpy(dtype=np.float64)
+
+
+def fit(fam_freq_df, args):
+    """Fit the PCA and build the single-linkage clustering from scratch
+
+    :param fam_freq_df: pandas df of genome x family frequencies
+    :param args: cmd-line args parser
+
+    Return dict representing the ordination model
+    """
+    families = sorted(col for col in fam_freq_df.columns if col not in META_COLUMNS)
+    data = get_family_matrix(fam_freq_df, families)
+
+    n_components = min(args.n_components, data.shape[0], data.shape[1])
+
+    # column scaling is fixed at the first fit, so that folded in genomes share the same space
+    if args.scale:
+        scale = data.std(axis=0)
+        scale[scale == 0] = 1.0
+    else:
+        scale = np.ones(data.shape[1])
+
+    scaled = data / scale
+
+    if args.method == "randomized":
+        mean, components, singular_values = randomized_pca(
+            scaled, n_components, args.oversamples, args.power_iters, args.seed,
+        )
+        n_seen = scaled.shape[0]
+        col_mean, col_var = mean, scaled.var(axis=0)
+
+    else:  # incremental
+        state = None
+        for start in range(0, scaled.shape[0], args.batch_size):
+            state = partial_fit_pca(state, scaled[start:start + args.batch_size], n_components)
+        mean, components, singular_values = state["mean"], state["components"], state["singular_values"]
+        n_seen, col_mean, col_var = state["n_seen"], state["mean"], state["var"]
+
+    mst = prim_mst(data)
+
+    model = {
+        "families": np.array(families),
+        "meta": fam_freq_df[META_COLUMNS].astype(str).to_numpy(dtype=str),
+        "data": data,
+        "scale": scale,
+        "mean": mean,
+        "components": components,
+        "singular_values": singular_values,
+        "n_seen": np.array(n_seen),
+        "var": col_var,
+        "mst": mst,
+    }
+
+    print(f"Fitted {n_components} components to {data.shape[0]} genomes and {data.shape[1]} families")
+
+    return model
+
+
+def update(model, fam_freq_df, args):
+    """Fold genomes that are not yet in the model into the PCA and clustering
+
+    :param model: dict representing the ordination model
+    :param fam_freq_df: pandas df of genome x family frequencies, can contain genomes already
+        in the model, these are ignored
+    :param args: cmd-line args parser
+
+    Return dict representing the updated ordination model
+    """
+    known_genomes = set(model["meta"][:, 0])
+    new_df = fam_freq_df[~fam_freq_df["Genome"].astype(str).isin(known_genomes)]
+
+    if len(new_df) == 0:
+        print("No new genomes to add to the model")
+        return model
+
+    families = list(model["families"])
+    new_families = sorted(
+        col for col in new_df.columns
+        if col not in META_COLUMNS and col not in families and new_df[col].fillna(0).any()
+    )
+    if len(new_families) != 0:
+        print(
+            f"WARNING: {len(new_families)} families are not in the fitted model and are ignored "
+            f"({', '.join(new_families)}). Rerun 'fit' to include them."
+        )
+
+    new_data = get_family_matrix(new_df, families)
+
+    # update the MST using only the distances involving the new genomes
+    model["mst"] = extend_mst(model["data"], model["mst"], new_data)
+
+    if args.refit_components:
+        state = {
+            "mean": model["mean"],
+            "components": model["components"],
+            "singular_values": model["singular_values"],
+            "n_seen": int(model["n_seen"]),
+            "var": model["var"],
+        }
+        scaled = new_data / model["scale"]
+        n_components = model["components"].shape[0]
+        for start in range(0, scaled.shape[0], args.batch_size):
+            state = partial_fit_pca(state, scaled[start:start + args.batch_size], n_components)
+
+        model["mean"] = state["mean"]
+        model["components"] = state["components"]
+        model["singular_values"] = state["singular_values"]
+        model["n_seen"] = np.array(state["n_seen"])
+        model["var"] = state["var"]
+
+    model["data"] = np.vstack([model["data"], new_data])
+    model["meta"] = np.vstack([model["meta"], new_df[META_COLUMNS].astype(str).to_numpy(dtype=str)])
+
+    print(f"Added {len(new_df)} genomes to the model")
+
+    return model
+
+
+def randomized_pca(data, n_components, oversamples, power_iters, seed):
+    """Compute a truncated PCA using a randomized range finder (Halko et al. 2011)
+
+    :param data: numpy array (samples x features)
+    :param n_components: int, number of principal components to compute
+    :param oversamples: int, number of extra random projections used to improve accuracy
+    :param power_iters: int, number of power iterations
+    :param seed: int, seed for the random number generator
+
+    Return the column means, components (components x features) and singular values
+    """
+    mean = data.mean(axis=0)
+    centred = data - mean
+
+    rng = np.random.default_rng(seed)
+    n_random = min(n_components + oversamples, min(centred.shape))
+
+    sketch = centred @ rng.standard_normal((centred.shape[1], n_random))
+    q, _ = np.linalg.qr(sketch)
+
+    for _ in range(power_iters):
+        q, _ = np.linalg.qr(centred.T @ q)
+        q, _ = np.linalg.qr(centred @ q)
+
+    u_small, singular_values, vt = np.linalg.svd(q.T @ centred, full_matrices=False)
+    u = q @ u_small
+
+    vt = flip_signs(u, vt)
+
+    return mean, vt[:n_components], singular_values[:n_components]
+
+
+def partial_fit_pca(state, batch, n_components):
+    """Update an incremental PCA with a batch of samples (Ross et al. 2008)
+
+    :param state: dict of the current incremental PCA, or None if no data have been seen
+    :param batch: numpy array (samples x features)
+    :param n_components: int, number of principal components to retain
+
+    Return dict of the updated incremental PCA
+    """
+    n_batch = batch.shape[0]
+    batch_mean = batch.mean(axis=0)
+    batch_var = batch.var(axis=0)
+
+    if state is None:
+        n_seen = 0
+        mean = np.zeros(batch.shape[1])
+        var = np.zeros(batch.shape[1])
+        stacked = batch - batch_mean
+    else:
+        n_seen = state["n_seen"]
+        mean, var = state["mean"], state["var"]
+        mean_correction = np.sqrt((n_seen * n_batch) / (n_seen + n_batch)) * (mean - batch_mean)
+        stacked = np.vstack([
+            state["singular_values"][:, np.newaxis] * state["components"],
+            batch - batch_mean,
+            mean_correction,
+        ])
+
+    n_total = n_seen + n_batch
+
+    # merge the running mean and variance (Chan et al. 1979)
+    delta = batch_mean - mean
+    new_mean = mean + delta * n_batch / n_total
+    new_var = (var * n_seen + batch_var * n_batch + delta ** 2 * n_seen * n_batch / n_total) / n_total
+
+    u, singular_values, vt = np.linalg.svd(stacked, full_matrices=False)
+    vt = flip_signs(u, vt)
+
+    n_components = min(n_components, vt.shape[0])
+
+    return {
+        "mean": new_mean,
+        "var": new_var,
+        "components": vt[:n_components],
+        "singular_values": singular_values[:n_components],
+        "n_seen": n_total,
+    }
+
+
+def flip_signs(u, vt):
+    """Make the largest absolute loading of each component positive, so results are deterministic
+
+    :param u: left singular vectors
+    :param vt: right singular vectors
+
+    Return vt with signs flipped
+    """
+    max_cols = np.argmax(np.abs(vt), axis=1)
+    signs = np.sign(vt[np.arange(vt.shape[0]), max_cols])
+    signs[signs == 0] = 1
+    return vt * signs[:, np.newaxis]
+
+
+def prim_mst(data):
+    """Build the Euclidean minimum spanning tree using Prim's algorithm
+
+    Distances are computed one row at a time, so the full distance matrix is never held
+    in memory: O(n^2) time, O(n) memory.
+
+    :param data: numpy array (samples x features)
+
+    Return numpy array of MST edges (n-1 x 3): node a, node b, distance
+    """
+    n_samples = data.shape[0]
+    if n_samples < 2:
+        return np.empty((0, 3))
+
+    sq_norms = np.einsum("ij,ij->i", data, data)
+
+    in_tree = np.zeros(n_samples, dtype=bool)
+    best_dist = np.full(n_samples, np.inf)
+    best_from = np.zeros(n_samples, dtype=np.int64)
+
+    edges = np.empty((n_samples - 1, 3))
+
+    current = 0
+    in_tree[current] = True
+
+    for step in range(n_samples - 1):
+        dist = row_distances(data, sq_norms, current)
+
+        closer = (dist < best_dist) & ~in_tree
+        best_dist[closer] = dist[closer]
+        best_from[closer] = current
+
+        candidates = np.where(in_tree, np.inf, best_dist)
+        current = int(np.argmin(candidates))
+
+        edges[step] = (best_from[current], current, best_dist[current])
+        in_tree[current] = True
+
+    return edges
+
+
+def row_distances(data, sq_norms, index):
+    """Calculate the Euclidean distance from one sample to all samples
+
+    :param data: numpy array (samples x features)
+    :param sq_norms: numpy array of the squared norm of each sample
+    :param index: int, index of the sample
+
+    Return numpy array of distances
+    """
+    sq_dist = sq_norms - 2 * (data @ data[index]) + sq_norms[index]
+    return np.sqrt(np.maximum(sq_dist, 0))
+
+
+def extend_mst(data, mst, new_data):
+    """Add samples to an existing Euclidean MST
+
+    The MST of the enlarged set only uses edges from the old MST or edges that involve at
+    least one new sample, so only the new x all distances need to be calculated.
+
+    :param data: numpy array of samples already in the MST
+    :param mst: numpy array of MST edges (n-1 x 3)
+    :param new_data: numpy array of samples to add
+
+    Return numpy array of MST edges for all samples
+    """
+    n_old = data.shape[0]
+    all_data = np.vstack([data, new_data])
+    n_all = all_data.shape[0]
+
+    sq_norms = np.einsum("ij,ij->i", all_data, all_data)
+
+    candidate_edges = [mst]
+    for index in range(n_old, n_all):
+        dist = row_distances(all_data, sq_norms, index)
+        others = np.arange(index)  # edges to old samples and previously added new samples
+        candidate_edges.append(np.column_stack([others, np.full(index, index), dist[:index]]))
+
+    candidate_edges = np.vstack(candidate_edges)
+    candidate_edges = candidate_edges[np.argsort(candidate_edges[:, 2], kind="stable")]
+
+    # Kruskal's algorithm over the candidate edges
+    parents = np.arange(n_all)
+    edges = []
+
+    for node_a, node_b, dist in candidate_edges:
+        root_a, root_b = find_root(parents, int(node_a)), find_root(parents, int(node_b))
+        if root_a == root_b:
+            continue
+        parents[root_b] = root_a
+        edges.append((node_a, node_b, dist))
+        if len(edges) == n_all - 1:
+            break
+
+    return np.array(edges).reshape(-1, 3)
+
+
+def find_root(parents, node):
+    """Find the root of a node in a union-find forest, compressing the path
+
+    :param parents: numpy array, parent of each node
+    :param node: int, index of the node
+
+    Return int
+    """
+    root = node
+    while parents[root] != root:
+        root = parents[root]
+    while parents[node] != root:
+        parents[node], node = root, parents[node]
+    return root
+
+
+def mst_to_linkage(mst, n_samples):
+    """Convert an MST into a single-linkage matrix in the SciPy linkage format
+
+    :param mst: numpy array of MST edges (n-1 x 3)
+    :param n_samples: int, number of samples
+
+    Return numpy array (n-1 x 4): cluster a, cluster b, distance, number of samples
+    """
+    mst = mst[np.argsort(mst[:, 2], kind="stable")]
+
+    parents = np.arange(n_samples)
+    cluster_ids = np.arange(n_samples)  # linkage cluster id of each union-find root
+    sizes = np.ones(n_samples, dtype=np.int64)
+
+    linkage = np.empty((len(mst), 4))
+
+    for step, (node_a, node_b, dist) in enumerate(mst):
+        root_a, root_b = find_root(parents, int(node_a)), find_root(parents, int(node_b))
+
+        id_a, id_b = sorted([cluster_ids[root_a], cluster_ids[root_b]])
+        size = sizes[root_a] + sizes[root_b]
+        linkage[step] = (id_a, id_b, dist, size)
+
+        parents[root_b] = root_a
+        sizes[root_a] = size
+        cluster_ids[root_a] = n_samples + step
+
+    return linkage
+
+
+def linkage_to_newick(linkage, labels):
+    """Write a single-linkage matrix as an ultrametric Newick tree
+
+    :param linkage: numpy array in the SciPy linkage format
+    :param labels: list of leaf labels
+
+    Return str
+    """
+    n_samples = len(labels)
+    if n_samples == 1:
+        return f"{labels[0]};"
+
+    subtrees = {i: labels[i] for i in range(n_samples)}
+    heights = {i: 0.0 for i in range(n_samples)}
+
+    for step, (id_a, id_b, dist, _) in enumerate(linkage):
+        id_a, id_b = int(id_a), int(id_b)
+        height = dist / 2
+        subtrees[n_samples + step] = "({}:{},{}:{})".format(
+            subtrees.pop(id_a), height - heights[id_a],
+            subtrees.pop(id_b), height - heights[id_b],
+        )
+        heights[n_samples + step] = height
+
+    return subtrees[n_samples + len(linkage) - 1] + ";"
+
+
+def write_outputs(model, output_dir):
+    """Write out the PCA scores, loadings, explained variance and linkage
+
+    :param model: dict representing the ordination model
+    :param output_dir: Path to output dir
+
+    Return nothing
+    """
+    meta_df = pd.DataFrame(model["meta"], columns=META_COLUMNS)
+
+    components = model["components"]
+    pc_names = [f"PC{i + 1}" for i in range(components.shape[0])]
+
+    scores = ((model["data"] / model["scale"]) - model["mean"]) @ components.T
+    scores_df = pd.concat([meta_df, pd.DataFrame(scores, columns=pc_names)], axis=1)
+    scores_df.to_csv(output_dir / "pca_scores.csv")
+
+    loadings_df = pd.DataFrame(components.T, columns=pc_names)
+    loadings_df.insert(0, "Family", model["families"])
+    loadings_df.to_csv(output_dir / "pca_loadings.csv")
+
+    n_seen = int(model["n_seen"])
+    explained_variance = model["singular_values"] ** 2 / max(n_seen - 1, 1)
+    total_variance = model["var"].sum() * n_seen / max(n_seen - 1, 1)
+    explained_df = pd.DataFrame({
+        "PC": pc_names,
+        "ExplainedVariance": explained_variance,
+        "ExplainedVarianceRatio": explained_variance / total_variance,
+    })
+    explained_df.to_csv(output_dir / "pca_explained_variance.csv")
+
+    n_samples = model["data"].shape[0]
+    linkage = mst_to_linkage(model["mst"], n_samples)
+
+    linkage_df = pd.DataFrame(linkage, columns=["ClusterA", "ClusterB", "Distance", "NumberOfGenomes"])
+    linkage_df = linkage_df.astype({"ClusterA": int, "ClusterB": int, "NumberOfGenomes": int})
+    linkage_df.to_csv(output_dir / "single_linkage.csv")
+
+    # leaf i of the linkage is row i of the scores df, so the linkage maps onto the genus and species
+    labels = [
+        f"{lineage}_{genus}_{species}_-_{genome}".strip("_").replace(" ", "_")
+        for genome, lineage, genus, species in model["meta"]
+    ]
+    with open(output_dir / "single_linkage_dendrogram.new", "w") as fh:
+        fh.write(linkage_to_newick(linkage, labels) + "\n")
+
+    print(f"Wrote ordination of {n_samples} genomes to {output_dir}")
+
+
+def save_model(model, model_path):
+    """Write the ordination model to disk
+
+    :param model: dict representing the ordination model
+    :param model_path: Path to npz file
+
+    Return nothing
+    """
+    np.savez_compressed(model_path, **model)
+
+
+def load_model(model_path):
+    """Load an ordination model written by save_model
+
+    :param model_path: Path to npz file
+
+    Return dict representing the ordination model
+    """
+    try:
+        with np.load(model_path, allow_pickle=False) as npz:
+            return {key: npz[key] for key in npz.files}
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f"No ordination model found at {model_path}. Run the 'fit' subcommand first."
+        )
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="cazome_ordination.py",
+        description="PCA and single-linkage clustering of CAZome compositions",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    fit_parser = subparsers.add_parser(
+        "fit",
+        help="Fit the PCA and clustering to all genomes",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    update_parser = subparsers.add_parser(
+        "update",
+        help="Fold genomes that are not yet in the model into an existing fit",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    for subparser in [fit_parser, update_parser]:
+        subparser.add_argument(
+            "fam_freqs",
+            type=Path,
+            help="Path to CSV file of CAZy family frequencies per genome (e.g. cazy_fam_freqs.csv)",
+        )
+        subparser.add_argument(
+            "output_dir",
+            type=Path,
+            help="Path to output dir, which also stores the ordination model",
+        )
+        subparser.add_argument(
+            "--batch_size",
+            type=int,
+            default=256,
+            help="Number of genomes per batch when using incremental PCA",
+        )
+
+    fit_parser.add_argument(
+        "--n_components",
+        type=int,
+        default=4,
+        help="Number of principal components",
+    )
+    fit_parser.add_argument(
+        "--method",
+        choices=["randomized", "incremental"],
+        default="randomized",
+        help="PCA solver",
+    )
+    fit_parser.add_argument(
+        "--scale",
+        dest="scale",
+        action="store_true",
+        default=False,
+        help="Scale each family to unit variance before PCA",
+    )
+    fit_parser.add_argument(
+        "--oversamples",
+        type=int,
+        default=10,
+        help="Number of extra random projections for randomized PCA",
+    )
+    fit_parser.add_argument(
+        "--power_iters",
+        type=int,
+        default=4,
+        help="Number of power iterations for randomized PCA",
+    )
+    fit_parser.add_argument(
+        "--seed",
+        type=int,
+        default=38745,
+        help="Seed for randomized PCA",
+    )
+
+    update_parser.add_argument(
+        "--refit_components",
+        dest="refit_components",
+        action="store_true",
+        default=False,
+        help=(
+            "Update the principal components with the new genomes (incremental PCA). "
+            "By default new genomes are projected onto the existing components"
+        ),
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
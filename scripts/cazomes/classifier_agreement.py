@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Count the proteins annotated by CAZy only, dbCAN only, or both, for every CAZy class and genus in one pass"""
+
+
+import argparse
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+
+CAZY_CLASSES = ["GH", "GT", "PL", "CE", "AA", "CBM"]
+
+# bit encoding of the classifiers that annotated a protein with a family from a given class
+CLASSIFIER_BITS = {"dbCAN": 1, "CAZy": 2}
+AGREEMENT_COLUMNS = ["dbCAN_only", "CAZy_only", "Both"]  # index = bitmask - 1
+
+DB_QUERY = """
+SELECT F.family AS Family, P.genbank_accession AS Protein, T.genus AS Genus, C.classifier AS Classifier
+FROM Proteins AS P
+INNER JOIN Domains AS D ON P.protein_id = D.protein_id
+INNER JOIN CazyFamilies AS F ON D.family_id = F.family_id
+INNER JOIN Classifiers AS C ON D.classifier_id = C.classifier_id
+INNER JOIN Assemblies AS A ON P.assembly_id = A.assembly_id
+INNER JOIN Taxonomies AS T ON A.taxonomy_id = T.taxonomy_id
+WHERE C.classifier IN ('dbCAN', 'CAZy')
+"""
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.db:
+        conn = sqlite3.connect(args.input)
+        annotation_df = pd.read_sql_query(DB_QUERY, conn)
+        conn.close()
+    else:
+        annotation_df = pd.read_csv(
+            args.input, usecols=["Family", "Protein", "Genus", "Classifier"],
+        )
+
+    genera, tensor = build_agreement_tensor(annotation_df)
+
+    agreement_df = tensor_to_df(genera, tensor)
+    agreement_df.to_csv(args.output)
+
+    print(agreement_df[agreement_df["Genus"] == "All"].to_string(index=False))
+
+    if args.classifier_csv_dir is not None:
+        write_classifier_csvs(tensor, args.classifier_csv_dir)
+
+
+def build_agreement_tensor(annotation_df):
+    """Build a genus x class x agreement tensor of protein counts
+
+    Each (protein, class) pair is given a bitmask of the classifiers that annotated the
+    protein with a family from the class, so all classes and genera are counted in one pass.
+
+    :param annotation_df: pandas df with the columns Family, Protein, Genus and Classifier
+
+    Return list of genera, and numpy array (genera x classes x 3) where the last axis is
+    dbCAN only, CAZy only, both
+    """
+    annotation_df = annotation_df[annotation_df["Classifier"].isin(CLASSIFIER_BITS)]
+
+    cazy_class = annotation_df["Family"].str.extract(
+        r"^({})\d".format("|".join(CAZY_CLASSES)), expand=False,
+    )
+    known_class = cazy_class.notna().to_numpy()
+
+    annotation_df = annotation_df[known_class]
+    class_codes = pd.Categorical(cazy_class[known_class], categories=CAZY_CLASSES).codes
+
+    genus_codes, genera = pd.factorize(annotation_df["Genus"], sort=True)
+    protein_codes, _ = pd.factorize(annotation_df["Genus"] + "|" + annotation_df["Protein"])
+    bits = annotation_df["Classifier"].map(CLASSIFIER_BITS).to_numpy(dtype=np.uint8)
+
+    n_classes = len(CAZY_CLASSES)
+    pair_codes = protein_codes.astype(np.int64) * n_classes + class_codes
+
+    n_pairs = (protein_codes.max() + 1) * n_classes if len(protein_codes) else 0
+    masks = np.zeros(n_pairs, dtype=np.uint8)
+    np.bitwise_or.at(masks, pair_codes, bits)
+
+    pair_genus = np.zeros(n_pairs, dtype=np.int64)
+    pair_genus[pair_codes] = genus_codes
+
+    annotated = np.flatnonzero(masks)
+    tensor = np.zeros((len(genera), n_classes, len(AGREEMENT_COLUMNS)), dtype=np.int64)
+    np.add.at(
+        tensor,
+        (pair_genus[annotated], annotated % n_classes, masks[annotated].astype(np.int64) - 1),
+        1,
+    )
+
+    return list(genera), tensor
+
+
+def tensor_to_df(genera, tensor):
+    """Convert the agreement tensor into a long-format df, including totals across all genera
+
+    :param genera: list of genera, in the order of the first axis of the tensor
+    :param tensor: numpy array (genera x classes x 3)
+
+    Return pandas df
+    """
+    all_tensor = np.concatenate([tensor, tensor.sum(axis=0, keepdims=True)])
+    genera = list(genera) + ["All"]
+
+    rows = []
+    for genus_index, genus in enumerate(genera):
+        for class_index, cazy_class in enumerate(CAZY_CLASSES):
+            rows.append([genus, cazy_class] + list(all_tensor[genus_index, class_index]))
+
+    agreement_df = pd.DataFrame(rows, columns=["Genus", "Class"] + AGREEMENT_COLUMNS)
+
+    agreement_df["Total"] = agreement_df[AGREEMENT_COLUMNS].sum(axis=1)
+    agreement_df["dbCAN"] = agreement_df["dbCAN_only"] + agreement_df["Both"]
+    agreement_df["CAZy"] = agreement_df["CAZy_only"] + agreement_df["Both"]
+    agreement_df["Jaccard"] = (agreement_df["Both"] / agreement_df["Total"]).fillna(0)
+
+    return agreement_df
+
+
+def write_classifier_csvs(tensor, output_dir):
+    """Write the number of proteins annotated by each classifier, one CSV file per CAZy class
+
+    Uses the same layout as data/cazome/classifier-<class>-cazymes.csv
+
+    :param tensor: numpy array (genera x classes x 3)
+    :param output_dir: Path to output dir
+
+    Return nothing
+    """
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    class_totals = tensor.sum(axis=0)  # classes x agreement
+
+    for class_index, cazy_class in enumerate(CAZY_CLASSES):
+        dbcan_only, cazy_only, both = class_totals[class_index]
+
+        class_df = pd.DataFrame(
+            [[cazy_only + both, "CAZy"], [dbcan_only + both, "dbCAN"]],
+            columns=["Num_CAZy_Prot_IDs", "classifier"],
+        )
+        class_df.to_csv(
+            output_dir / f"classifier-{cazy_class.lower()}-cazymes.csv", index=False,
+        )
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="classifier_agreement.py",
+        description="Compare CAZy and dbCAN annotations per CAZy class and genus",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "input",
+        type=Path,
+        help="Path to fam-genome-protein-genus-species.csv, or local CAZome database if --db is used",
+    )
+    parser.add_argument(
+        "output",
+        type=Path,
+        help="Path to write out the agreement CSV file",
+    )
+    parser.add_argument(
+        "--db",
+        dest="db",
+        action="store_true",
+        default=False,
+        help="Input is a local CAZome database",
+    )
+    parser.add_argument(
+        "--classifier_csv_dir",
+        type=Path,
+        default=None,
+        help="Write the classifier-<class>-cazymes.csv files to this dir",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
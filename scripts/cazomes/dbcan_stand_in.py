@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Stand-in for dbCAN (run_dbcan.py), for testing run_dbcan_shards.py without the dbCAN databases
+
+Writes an overview.txt file in the dbCAN format, with predictions derived from the protein IDs,
+so repeated runs on the same proteome give the same output.
+"""
+
+
+import argparse
+import hashlib
+import os
+import time
+
+from pathlib import Path
+
+from Bio import SeqIO
+
+
+FAMILIES = ["GH5", "GH18", "GT2", "PL1", "CE4", "AA9", "CBM1"]
+SLEEP_ENV = "DBCAN_STAND_IN_SLEEP"  # seconds to sleep per 1000 proteins, to mimic the run time of dbCAN
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+
+    protein_ids = [record.id for record in SeqIO.parse(args.input, "fasta")]
+
+    time.sleep(float(os.environ.get(SLEEP_ENV, 0)) * len(protein_ids) / 1000)
+
+    with open(args.out_dir / "overview.txt", "w") as fh:
+        fh.write("Gene ID\tHMMER\tHotpep\tDIAMOND\t#ofTools\n")
+
+        for protein_id in protein_ids:
+            digest = hashlib.md5(protein_id.encode()).digest()
+            if digest[0] % 10 != 0:  # about one in ten proteins is a CAZyme
+                continue
+
+            family = FAMILIES[digest[1] % len(FAMILIES)]
+            predictions = [
+                f"{family}({digest[3]}-{digest[3] + 200})" if digest[2] & (1 << tool) else "-"
+                for tool in range(3)
+            ]
+            n_tools = sum(prediction != "-" for prediction in predictions)
+            if n_tools == 0:
+                continue
+
+            fh.write("\t".join([protein_id] + predictions + [str(n_tools)]) + "\n")
+
+
+def build_parser():
+    """Build cmd-line args parser, accepting the dbCAN arguments used by run_dbcan_shards.py"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="dbcan_stand_in.py",
+        description="Stand-in for dbCAN, writing an overview.txt file of predictions",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("input", type=Path, help="Path to protein FASTA file")
+    parser.add_argument("seq_type", choices=["protein"], help="Type of the input seqs")
+    parser.add_argument("--out_dir", type=Path, required=True, help="Path to output dir")
+    parser.add_argument("--db_dir", type=Path, default=None, help="Ignored")
+    parser.add_argument("--dia_cpu", type=int, default=1, help="Ignored")
+    parser.add_argument("--hmm_cpu", type=int, default=1, help="Ignored")
+    parser.add_argument("--hotpep_cpu", type=int, default=1, help="Ignored")
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Export the protein seqs of CAZymes in a local CAZome database, one FASTA file per class or classifier
+
+The families and classifiers of interest are loaded into temporary tables, so the seqs are
+selected with one query, and the results are streamed in batches to all output files in
+one pass over the database. CAZome databases do not store seqs, so the seqs are read from the
+Genbanks table of a local CAZy database built by cazy_webscraper, joined on the GenBank accession.
+"""
+
+
+import argparse
+import os
+import re
+import sqlite3
+import sys
+
+from pathlib import Path
+
+
+CAZY_CLASSES = ["GH", "GT", "PL", "CE", "AA", "CBM"]
+FAMILY_REGEX = re.compile(r"^(GH|GT|PL|CE|AA|CBM)\d+")
+IDENTIFIER_REGEX = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")  # table and column names
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    for identifier in [args.seq_table, args.seq_column, args.seq_key]:
+        if IDENTIFIER_REGEX.match(identifier) is None:
+            parser.error(f"Invalid table or column name: {identifier}")
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    conn.execute("PRAGMA temp_store = FILE")  # the id table may not fit in memory
+
+    if args.seq_db is not None:
+        conn.execute("ATTACH DATABASE ? AS seq_db", (f"file:{args.seq_db}?mode=ro",))
+
+    check_seq_source(conn, args)
+
+    n_ids = load_export_ids(conn, args.classes, args.classifiers, args.group_by)
+    print(f"Selected {n_ids} proteins to export")
+
+    counts = export_seqs(conn, args)
+
+    conn.close()
+
+    for group, count in sorted(counts.items()):
+        print(f"Wrote {count} seqs to {get_output_path(args.output_dir, group)}")
+
+
+def check_seq_source(conn, args):
+    """Exit with a clear message if the seq table, seq column or join key is not in the database
+
+    :param conn: sqlite3 connection
+    :param args: cmd-line args parser
+
+    Return nothing
+    """
+    schema = "main" if args.seq_db is None else "seq_db"
+    db = args.db if args.seq_db is None else args.seq_db
+
+    tables = [row[0] for row in conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table'")]
+    if args.seq_table not in tables:
+        sys.exit(
+            f"No table {args.seq_table} in {db}, tables: {', '.join(sorted(tables))}\n"
+            "Pass the database containing the seqs with --seq_db, and the table with --seq_table"
+        )
+
+    columns = [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({args.seq_table})")]
+    for column in [args.seq_column, args.seq_key]:
+        if column not in columns:
+            sys.exit(
+                f"No column {column} in {args.seq_table} in {db}, columns: {', '.join(columns)}\n"
+                "Pass the database containing the seqs with --seq_db (CAZome databases do not store seqs), "
+                "the seq column with --seq_column, and the GenBank accession column with --seq_key"
+            )
+
+
+def load_export_ids(conn, classes, classifiers, group_by):
+    """Load the IDs of the proteins to export, and the file to write each to, into a temporary table
+
+    :param conn: sqlite3 connection
+    :param classes: list of CAZy classes, e.g. ['PL', 'GH']
+    :param classifiers: list of classifiers, e.g. ['dbCAN', 'CAZy']
+    :param group_by: str, 'class' or 'classifier', to write one FASTA file per class or classifier
+
+    Return int, number of (file, protein) pairs to export
+    """
+    conn.execute("CREATE TEMP TABLE export_families (family_id INTEGER PRIMARY KEY, class TEXT)")
+    conn.execute("CREATE TEMP TABLE export_classifiers (classifier_id INTEGER PRIMARY KEY, classifier TEXT)")
+    conn.execute(
+        "CREATE TEMP TABLE export_ids (grp TEXT, protein_id INTEGER, PRIMARY KEY (grp, protein_id)) "
+        "WITHOUT ROWID"
+    )
+
+    export_families = []
+    for family_id, family in conn.execute("SELECT family_id, family FROM CazyFamilies"):
+        match = FAMILY_REGEX.match(family or "")
+        if match is not None and match.group(1) in classes:
+            export_families.append((family_id, match.group(1)))
+
+    export_classifiers = [
+        (classifier_id, classifier)
+        for classifier_id, classifier in conn.execute("SELECT classifier_id, classifier FROM Classifiers")
+        if classifier in classifiers
+    ]
+
+    with conn:
+        conn.executemany("INSERT INTO temp.export_families VALUES (?, ?)", export_families)
+        conn.executemany("INSERT INTO temp.export_classifiers VALUES (?, ?)", export_classifiers)
+
+        group_column = "F.class" if group_by == "class" else "C.classifier"
+        conn.execute(
+            f"""INSERT OR IGNORE INTO temp.export_ids (grp, protein_id)
+            SELECT {group_column}, D.protein_id
+            FROM Domains AS D
+            INNER JOIN temp.export_families AS F ON D.family_id = F.family_id
+            INNER JOIN temp.export_classifiers AS C ON D.classifier_id = C.classifier_id"""
+        )
+
+    return conn.execute("SELECT COUNT(*) FROM temp.export_ids").fetchone()[0]
+
+
+def export_seqs(conn, args):
+    """Stream the seqs of the selected proteins to one FASTA file per group
+
+    A file is written for every requested class or classifier, even if it has no seqs, so a file
+    from a previous run is never left in place. Each file is written under a temporary name and
+    renamed once all seqs are written.
+
+    :param conn: sqlite3 connection
+    :param args: cmd-line args parser
+
+    Return dict {group: number of seqs written}
+    """
+    schema = "main" if args.seq_db is None else "seq_db"
+    query = f"""SELECT E.grp, P.genbank_accession, S.{args.seq_column}
+        FROM temp.export_ids AS E
+        INNER JOIN Proteins AS P ON E.protein_id = P.protein_id
+        INNER JOIN {schema}.{args.seq_table} AS S ON S.{args.seq_key} = P.genbank_accession"""
+
+    groups = args.classes if args.group_by == "class" else args.classifiers
+
+    handles = {}
+    counts = {group: 0 for group in groups}
+    n_missing = 0
+
+    try:
+        for group in groups:
+            handles[group] = open(get_output_path(args.output_dir, group).with_suffix(".fasta.tmp"), "w")
+
+        cursor = conn.execute(query)
+        while True:
+            rows = cursor.fetchmany(args.batch_size)
+            if not rows:
+                break
+
+            for group, accession, seq in rows:
+                if not seq:
+                    n_missing += 1
+                    continue
+
+                handles[group].write(f">{accession}\n{seq}\n")
+                counts[group] += 1
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    for group in handles:
+        output_path = get_output_path(args.output_dir, group)
+        os.replace(output_path.with_suffix(".fasta.tmp"), output_path)
+
+    if n_missing:
+        print(f"No seq found in {args.seq_table}.{args.seq_column} for {n_missing} proteins")
+
+    return counts
+
+
+def get_output_path(output_dir, group):
+    """Return Path to the FASTA file of a class or classifier, e.g. <output dir>/pl_seqs.fasta"""
+    return output_dir / f"{group.lower()}_seqs.fasta"
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="export_db_seqs.py",
+        description="Export the protein seqs of CAZymes in a local CAZome database",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "db",
+        type=Path,
+        help="Path to local CAZome database, used to select the CAZymes to export",
+    )
+    parser.add_argument(
+        "output_dir",
+        type=Path,
+        help="Path to dir to write the FASTA files to, named <class or classifier>_seqs.fasta",
+    )
+    parser.add_argument(
+        "--classes",
+        nargs="+",
+        choices=CAZY_CLASSES,
+        default=CAZY_CLASSES,
+        help="CAZy classes of the proteins to export",
+    )
+    parser.add_argument(
+        "--classifiers",
+        nargs="+",
+        default=["dbCAN", "CAZy"],
+        help="Export proteins with a family of the selected classes predicted by any of these classifiers",
+    )
+    parser.add_argument(
+        "--group_by",
+        choices=["class", "classifier"],
+        default="class",
+        help="Write one FASTA file per CAZy class, or per classifier",
+    )
+    parser.add_argument(
+        "--seq_db",
+        type=Path,
+        default=None,
+        help="Path to the database containing the seq table, e.g. a local CAZy database. Default: db",
+    )
+    parser.add_argument(
+        "--seq_table",
+        type=str,
+        default="Genbanks",
+        help="Table containing the protein seqs, by default the table of a cazy_webscraper database",
+    )
+    parser.add_argument(
+        "--seq_column",
+        type=str,
+        default="sequence",
+        help="Column of the seq table containing the protein seqs",
+    )
+    parser.add_argument(
+        "--seq_key",
+        type=str,
+        default="genbank_accession",
+        help="Column of the seq table containing the GenBank accession",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=10000,
+        help="Number of seqs fetched from the database at a time",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
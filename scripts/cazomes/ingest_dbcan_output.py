@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Parse dbCAN output for each genome and bulk insert the CAZyme predictions into the local CAZome database"""
+
+
+import argparse
+import os
+import re
+import sqlite3
+
+import pandas as pd
+import yaml
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from tqdm import tqdm
+
+
+# added to the Classifiers table if not already present, their IDs are read back from the table
+CLASSIFIERS = ["dbCAN", "HMMER", "Hotpep", "DIAMOND", "CAZy"]
+DBCAN_TOOLS = ["HMMER", "Hotpep", "DIAMOND"]
+MIN_TOOLS = 2  # number of tools that must predict a family for it to be a dbCAN consensus prediction
+
+ASSEMBLY_REGEX = re.compile(r"GC[AF]_\d+\.\d+")
+FAMILY_REGEX = re.compile(r"^(GH|GT|PL|CE|AA|CBM)\d+$")
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS Taxonomies (
+        taxonomy_id INTEGER PRIMARY KEY,
+        genus TEXT,
+        species TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS Assemblies (
+        assembly_id INTEGER PRIMARY KEY,
+        assembly_accession TEXT,
+        taxonomy_id INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS Proteins (
+        protein_id INTEGER PRIMARY KEY,
+        genbank_accession TEXT,
+        assembly_id INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS CazyFamilies (
+        family_id INTEGER PRIMARY KEY,
+        family TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS Classifiers (
+        classifier_id INTEGER PRIMARY KEY,
+        classifier TEXT,
+        version TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS Domains (
+        protein_id INTEGER,
+        family_id INTEGER,
+        classifier_id INTEGER
+    )""",
+]
+
+# indexes are only built after the bulk insert of a new database
+INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS tax_index ON Taxonomies (genus, species)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS assembly_index ON Assemblies (assembly_accession)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS protein_index ON Proteins (genbank_accession)",
+    "CREATE INDEX IF NOT EXISTS protein_assembly_index ON Proteins (assembly_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS family_index ON CazyFamilies (family)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS classifier_index ON Classifiers (classifier)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS domain_index ON Domains (protein_id, family_id, classifier_id)",
+    "CREATE INDEX IF NOT EXISTS domain_family_index ON Domains (family_id)",
+]
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    with open(args.config, "r") as fh:
+        config = yaml.safe_load(fh)
+
+    dbcan_dir = Path(config["dbCAN"]["dir"])
+    dbcan_version = str(config["dbCAN"]["version"])
+
+    assembly_taxs = get_assembly_taxonomies(args.genome_csv)
+
+    new_db = not args.db.exists()
+    args.db.parent.mkdir(exist_ok=True, parents=True)
+
+    conn = sqlite3.connect(args.db)
+    configure_connection(conn)
+
+    with conn:
+        for statement in SCHEMA:
+            conn.execute(statement)
+
+    existing_assemblies = {
+        row[0] for row in conn.execute("SELECT assembly_accession FROM Assemblies")
+    }
+
+    genome_dirs = []
+    for genome_dir in sorted(dbcan_dir.iterdir()):
+        assembly = get_assembly_accession(genome_dir.name)
+        if not genome_dir.is_dir() or assembly is None:
+            continue
+        if assembly in existing_assemblies:
+            continue
+        genome_dirs.append(genome_dir)
+
+    print(
+        f"{len(existing_assemblies)} genomes already in the database, "
+        f"{len(genome_dirs)} genomes to add"
+    )
+
+    if len(genome_dirs) == 0:
+        conn.close()
+        return
+
+    with ProcessPoolExecutor(max_workers=args.cpus) as executor:
+        parsed_genomes = list(tqdm(
+            executor.map(parse_genome_dir, genome_dirs, chunksize=4),
+            total=len(genome_dirs),
+            desc="Parsing dbCAN output",
+        ))
+
+    insert_genomes(conn, parsed_genomes, assembly_taxs, dbcan_version)
+
+    if new_db:
+        print("Building indexes")
+    with conn:
+        for statement in INDEXES:
+            conn.execute(statement)
+
+    conn.close()
+
+
+def configure_connection(conn):
+    """Configure the SQLite connection for bulk loading
+
+    :param conn: sqlite3 connection
+
+    Return nothing
+    """
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -262144")  # 256MB
+
+
+def get_assembly_accession(name):
+    """Retrieve the NCBI genomic assembly accession from a file or dir name
+
+    :param name: str
+
+    Return str, or None if no accession is found
+    """
+    match = ASSEMBLY_REGEX.search(name)
+    if match is None:
+        return None
+    return match.group()
+
+
+def get_assembly_taxonomies(genome_csv):
+    """Map each genomic assembly accession to its genus and species
+
+    :param genome_csv: Path to genome dataframe created when downloading the genomes
+
+    Return dict {assembly accession: (genus, species)}
+    """
+    genome_df = pd.read_csv(genome_csv, index_col=0)
+    genome_df.columns = [col.strip() for col in genome_df.columns]
+
+    assembly_taxs = {}
+
+    for genus, species, accessions in zip(
+        genome_df["Genus"], genome_df["Species"], genome_df["NCBI Accession Numbers"],
+    ):
+        if type(accessions) is float:  # no assemblies listed
+            continue
+        for accession in accessions.split(","):
+            assembly_taxs[accession.strip()] = (genus.strip(), species.strip())
+
+    return assembly_taxs
+
+
+def parse_genome_dir(genome_dir):
+    """Parse the dbCAN overview file for a genome
+
+    :param genome_dir: Path to dbCAN output dir for the genome
+
+    Return the assembly accession (str) and a set of tuples (protein, family, classifier)
+    """
+    assembly = get_assembly_accession(genome_dir.name)
+    domains = set()
+
+    overview_path = genome_dir / "overview.txt"
+    if not overview_path.exists():
+        print(f"No dbCAN overview.txt file found in {genome_dir}")
+        return assembly, domains
+
+    with open(overview_path, "r") as fh:
+        header = fh.readline().rstrip("\n").split("\t")
+        header = [col.strip() for col in header]
+
+        tool_columns = {tool: header.index(tool) for tool in DBCAN_TOOLS if tool in header}
+
+        for line in fh:
+            row = line.rstrip("\n").split("\t")
+            if len(row) < len(header):
+                continue
+
+            protein = row[0].strip()
+            tool_predictions = {
+                tool: parse_families(row[index]) for tool, index in tool_columns.items()
+            }
+
+            family_counts = {}
+            for tool, families in tool_predictions.items():
+                for family in families:
+                    domains.add((protein, family, tool))
+                    family_counts[family] = family_counts.get(family, 0) + 1
+
+            for family, count in family_counts.items():
+                if count >= MIN_TOOLS:
+                    domains.add((protein, family, "dbCAN"))
+
+    return assembly, domains
+
+
+def parse_families(prediction):
+    """Retrieve the CAZy families from a dbCAN tool prediction
+
+    e.g. 'GH5_7(23-300)+CBM1(400-430)' -> {'GH5', 'CBM1'}
+
+    :param prediction: str, prediction from one tool in the dbCAN overview file
+
+    Return set of CAZy families
+    """
+    families = set()
+
+    for domain in prediction.split("+"):
+        family = domain.split("(")[0].strip().split("_")[0]
+        if FAMILY_REGEX.match(family):
+            families.add(family)
+
+    return families
+
+
+def insert_genomes(conn, parsed_genomes, assembly_taxs, dbcan_version):
+    """Bulk insert the parsed dbCAN predictions in a single transaction
+
+    Taxonomies, assemblies, proteins and families are deduplicated in memory and given their
+    primary keys before insertion, so each table is written with a single executemany. Classifiers
+    are looked up by name, so the IDs of a database built by another tool (e.g. pyrewton) are kept.
+
+    :param conn: sqlite3 connection
+    :param parsed_genomes: list of tuples (assembly accession, set of domains)
+    :param assembly_taxs: dict {assembly accession: (genus, species)}
+    :param dbcan_version: str, version of dbCAN used to predict CAZymes
+
+    Return nothing
+    """
+    tax_ids = load_ids(conn, "SELECT genus, species, taxonomy_id FROM Taxonomies", key_len=2)
+    family_ids = load_ids(conn, "SELECT family, family_id FROM CazyFamilies")
+    protein_ids = load_ids(conn, "SELECT genbank_accession, protein_id FROM Proteins")
+
+    next_tax_id = get_next_id(conn, "Taxonomies", "taxonomy_id")
+    next_assembly_id = get_next_id(conn, "Assemblies", "assembly_id")
+    next_protein_id = get_next_id(conn, "Proteins", "protein_id")
+    next_family_id = get_next_id(conn, "CazyFamilies", "family_id")
+
+    # added in the same transaction as the genomes, which is committed below
+    existing_classifiers = load_ids(conn, "SELECT classifier, classifier_id FROM Classifiers")
+    conn.executemany(
+        "INSERT OR IGNORE INTO Classifiers (classifier, version) VALUES (?, ?)",
+        [
+            (classifier, dbcan_version if classifier != "CAZy" else None)
+            for classifier in CLASSIFIERS
+            if classifier not in existing_classifiers
+        ],
+    )
+    classifier_ids = load_ids(conn, "SELECT classifier, classifier_id FROM Classifiers")
+
+    new_taxs, new_assemblies, new_proteins, new_families = [], [], [], []
+    new_domains = set()
+
+    for assembly, domains in parsed_genomes:
+        genus, species = assembly_taxs.get(assembly, (None, None))
+        if genus is None:
+            print(f"Could not retrieve taxonomy for {assembly}, adding genome without a taxonomy")
+
+        tax_id = tax_ids.get((genus, species))
+        if tax_id is None:
+            tax_id = next_tax_id
+            next_tax_id += 1
+            tax_ids[(genus, species)] = tax_id
+            new_taxs.append((tax_id, genus, species))
+
+        assembly_id = next_assembly_id
+        next_assembly_id += 1
+        new_assemblies.append((assembly_id, assembly, tax_id))
+
+        for protein, family, classifier in domains:
+            protein_id = protein_ids.get(protein)
+            if protein_id is None:
+                protein_id = next_protein_id
+                next_protein_id += 1
+                protein_ids[protein] = protein_id
+                new_proteins.append((protein_id, protein, assembly_id))
+
+            family_id = family_ids.get(family)
+            if family_id is None:
+                family_id = next_family_id
+                next_family_id += 1
+                family_ids[family] = family_id
+                new_families.append((family_id, family))
+
+            new_domains.add((protein_id, family_id, classifier_ids[classifier]))
+
+    with conn:
+        conn.executemany(
+            "INSERT INTO Taxonomies (taxonomy_id, genus, species) VALUES (?, ?, ?)",
+            new_taxs,
+        )
+        conn.executemany(
+            "INSERT INTO Assemblies (assembly_id, assembly_accession, taxonomy_id) VALUES (?, ?, ?)",
+            new_assemblies,
+        )
+        conn.executemany(
+            "INSERT INTO Proteins (protein_id, genbank_accession, assembly_id) VALUES (?, ?, ?)",
+            new_proteins,
+        )
+        conn.executemany(
+            "INSERT INTO CazyFamilies (family_id, family) VALUES (?, ?)",
+            new_families,
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO Domains (protein_id, family_id, classifier_id) VALUES (?, ?, ?)",
+            sorted(new_domains),
+        )
+
+    print(
+        f"Added {len(new_assemblies)} genomes, {len(new_proteins)} proteins, "
+        f"{len(new_families)} families and {len(new_domains)} domains to the database"
+    )
+
+
+def load_ids(conn, query, key_len=1):
+    """Load a mapping of natural keys to primary keys from the database
+
+    :param conn: sqlite3 connection
+    :param query: str, SQL query returning the key column(s) followed by the primary key
+    :param key_len: int, number of columns making up the key
+
+    Return dict
+    """
+    ids = {}
+    for row in conn.execute(query):
+        key = row[0] if key_len == 1 else tuple(row[:key_len])
+        ids[key] = row[key_len]
+    return ids
+
+
+def get_next_id(conn, table, column):
+    """Get the next free primary key in a table
+
+    :param conn: sqlite3 connection
+    :param table: str, name of the table
+    :param column: str, name of the primary key column
+
+    Return int
+    """
+    max_id = conn.execute(f"SELECT MAX({column}) FROM {table}").fetchone()[0]
+    return 1 if max_id is None else max_id + 1
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="ingest_dbcan_output.py",
+        description="Bulk insert dbCAN predictions into a local CAZome database",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "config",
+        type=Path,
+        help="Path to YAML config file listing the dbCAN version and output dir",
+    )
+    parser.add_argument(
+        "db",
+        type=Path,
+        help=(
+            "Path to local CAZome database. If the database exists only genomes that are "
+            "not already in the database are added"
+        ),
+    )
+    parser.add_argument(
+        "genome_csv",
+        type=Path,
+        help="Path to genome dataframe CSV file, used to retrieve the taxonomy of each genome",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of genomes to parse in parallel",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -162,57 +162,9 @@ GROUP BY T.species
 " > data/cazome/cazy-cazymes-in-cazy-db-allow-strain-mismatch.csv
 
 
-# Retrieve CAZymes per CAzy class for each classifier
-sqlite3 -header -csv data/cazy/all_cazy_2022_01_13.db "SELECT COUNT(DISTINCT P.genbank_accession) AS Num_CAZy_Prot_IDs, C.classifier
-FROM Proteins AS P
-INNER JOIN Domains AS D ON P.protein_id = D.protein_id
-INNER JOIN Classifiers AS C ON D.classifier_id = C.classifier_id
-INNER JOIN CazyFamilies AS F ON D.family_id = F.family_id
-WHERE F.family LIKE 'GH%'
-GROUP BY C.classifier
-" > data/cazome/classifier-gh-cazymes.csv
-
-sqlite3 -header -csv data/cazy/all_cazy_2022_01_13.db "SELECT COUNT(DISTINCT P.genbank_accession) AS Num_CAZy_Prot_IDs, C.classifier
-FROM Proteins AS P
-INNER JOIN Domains AS D ON P.protein_id = D.protein_id
-INNER JOIN Classifiers AS C ON D.classifier_id = C.classifier_id
-INNER JOIN CazyFamilies AS F ON D.family_id = F.family_id
-WHERE F.family LIKE 'GT%'
-GROUP BY C.classifier
-" > data/cazome/classifier-gt-cazymes.csv
-
-sqlite3 -header -csv data/cazy/all_cazy_2022_01_13.db "SELECT COUNT(DISTINCT P.genbank_accession) AS Num_CAZy_Prot_IDs, C.classifier
-FROM Proteins AS P
-INNER JOIN Domains AS D ON P.protein_id = D.protein_id
-INNER JOIN Classifiers AS C ON D.classifier_id = C.classifier_id
-INNER JOIN CazyFamilies AS F ON D.family_id = F.family_id
-WHERE F.family LIKE 'PL%'
-GROUP BY C.classifier
-" > data/cazome/classifier-pl-cazymes.csv
-
-sqlite3 -header -csv data/cazy/all_cazy_2022_01_13.db "SELECT COUNT(DISTINCT P.genbank_accession) AS Num_CAZy_Prot_IDs, C.classifier
-FROM Proteins AS P
-INNER JOIN Domains AS D ON P.protein_id = D.protein_id
-INNER JOIN Classifiers AS C ON D.classifier_id = C.classifier_id
-INNER JOIN CazyFamilies AS F ON D.family_id = F.family_id
-WHERE F.family LIKE 'CE%'
-GROUP BY C.classifier
-" > data/cazome/classifier-ce-cazymes.csv
-
-sqlite3 -header -csv data/cazy/all_cazy_2022_01_13.db "SELECT COUNT(DISTINCT P.genbank_accession) AS Num_CAZy_Prot_IDs, C.classifier
-FROM Proteins AS P
-INNER JOIN Domains AS D ON P.protein_id = D.protein_id
-INNER JOIN Classifiers AS C ON D.classifier_id = C.classifier_id
-INNER JOIN CazyFamilies AS F ON D.family_id = F.family_id
-WHERE F.family LIKE 'AA%'
-GROUP BY C.classifier
-" > data/cazome/classifier-aa-cazymes.csv
-
-sqlite3 -header -csv data/cazy/all_cazy_2022_01_13.db "SELECT COUNT(DISTINCT P.genbank_accession) AS Num_CAZy_Prot_IDs, C.classifier
-FROM Proteins AS P
-INNER JOIN Domains AS D ON P.protein_id = D.protein_id
-INNER JOIN Classifiers AS C ON D.classifier_id = C.classifier_id
-INNER JOIN CazyFamilies AS F ON D.family_id = F.family_id
-WHERE F.family LIKE 'CBM%'
-GROUP BY C.classifier
-" > data/cazome/classifier-cbm-cazymes.csv
+# Retrieve CAZymes per CAzy class for each classifier, and the agreement between CAZy and dbCAN
+# for each CAZy class and genus, in one pass over the family annotations
+python3 scripts/cazomes/classifier_agreement.py \
+    data/cazome/fam-genome-protein-genus-species.csv \
+    data/cazome/classifier-agreement.csv \
+    --classifier_csv_dir data/cazome
@@ -41,9 +41,14 @@
 # run_dbcan
 
 # run dbcan for all protein sequences FASTA files in an input directory
+# each proteome is run as an independent job, and proteomes that were already run are skipped
 
-pyrewton predict_cazymes \
+# $1 Optional, index of the shard of proteomes to run (from 0), to spread the run over nodes. Default 0
+# $2 Optional, number of shards. Default 1
+
+python3 scripts/cazomes/run_dbcan_shards.py \
     data/proteins/proteomes \
-    dbcan \
-    . \
-    -o data/proteins/dbcan_output
+    data/cazome/compile_db_config.yaml \
+    --db_dir dbCAN/db \
+    --shard ${1:-0} \
+    --num_shards ${2:-1}
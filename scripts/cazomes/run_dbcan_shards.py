@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Run dbCAN on each proteome as an independent job, so runs can be resumed and spread over cores and nodes
+
+Each proteome is run in a working dir, which is moved to <dbCAN output dir>/<assembly accession>
+with a completion marker once dbCAN has finished, so the output dir only ever contains
+complete output. Proteomes with a completion marker are not run again.
+"""
+
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+import yaml
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+from tqdm import tqdm
+
+
+FASTA_SUFFIXES = (".fasta", ".fa", ".faa")
+ASSEMBLY_REGEX = re.compile(r"GC[AF]_\d+\.\d+")
+MARKER_FILE = "dbcan_complete.json"
+RUNNING_DIR = ".running"  # not an assembly accession, so not parsed by ingest_dbcan_output.py
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    with open(args.config, "r") as fh:
+        config = yaml.safe_load(fh)
+
+    output_dir = Path(config["dbCAN"]["dir"])
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    proteomes = get_proteomes(args.proteome_dir)
+
+    # the shards are taken from the full list of proteomes, so a proteome is always in the same shard
+    proteomes = proteomes[args.shard::args.num_shards]
+
+    existing_dirs = get_existing_dirs(output_dir)
+
+    jobs = []
+    for assembly, proteome_path in proteomes:
+        if not is_complete(proteome_path, existing_dirs.get(assembly)):
+            jobs.append((assembly, proteome_path, existing_dirs.get(assembly)))
+
+    max_jobs = max(1, args.cpus // args.job_cpus)
+
+    print(
+        f"{len(proteomes)} proteomes in shard {args.shard + 1} of {args.num_shards}, "
+        f"{len(jobs)} to run, {max_jobs} at a time"
+    )
+
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        futures = [
+            executor.submit(run_job, assembly, proteome_path, output_dir, old_dir, args)
+            for assembly, proteome_path, old_dir in jobs
+        ]
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Running dbCAN"):
+            assembly, returncode = future.result()
+            if returncode != 0:
+                failed.append(assembly)
+                print(
+                    f"dbCAN failed for {assembly} with exit status {returncode}, "
+                    f"see {output_dir / RUNNING_DIR / assembly / 'dbcan.log'}"
+                )
+
+    print(f"dbCAN completed for {len(jobs) - len(failed)} proteomes, {len(failed)} failed")
+
+    if failed:
+        sys.exit(1)
+
+
+def get_proteomes(proteome_dir):
+    """List the proteome to run dbCAN on for each assembly
+
+    Each assembly is one job, which writes to a work dir named by its accession. If there is more
+    than one proteome for an assembly (e.g. a proteome extracted by pyrewton next to one written by
+    extract_proteomes.py), only the most recently modified is used.
+
+    :param proteome_dir: Path to dir containing proteome FASTA files
+
+    Return list of tuples (assembly accession, Path to proteome), sorted by accession
+    """
+    proteomes = {}
+
+    for proteome_path in sorted(path for path in proteome_dir.iterdir() if path.suffix in FASTA_SUFFIXES):
+        proteomes.setdefault(get_job_name(proteome_path), []).append(proteome_path)
+
+    selected = []
+    for assembly, paths in sorted(proteomes.items()):
+        proteome_path = max(paths, key=lambda path: (path.stat().st_mtime_ns, path.name))
+        if len(paths) > 1:
+            print(
+                f"Warning: {len(paths)} proteomes for {assembly}, using {proteome_path.name} and ignoring "
+                f"{', '.join(path.name for path in paths if path != proteome_path)}"
+            )
+        selected.append((assembly, proteome_path))
+
+    return selected
+
+
+def get_job_name(proteome_path):
+    """Return the assembly accession in the name of the proteome file, or its stem if there is none"""
+    match = ASSEMBLY_REGEX.search(proteome_path.name)
+    if match is None:
+        return proteome_path.stem
+    return match.group()
+
+
+def get_existing_dirs(output_dir):
+    """Map each assembly accession to its dbCAN output dir
+
+    Dirs written before the proteomes were run as jobs are named with, but not only of, the accession.
+
+    :param output_dir: Path to the dbCAN output dir
+
+    Return dict {assembly accession: Path}
+    """
+    existing_dirs = {}
+
+    for genome_dir in output_dir.iterdir():
+        if not genome_dir.is_dir() or genome_dir.name == RUNNING_DIR:
+            continue
+        match = ASSEMBLY_REGEX.search(genome_dir.name)
+        existing_dirs[match.group() if match is not None else genome_dir.name] = genome_dir
+
+    return existing_dirs
+
+
+def is_complete(proteome_path, genome_dir):
+    """Check if dbCAN has completed for the current version of a proteome
+
+    Output written before the proteomes were run as jobs has no completion marker, and is
+    complete if it contains the dbCAN overview file. A marker is then written for it.
+
+    :param proteome_path: Path to the proteome FASTA file
+    :param genome_dir: Path to the dbCAN output dir of the proteome, or None
+
+    Return bool
+    """
+    if genome_dir is None:
+        return False
+
+    marker_path = genome_dir / MARKER_FILE
+    stat = proteome_path.stat()
+
+    if not marker_path.exists():
+        if not (genome_dir / "overview.txt").exists():
+            return False
+        write_marker(marker_path, proteome_path, None)
+        return True
+
+    with open(marker_path, "r") as fh:
+        marker = json.load(fh)
+
+    return marker["size"] == stat.st_size and marker["mtime_ns"] == stat.st_mtime_ns
+
+
+def run_job(assembly, proteome_path, output_dir, old_dir, args):
+    """Run dbCAN for one proteome, and move its output to the dbCAN output dir once complete
+
+    :param assembly: str, assembly accession, the name of the output dir
+    :param proteome_path: Path to the proteome FASTA file
+    :param output_dir: Path to the dbCAN output dir
+    :param old_dir: Path to the output dir of a previous version of the proteome, or None
+    :param args: cmd-line args parser
+
+    Return the assembly accession, and int exit status of dbCAN
+    """
+    work_dir = output_dir / RUNNING_DIR / assembly
+    if work_dir.exists():  # left by an interrupted run, dbCAN cannot resume a run
+        shutil.rmtree(work_dir)
+    work_dir.mkdir(parents=True)
+
+    command = [
+        args.dbcan, str(proteome_path), "protein",
+        "--out_dir", str(work_dir),
+        "--db_dir", str(args.db_dir),
+        "--dia_cpu", str(args.job_cpus),
+        "--hmm_cpu", str(args.job_cpus),
+        "--hotpep_cpu", str(args.job_cpus),
+    ]
+
+    start = time.perf_counter()
+    with open(work_dir / "dbcan.log", "w") as log:
+        try:
+            returncode = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT).returncode
+        except FileNotFoundError:
+            log.write(f"Could not find {args.dbcan}\n")
+            returncode = 127
+
+    if returncode == 0 and not (work_dir / "overview.txt").exists():
+        returncode = 1
+
+    if returncode != 0:
+        return assembly, returncode
+
+    write_marker(work_dir / MARKER_FILE, proteome_path, time.perf_counter() - start)
+
+    if old_dir is not None:  # output for a previous version of the proteome
+        shutil.rmtree(old_dir)
+    os.replace(work_dir, output_dir / assembly)
+
+    return assembly, returncode
+
+
+def write_marker(marker_path, proteome_path, wall_time):
+    """Write the completion marker of a dbCAN job
+
+    :param marker_path: Path to the marker file
+    :param proteome_path: Path to the proteome FASTA file, whose size and mtime are recorded
+    :param wall_time: float, seconds dbCAN ran for, or None if not known
+
+    Return nothing
+    """
+    stat = proteome_path.stat()
+
+    with open(marker_path, "w") as fh:
+        json.dump(
+            {
+                "proteome": proteome_path.name,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "wall_time": round(wall_time, 1) if wall_time is not None else None,
+                "completed": datetime.now().isoformat(timespec="seconds"),
+            },
+            fh,
+            indent=1,
+        )
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="run_dbcan_shards.py",
+        description="Run dbCAN on each proteome as an independent, resumable job",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "proteome_dir",
+        type=Path,
+        help="Path to dir containing one protein FASTA file per genome",
+    )
+    parser.add_argument(
+        "config",
+        type=Path,
+        help="Path to YAML config file listing the dbCAN output dir",
+    )
+    parser.add_argument(
+        "--db_dir",
+        type=Path,
+        default=Path("db"),
+        help="Path to the dbCAN database dir",
+    )
+    parser.add_argument(
+        "--dbcan",
+        type=str,
+        default="run_dbcan.py",
+        help="dbCAN executable, e.g. scripts/cazomes/dbcan_stand_in.py for testing",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=os.cpu_count(),
+        help="Total number of CPUs to use",
+    )
+    parser.add_argument(
+        "--job_cpus",
+        type=int,
+        default=4,
+        help="Number of CPUs used by each dbCAN job, the jobs run at once are limited to cpus / job_cpus",
+    )
+    parser.add_argument(
+        "--shard",
+        type=int,
+        default=0,
+        help="Index of the shard of proteomes to run, from 0, to spread the proteomes over nodes",
+    )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=1,
+        help="Number of shards the proteomes are split into",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
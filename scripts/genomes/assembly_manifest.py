@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Build a manifest of the genomic assemblies listed in the genome dataframe, with one row per assembly"""
+
+
+import argparse
+import os
+
+import pandas as pd
+
+from pathlib import Path
+
+
+MANIFEST_COLUMNS = ["assembly", "genus", "species", "taxid", "file_path", "url", "md5", "size"]
+DOWNLOAD_COLUMNS = ["file_path", "url", "md5", "size"]  # filled in by fetch_genomes.py
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.manifest is None:
+        args.manifest = args.genome_csv.with_name("assembly_manifest.csv")
+
+    assembly_df = read_genome_csv(args.genome_csv)
+
+    # keep the download records of assemblies that were already in the manifest
+    if args.manifest.exists():
+        old_manifest = load_manifest(args.manifest)
+        assembly_df = assembly_df.merge(
+            old_manifest[["assembly"] + DOWNLOAD_COLUMNS], on="assembly", how="left",
+        )
+    else:
+        for column in DOWNLOAD_COLUMNS:
+            assembly_df[column] = None
+
+    write_manifest(assembly_df[MANIFEST_COLUMNS], args.manifest)
+
+    print(
+        f"Wrote {len(assembly_df)} assemblies of {assembly_df['taxid'].nunique()} species "
+        f"to {args.manifest}, {assembly_df['md5'].isna().sum()} not yet downloaded"
+    )
+
+
+def read_genome_csv(genome_csv):
+    """Split the comma-joined assembly accessions of the genome dataframe into one row per assembly
+
+    :param genome_csv: Path to genome dataframe created when downloading the genomes
+
+    Return pandas df with the columns assembly, genus, species and taxid
+    """
+    genome_df = pd.read_csv(genome_csv, index_col=0)
+    genome_df.columns = [col.strip() for col in genome_df.columns]
+
+    rows = []
+    for genus, species, taxid, accessions in zip(
+        genome_df["Genus"],
+        genome_df["Species"],
+        genome_df["NCBI Taxonomy ID"],
+        genome_df["NCBI Accession Numbers"],
+    ):
+        if type(accessions) is float:  # no assemblies listed
+            continue
+        for accession in accessions.split(","):
+            rows.append([
+                accession.strip(),
+                genus.strip(),
+                species.strip(),
+                int(str(taxid).strip().replace("NCBI:txid", "")),
+            ])
+
+    assembly_df = pd.DataFrame(rows, columns=["assembly", "genus", "species", "taxid"])
+
+    return assembly_df.drop_duplicates("assembly", ignore_index=True)
+
+
+def load_manifest(manifest_path):
+    """Load the assembly manifest
+
+    :param manifest_path: Path to assembly manifest CSV file
+
+    Return pandas df
+    """
+    return pd.read_csv(
+        manifest_path,
+        dtype={"assembly": str, "file_path": str, "url": str, "md5": str, "size": "Int64"},
+    )
+
+
+def write_manifest(manifest_df, manifest_path):
+    """Write the manifest atomically so an interrupted run cannot corrupt it
+
+    :param manifest_df: pandas df with the MANIFEST_COLUMNS
+    :param manifest_path: Path to assembly manifest CSV file
+
+    Return nothing
+    """
+    temp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    manifest_df.to_csv(temp_path, index=False)
+    os.replace(temp_path, manifest_path)
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="assembly_manifest.py",
+        description="Build a manifest with one row per assembly from the genome dataframe",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "genome_csv",
+        type=Path,
+        help="Path to genome dataframe CSV file, listing the assemblies of each species",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help="Path to the assembly manifest CSV file. Default: assembly_manifest.csv next to the genome CSV",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
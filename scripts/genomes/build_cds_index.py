@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Build an index of the CDS of every protein in the downloaded genomes, to retrieve CDSs without ncfp
+
+The index is a dir containing the CDSs concatenated in one file (cds.blob), and a numpy array
+of (protein_id, offset, length) sorted by protein ID (cds_index.npy), which is memory-mapped to
+look up CDSs by binary search without loading the index. See cluster_analysis/get_local_cds.py.
+"""
+
+
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from tqdm import tqdm
+
+from gbff_parser import extract_cds, is_gbff, iter_records
+
+
+BLOB_FILE = "cds.blob"
+INDEX_FILE = "cds_index.npy"
+MANIFEST_FILE = "manifest.json"
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    gbff_paths = sorted(path for path in args.genome_dir.iterdir() if is_gbff(path))
+
+    genomes = {
+        path.name: {"size": path.stat().st_size, "mtime_ns": path.stat().st_mtime_ns}
+        for path in gbff_paths
+    }
+
+    manifest = load_manifest(args.index_dir / MANIFEST_FILE)
+    if not args.force and manifest.get("genomes") == genomes:
+        print(f"CDS index in {args.index_dir} is up to date with {len(gbff_paths)} genomes")
+        return
+
+    print(f"Indexing the CDSs of {len(gbff_paths)} genomes")
+
+    # build the index in a separate dir, so readers never see a partially written index
+    temp_dir = args.index_dir.with_name(args.index_dir.name + ".tmp")
+    if temp_dir.exists():
+        shutil.rmtree(temp_dir)
+    temp_dir.mkdir(parents=True)
+
+    protein_ids, offsets, lengths = [], [], []
+    offset = 0
+    n_skipped = 0
+
+    with open(temp_dir / BLOB_FILE, "wb") as blob, ProcessPoolExecutor(max_workers=args.cpus) as executor:
+        futures = [executor.submit(get_genome_cds, path) for path in gbff_paths]
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Parsing genomes"):
+            genome_cds, genome_skipped = future.result()
+            n_skipped += genome_skipped
+
+            for protein_id, cds in genome_cds:
+                cds = cds.encode()
+                blob.write(cds)
+                protein_ids.append(protein_id.encode())
+                offsets.append(offset)
+                lengths.append(len(cds))
+                offset += len(cds)
+
+    index = build_index(protein_ids, offsets, lengths)
+    np.save(temp_dir / INDEX_FILE, index)
+
+    write_manifest(
+        {"genomes": genomes, "n_cds": len(index), "n_skipped": n_skipped},
+        temp_dir / MANIFEST_FILE,
+    )
+
+    swap_dirs(temp_dir, args.index_dir)
+
+    print(
+        f"Indexed {len(index)} CDSs in {args.index_dir}, "
+        f"{n_skipped} CDSs could not be extracted"
+    )
+
+
+def get_genome_cds(gbff_path):
+    """Extract the CDS of every protein in a genome, without its stop codon
+
+    :param gbff_path: Path to GenBank flat file of the genome
+
+    Return list of tuples (protein_id, str of CDS), and number of CDS features that were skipped
+    """
+    genome_cds = []
+    n_skipped = 0
+
+    for _, features, seq in iter_records(gbff_path):
+        for feature in features:
+            if "protein_id" not in feature:  # e.g. pseudogenes
+                continue
+
+            cds = extract_cds(feature, seq)
+            if not cds:
+                n_skipped += 1
+                continue
+
+            genome_cds.append((feature["protein_id"], cds))
+
+    return genome_cds, n_skipped
+
+
+def build_index(protein_ids, offsets, lengths):
+    """Build the array of CDS positions in the blob, sorted by protein ID
+
+    When a protein ID is in more than one genome, the first CDS written to the blob is kept.
+
+    :param protein_ids: list of bytes of protein IDs
+    :param offsets: list of int, offset of each CDS in the blob
+    :param lengths: list of int, length of each CDS
+
+    Return numpy structured array with fields protein_id, offset and length
+    """
+    max_id_length = max((len(protein_id) for protein_id in protein_ids), default=1)
+
+    index = np.empty(
+        len(protein_ids),
+        dtype=[("protein_id", f"S{max_id_length}"), ("offset", "<u8"), ("length", "<u4")],
+    )
+    index["protein_id"] = protein_ids
+    index["offset"] = offsets
+    index["length"] = lengths
+
+    index = index[np.argsort(index["protein_id"], kind="stable")]
+
+    _, first = np.unique(index["protein_id"], return_index=True)
+
+    return index[first]
+
+
+def swap_dirs(new_dir, index_dir):
+    """Replace the index dir with the newly built index
+
+    :param new_dir: Path to dir containing the new index
+    :param index_dir: Path to the index dir
+
+    Return nothing
+    """
+    old_dir = index_dir.with_name(index_dir.name + ".old")
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
+
+    if index_dir.exists():
+        os.replace(index_dir, old_dir)
+    os.replace(new_dir, index_dir)
+
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
+
+
+def load_manifest(manifest_path):
+    """Load the manifest of the genomes indexed in the last run
+
+    :param manifest_path: Path to JSON manifest file
+
+    Return dict
+    """
+    try:
+        with open(manifest_path, "r") as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(manifest, manifest_path):
+    """Write the manifest of the indexed genomes
+
+    :param manifest: dict
+    :param manifest_path: Path to JSON manifest file
+
+    Return nothing
+    """
+    with open(manifest_path, "w") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="build_cds_index.py",
+        description="Index the CDS of every protein in the downloaded genomes",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "genome_dir",
+        type=Path,
+        help="Path to dir containing the GenBank flat files (.gbff, optionally gzipped) of the genomes",
+    )
+    parser.add_argument(
+        "index_dir",
+        type=Path,
+        help="Path to dir to write the CDS index to",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of genomes to parse in parallel",
+    )
+    parser.add_argument(
+        "--force",
+        dest="force",
+        action="store_true",
+        default=False,
+        help="Rebuild the index even if no genomes were added or changed",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
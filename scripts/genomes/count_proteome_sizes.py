@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Count the number of proteins and residues in each proteome FASTA file extracted from the genomes"""
+
+
+import argparse
+import json
+import mmap
+import os
+import re
+
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from tqdm import tqdm
+
+
+FASTA_SUFFIXES = (".fasta", ".fa", ".faa")
+CHUNK_SIZE = 16 * 1024 * 1024  # bytes read per slice when counting newlines
+ASSEMBLY_REGEX = re.compile(r"GC[AF]_\d+\.\d+")
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.manifest is None:
+        args.manifest = args.proteome_dir / "proteome_sizes_manifest.json"
+
+    assembly_genera = get_assembly_genera(args.genome_csv)
+
+    manifest = load_manifest(args.manifest)
+
+    proteome_paths = sorted(
+        path for path in args.proteome_dir.iterdir() if path.suffix in FASTA_SUFFIXES
+    )
+
+    # only rescan proteomes that are new or whose file changed since the last run
+    to_scan = []
+    for path in proteome_paths:
+        stat = path.stat()
+        record = manifest.get(path.name)
+        if (
+            record is None
+            or record["size"] != stat.st_size
+            or record["mtime_ns"] != stat.st_mtime_ns
+        ):
+            to_scan.append(path)
+
+    print(f"{len(proteome_paths)} proteomes found, {len(to_scan)} new or changed proteomes to scan")
+
+    with ProcessPoolExecutor(max_workers=args.cpus) as executor:
+        futures = [executor.submit(count_proteome, path) for path in to_scan]
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Counting proteins"):
+            path, n_proteins, n_residues = future.result()
+            stat = path.stat()
+
+            assembly = get_assembly_accession(path.name)
+
+            manifest[path.name] = {
+                "assembly": assembly,
+                "genus": assembly_genera.get(assembly),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "n_proteins": n_proteins,
+                "n_residues": n_residues,
+            }
+
+    # drop proteomes that have been removed from the proteome dir
+    present = {path.name for path in proteome_paths}
+    manifest = {name: record for name, record in manifest.items() if name in present}
+
+    write_manifest(manifest, args.manifest)
+
+    proteome_data = []
+    for name in sorted(manifest):
+        record = manifest[name]
+        if record["genus"] is None:
+            print(f"Could not retrieve genus for {name}, not adding to proteome sizes")
+            continue
+        proteome_data.append([record["genus"], record["n_proteins"]])
+
+    proteome_df = pd.DataFrame(proteome_data, columns=["Genus", "Number of Proteins"])
+    proteome_df.to_csv(args.output)
+
+
+def count_proteome(fasta_path):
+    """Count the number of protein seqs and residues in a FASTA file using a byte-level scan
+
+    The file is memory-mapped so only the header lines are ever searched in Python,
+    the sequence lines are counted in large slices.
+
+    :param fasta_path: Path to proteome FASTA file
+
+    Return fasta path, number of proteins (int) and number of residues (int)
+    """
+    size = fasta_path.stat().st_size
+    if size == 0:
+        return fasta_path, 0, 0
+
+    n_proteins = 0
+    header_bytes = 0  # including the new line character
+    header_newlines = 0
+    header_carriage_returns = 0
+
+    with open(fasta_path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:1] == b">":
+            pos = 0
+        else:
+            pos = mm.find(b"\n>")
+            pos = pos + 1 if pos != -1 else -1
+
+        while pos != -1:
+            n_proteins += 1
+
+            eol = mm.find(b"\n", pos)
+            if eol == -1:  # header on the last line without a new line character
+                header_bytes += size - pos
+                break
+
+            header_bytes += eol - pos + 1
+            header_newlines += 1
+            if mm[eol - 1:eol] == b"\r":
+                header_carriage_returns += 1
+
+            pos = mm.find(b"\n>", eol)
+            if pos != -1:
+                pos += 1
+
+        newlines, carriage_returns = 0, 0
+        for start in range(0, size, CHUNK_SIZE):
+            chunk = mm[start:start + CHUNK_SIZE]
+            newlines += chunk.count(b"\n")
+            carriage_returns += chunk.count(b"\r")
+
+    n_residues = (
+        size
+        - header_bytes
+        - (newlines - header_newlines)
+        - (carriage_returns - header_carriage_returns)
+    )
+
+    return fasta_path, n_proteins, n_residues
+
+
+def get_assembly_accession(file_name):
+    """Retrieve the NCBI genomic assembly accession from a proteome file name
+
+    :param file_name: str, name of the proteome FASTA file
+
+    Return str, or None if no accession is in the file name
+    """
+    match = ASSEMBLY_REGEX.search(file_name)
+    if match is None:
+        return None
+    return match.group()
+
+
+def get_assembly_genera(genome_csv):
+    """Map each genomic assembly accession to its genus
+
+    :param genome_csv: Path to genome dataframe created when downloading the genomes
+
+    Return dict {assembly accession: genus}
+    """
+    genome_df = pd.read_csv(genome_csv, index_col=0)
+    genome_df.columns = [col.strip() for col in genome_df.columns]
+
+    assembly_genera = {}
+
+    for genus, accessions in zip(genome_df["Genus"], genome_df["NCBI Accession Numbers"]):
+        if type(accessions) is float:  # no assemblies listed
+            continue
+        for accession in accessions.split(","):
+            assembly_genera[accession.strip()] = genus.strip()
+
+    return assembly_genera
+
+
+def load_manifest(manifest_path):
+    """Load the manifest of proteomes counted in previous runs
+
+    :param manifest_path: Path to JSON manifest file
+
+    Return dict {file name: record}
+    """
+    try:
+        with open(manifest_path, "r") as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(manifest, manifest_path):
+    """Write the manifest atomically so an interrupted run cannot corrupt it
+
+    :param manifest: dict {file name: record}
+    :param manifest_path: Path to JSON manifest file
+
+    Return nothing
+    """
+    temp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+
+    with open(temp_path, "w") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+
+    os.replace(temp_path, manifest_path)
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="count_proteome_sizes.py",
+        description="Count the number of proteins in each proteome",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "proteome_dir",
+        type=Path,
+        help="Path to dir containing one protein FASTA file per genome",
+    )
+    parser.add_argument(
+        "genome_csv",
+        type=Path,
+        help="Path to genome dataframe CSV file, used to retrieve the genus of each genome",
+    )
+    parser.add_argument(
+        "output",
+        type=Path,
+        help="Path to write out proteome sizes CSV file",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help=(
+            "Path to JSON manifest of counted proteomes. "
+            "Default: proteome_sizes_manifest.json in the proteome dir"
+        ),
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of proteomes to scan in parallel",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
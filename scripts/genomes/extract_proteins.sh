@@ -41,8 +41,8 @@
 # extract_proteins
 
 # Extract protein sequences from downloaded gbff.gz files
+# Genomes are extracted in parallel, and only genomes that are newer than their proteome are extracted
 
-pyrewton extract_protein_seqs \
-    data/genomes/2020_05_31_genome_dataframe.csv \
+python3 scripts/genomes/extract_proteomes.py \
     data/genomes/genomes \
     data/proteins/proteomes
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Extract the protein seqs of each downloaded genome into one FASTA file per genome"""
+
+
+import argparse
+import os
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from tqdm import tqdm
+
+from gbff_parser import GBFF_SUFFIXES, is_gbff, iter_records
+
+
+LINE_LENGTH = 60  # residues per line of the FASTA files
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    gbff_paths = sorted(path for path in args.genome_dir.iterdir() if is_gbff(path))
+
+    # only extract genomes that are new or were downloaded again since their proteome was written
+    to_extract = []
+    for gbff_path in gbff_paths:
+        output_path = get_output_path(gbff_path, args.output_dir)
+        if (
+            args.force
+            or not output_path.exists()
+            or output_path.stat().st_mtime_ns < gbff_path.stat().st_mtime_ns
+        ):
+            to_extract.append((gbff_path, output_path))
+
+    print(f"{len(gbff_paths)} genomes found, {len(to_extract)} new or changed genomes to extract")
+
+    with ProcessPoolExecutor(max_workers=args.cpus) as executor:
+        futures = [
+            executor.submit(extract_proteome, gbff_path, output_path)
+            for gbff_path, output_path in to_extract
+        ]
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Extracting proteomes"):
+            gbff_path, n_proteins = future.result()
+            if n_proteins == 0:
+                print(f"No protein seqs found in {gbff_path.name}")
+
+
+def get_output_path(gbff_path, output_dir):
+    """Return Path to the proteome FASTA file of a genome, named after its GenBank flat file"""
+    name = gbff_path.name
+    for suffix in GBFF_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+
+    return output_dir / f"{name}_protein_seqs.fasta"
+
+
+def extract_proteome(gbff_path, output_path):
+    """Write the translation of each CDS feature in a genome to a FASTA file
+
+    CDS features without a protein_id or translation (e.g. pseudogenes) are skipped, and only
+    the first CDS of each protein_id is written. The file is written under a temporary name and
+    renamed once complete, so an interrupted run never leaves a partial proteome.
+
+    :param gbff_path: Path to GenBank flat file of the genome, optionally gzip-compressed
+    :param output_path: Path to write out the proteome FASTA file
+
+    Return gbff path and number of protein seqs written (int)
+    """
+    temp_path = output_path.with_name(output_path.name + ".tmp")
+    written = set()
+
+    with open(temp_path, "w") as fh:
+        for _, features, _ in iter_records(gbff_path, read_seq=False):
+            for feature in features:
+                protein_id = feature.get("protein_id")
+                translation = feature.get("translation")
+                if not protein_id or not translation or protein_id in written:
+                    continue
+
+                written.add(protein_id)
+
+                header = f">{protein_id} {feature['product']}" if "product" in feature else f">{protein_id}"
+                lines = [translation[i:i + LINE_LENGTH] for i in range(0, len(translation), LINE_LENGTH)]
+                fh.write(header + "\n" + "\n".join(lines) + "\n")
+
+    os.replace(temp_path, output_path)
+
+    return gbff_path, len(written)
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="extract_proteomes.py",
+        description="Extract the protein seqs of each genome into one FASTA file per genome",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "genome_dir",
+        type=Path,
+        help="Path to dir containing the GenBank flat files (.gbff, optionally gzipped) of the genomes",
+    )
+    parser.add_argument(
+        "output_dir",
+        type=Path,
+        help="Path to dir to write one protein FASTA file per genome to",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of genomes to extract in parallel",
+    )
+    parser.add_argument(
+        "--force",
+        dest="force",
+        action="store_true",
+        default=False,
+        help="Extract all genomes, even if their proteome is newer than the genome",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
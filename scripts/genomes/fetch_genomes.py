@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Download the genomic assemblies in the assembly manifest that are missing from the genome dir
+
+Assemblies are downloaded concurrently from the NCBI genomes FTP site, or from a local mirror
+with the same layout, partial downloads are resumed, and each file is verified against the
+md5 checksums published with the assembly.
+"""
+
+
+import argparse
+import hashlib
+import os
+import re
+import sys
+import urllib.error
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from tqdm import tqdm
+
+from assembly_manifest import load_manifest, write_manifest
+
+
+NCBI_URL = "https://ftp.ncbi.nlm.nih.gov/genomes/all"
+GBFF_SUFFIX = "_genomic.gbff.gz"
+CHUNK_SIZE = 1024 * 1024  # bytes read per read of a download or of a file being checksummed
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    args.genome_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest_df = load_manifest(args.manifest)
+    manifest_df = manifest_df.astype({"file_path": object, "url": object, "md5": object})
+
+    to_fetch = [
+        row._asdict() for row in manifest_df.itertuples(index=False)
+        if not is_downloaded(row._asdict(), args.genome_dir)
+    ]
+
+    print(f"{len(manifest_df)} assemblies in the manifest, {len(to_fetch)} to download")
+
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=args.max_downloads) as executor:
+        futures = [
+            executor.submit(fetch_assembly, record, args.genome_dir, args.base_url, args.retries)
+            for record in to_fetch
+        ]
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading genomes"):
+            record, error = future.result()
+            if error is not None:
+                failed.append(record["assembly"])
+                print(f"Could not download {record['assembly']}: {error}")
+                continue
+
+            # record each download, so an interrupted run does not download it again
+            index = manifest_df.index[manifest_df["assembly"] == record["assembly"]]
+            for column in ["file_path", "url", "md5", "size"]:
+                manifest_df.loc[index, column] = record[column]
+            write_manifest(manifest_df, args.manifest)
+
+    print(f"Downloaded {len(to_fetch) - len(failed)} assemblies, {len(failed)} failed")
+
+    if failed:
+        print("Rerun to retry the failed downloads")
+        sys.exit(1)
+
+
+def is_downloaded(record, genome_dir):
+    """Check if an assembly was downloaded and its file is complete
+
+    :param record: dict, row of the manifest
+    :param genome_dir: Path to dir the genomes are downloaded to
+
+    Return bool
+    """
+    if type(record["file_path"]) is not str or type(record["md5"]) is not str:
+        return False
+
+    file_path = genome_dir / record["file_path"]
+
+    return file_path.exists() and file_path.stat().st_size == record["size"]
+
+
+def fetch_assembly(record, genome_dir, base_url, retries):
+    """Download the GenBank flat file of an assembly, and verify its md5 checksum
+
+    :param record: dict, row of the manifest
+    :param genome_dir: Path to dir to download the genome to
+    :param base_url: str, URL of the NCBI genomes/all dir, or of a mirror with the same layout
+    :param retries: int, number of times to retry a failed download
+
+    Return the record, with the download columns filled in, and str of the error or None
+    """
+    try:
+        assembly_url = get_assembly_url(record["assembly"], base_url)
+        file_name = assembly_url.rsplit("/", 1)[-1] + GBFF_SUFFIX
+        md5 = get_md5(assembly_url, file_name)
+    except (urllib.error.URLError, OSError, ValueError) as error:
+        return record, str(error)
+
+    file_path = genome_dir / file_name
+    part_path = genome_dir / (file_name + ".part")
+    url = f"{assembly_url}/{file_name}"
+
+    # downloaded before the assembly was added to the manifest
+    if file_path.exists() and file_md5(file_path) == md5:
+        record.update({"file_path": file_name, "url": url, "md5": md5, "size": file_path.stat().st_size})
+        return record, None
+
+    error = None
+    for _ in range(retries + 1):
+        try:
+            download(url, part_path)
+        except (urllib.error.URLError, OSError) as download_error:
+            error = str(download_error)
+            continue  # resume the partial file
+
+        if file_md5(part_path) == md5:
+            os.replace(part_path, file_path)
+            record.update({"file_path": file_name, "url": url, "md5": md5, "size": file_path.stat().st_size})
+            return record, None
+
+        error = "md5 checksum does not match"
+        part_path.unlink()  # corrupt, download again from the start
+
+    return record, error
+
+
+def get_assembly_url(assembly, base_url):
+    """Find the URL of the dir of an assembly, which is named after its accession and assembly name
+
+    :param assembly: str, assembly accession, e.g. GCA_012656185.1
+    :param base_url: str, URL of the NCBI genomes/all dir, or of a mirror with the same layout
+
+    Return str
+    """
+    prefix, number = assembly.split(".")[0].split("_")
+    parent_url = f"{base_url.rstrip('/')}/{prefix}/{number[0:3]}/{number[3:6]}/{number[6:9]}"
+
+    with urllib.request.urlopen(f"{parent_url}/") as response:
+        listing = response.read().decode()
+
+    match = re.search(rf'href="(?:[^"]*/)?({re.escape(assembly)}_[^"/]+)/?"', listing)
+    if match is None:
+        raise ValueError(f"no dir for {assembly} in {parent_url}")
+
+    return f"{parent_url}/{match.group(1)}"
+
+
+def get_md5(assembly_url, file_name):
+    """Get the md5 checksum of a file of an assembly from the md5checksums.txt file of the assembly
+
+    :param assembly_url: str, URL of the dir of the assembly
+    :param file_name: str, name of the file
+
+    Return str
+    """
+    with urllib.request.urlopen(f"{assembly_url}/md5checksums.txt") as response:
+        for line in response.read().decode().splitlines():
+            md5, _, name = line.strip().partition("  ")
+            if name.lstrip("./") == file_name:
+                return md5
+
+    raise ValueError(f"no md5 checksum for {file_name}")
+
+
+def download(url, part_path):
+    """Download a file, resuming a partial download
+
+    :param url: str, URL of the file
+    :param part_path: Path to the partial download, which is appended to
+
+    Return nothing
+    """
+    start = part_path.stat().st_size if part_path.exists() else 0
+    request = urllib.request.Request(url, headers={"Range": f"bytes={start}-"} if start else {})
+
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as error:
+        if error.code == 416:  # the partial file is already complete
+            return
+        raise
+
+    with response:
+        # the server ignored the Range header, and is sending the whole file
+        mode = "ab" if response.status == 206 else "wb"
+
+        with open(part_path, mode) as fh:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                fh.write(chunk)
+
+
+def file_md5(file_path):
+    """Return the md5 checksum of a file, as a str of hex digits"""
+    md5 = hashlib.md5()
+
+    with open(file_path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="fetch_genomes.py",
+        description="Download the assemblies in the assembly manifest that have not been downloaded",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "manifest",
+        type=Path,
+        help="Path to the assembly manifest CSV file, built by assembly_manifest.py",
+    )
+    parser.add_argument(
+        "genome_dir",
+        type=Path,
+        help="Path to dir to download the genomes to",
+    )
+    parser.add_argument(
+        "--base_url",
+        type=str,
+        default=NCBI_URL,
+        help="URL of the NCBI genomes/all dir, or of a local mirror with the same layout",
+    )
+    parser.add_argument(
+        "--max_downloads",
+        type=int,
+        default=4,
+        help="Maximum number of concurrent downloads",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Number of times to retry a failed download",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Stream the CDS features of (optionally gzip-compressed) GenBank flat files without building SeqRecords"""
+
+
+import gzip
+
+from Bio.Data.CodonTable import unambiguous_dna_by_id
+from Bio.Seq import reverse_complement
+
+
+GBFF_SUFFIXES = (".gbff", ".gbff.gz", ".gbk", ".gbk.gz", ".gb", ".gb.gz")
+
+FEATURE_INDENT = 21  # column at which feature locations and qualifiers start
+SEQ_DELETE = str.maketrans("", "", "0123456789 \t\r\n")  # drop positions and spacing of ORIGIN lines
+
+
+def is_gbff(path):
+    """Return True if the file name has a GenBank flat file suffix"""
+    return path.name.endswith(GBFF_SUFFIXES)
+
+
+def open_gbff(gbff_path):
+    """Open a GenBank flat file for reading as text, decompressing it if it ends in .gz"""
+    if gbff_path.name.endswith(".gz"):
+        return gzip.open(gbff_path, "rt")
+    return open(gbff_path, "r")
+
+
+def iter_records(gbff_path, read_seq=True):
+    """Stream the records of a GenBank flat file, parsing only the CDS features
+
+    :param gbff_path: Path to GenBank flat file, optionally gzip-compressed
+    :param read_seq: bool, read the nucleotide seq of each record. Skipped when only the
+        qualifiers of the CDS features are needed, e.g. to extract the protein seqs
+
+    Return generator of tuples (locus name, list of CDS features, str of nt seq or None),
+        each CDS feature is a dict {'location': str, qualifier: str of value}
+    """
+    with open_gbff(gbff_path) as fh:
+        locus = None
+        features = []
+        feature = None  # the CDS feature being parsed
+        qualifier = None  # [name, list of value lines] of the qualifier being parsed
+        in_features = False
+        seq_lines = None
+
+        for line in fh:
+            if seq_lines is not None:
+                if line.startswith("//"):
+                    yield locus, features, "".join(seq_lines).translate(SEQ_DELETE).upper()
+                    locus, features, seq_lines = None, [], None
+                elif read_seq:
+                    seq_lines.append(line)
+                continue
+
+            if line.startswith("LOCUS"):
+                locus = line.split()[1]
+                continue
+
+            if line.startswith("FEATURES"):
+                in_features = True
+                continue
+
+            if not in_features:
+                if line.startswith("//"):  # record without a seq
+                    yield locus, features, None
+                    locus, features = None, []
+                continue
+
+            if line[:1] != " ":  # end of the feature table, e.g. ORIGIN, CONTIG or //
+                add_qualifier(feature, qualifier)
+                feature, qualifier = None, None
+                in_features = False
+
+                if line.startswith("ORIGIN"):
+                    seq_lines = []
+                elif line.startswith("//"):
+                    yield locus, features, None
+                    locus, features = None, []
+                continue
+
+            if line[5] != " ":  # start of a new feature
+                add_qualifier(feature, qualifier)
+                qualifier = None
+
+                if line[5:FEATURE_INDENT].strip() == "CDS":
+                    feature = {"location": line[FEATURE_INDENT:].strip()}
+                    features.append(feature)
+                else:
+                    feature = None
+                continue
+
+            if feature is None:  # not a CDS feature
+                continue
+
+            text = line[FEATURE_INDENT:].rstrip("\n")
+
+            if qualifier is None and not text.startswith("/"):  # location continued
+                feature["location"] += text.strip()
+                continue
+
+            # a new qualifier starts with '/', unless the value of the last one is still in quotes
+            if text.startswith("/") and (qualifier is None or not in_quotes(qualifier)):
+                add_qualifier(feature, qualifier)
+                name, _, value = text[1:].partition("=")
+                qualifier = [name, [value]]
+            else:
+                qualifier[1].append(text)
+
+
+def in_quotes(qualifier):
+    """Return True if the value of a qualifier has an unclosed quote"""
+    return sum(value.count('"') for value in qualifier[1]) % 2 == 1
+
+
+def add_qualifier(feature, qualifier):
+    """Add a parsed qualifier to its feature
+
+    Lines of translations are joined without spaces, and lines of other values with spaces.
+
+    :param feature: dict of the CDS feature, or None
+    :param qualifier: [name, list of value lines], or None
+
+    Return nothing
+    """
+    if feature is None or qualifier is None:
+        return
+
+    name, lines = qualifier
+    separator = "" if name == "translation" else " "
+    feature[name] = separator.join(line.strip() for line in lines).strip('"')
+
+
+def parse_location(location):
+    """Parse a feature location into its parts, in the order they are transcribed
+
+    Fuzzy ends ('<', '>') are treated as exact. Locations referring to other records, and
+    locations between bases ('^'), are not supported.
+
+    :param location: str, e.g. 'complement(join(100..200,300..>400))'
+
+    Return list of tuples (0-based start, end, strand), or None if the location is not supported
+    """
+    location = location.replace(" ", "")
+
+    for operator in ("complement(", "join(", "order("):
+        if location.startswith(operator) and location.endswith(")"):
+            inner = location[len(operator):-1]
+
+            if operator == "complement(":
+                parts = parse_location(inner)
+                if parts is None:
+                    return None
+                return [(start, end, -strand) for start, end, strand in reversed(parts)]
+
+            parts = []
+            for sub_location in split_top_level(inner):
+                sub_parts = parse_location(sub_location)
+                if sub_parts is None:
+                    return None
+                parts += sub_parts
+            return parts
+
+    if ":" in location or "^" in location or "(" in location:
+        return None
+
+    start, _, end = location.replace("<", "").replace(">", "").partition("..")
+    try:
+        start = int(start)
+        end = int(end) if end else start
+    except ValueError:
+        return None
+
+    return [(start - 1, end, 1)]
+
+
+def split_top_level(location):
+    """Split a location at the commas that are not within brackets"""
+    parts = []
+    depth = 0
+    last = 0
+
+    for index, char in enumerate(location):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(location[last:index])
+            last = index + 1
+
+    parts.append(location[last:])
+
+    return parts
+
+
+def extract_cds(feature, seq, drop_stop_codon=True):
+    """Extract the nucleotide seq of a CDS feature from the seq of its record
+
+    The bases before codon_start are removed, so the CDS is in frame with its translation.
+
+    :param feature: dict of the CDS feature, from iter_records
+    :param seq: str, nt seq of the record
+    :param drop_stop_codon: bool, remove the terminal stop codon
+
+    Return str of the CDS, or None if the location is not supported
+    """
+    parts = parse_location(feature["location"])
+    if parts is None or seq is None:
+        return None
+
+    cds = "".join(
+        seq[start:end] if strand == 1 else reverse_complement(seq[start:end])
+        for start, end, strand in parts
+    )
+
+    codon_start = int(feature.get("codon_start", 1))
+    cds = cds[codon_start - 1:]
+
+    if drop_stop_codon and len(cds) % 3 == 0:
+        stop_codons = unambiguous_dna_by_id[int(feature.get("transl_table", 1))].stop_codons
+        if cds[-3:] in stop_codons:
+            cds = cds[:-3]
+
+    return cds
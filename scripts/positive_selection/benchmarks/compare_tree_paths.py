@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Compare the neighbour-joining fast path against modeltest-ng and RaxML-ng on synthetic clusters
+
+Both paths are timed, and the LRTs of the branch-site tests run on each tree are compared.
+CodeML, modeltest-ng and RaxML-ng are found on PATH, so the stand-ins can be used by passing
+their bin dir.
+"""
+
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from datetime import datetime
+from io import StringIO
+from pathlib import Path
+
+from Bio import Phylo
+
+from run_benchmarks import BENCHMARK_DIR, CLUSTER_ANALYSIS_DIR, get_version
+from synthetic_clusters import write_cluster
+
+
+SIGNIFICANCE_LEVEL = 0.05
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.bin_dir is not None:
+        env["PATH"] = f"{args.bin_dir.resolve()}{os.pathsep}{env['PATH']}"
+
+    commit, dirty = get_version()
+    run_info = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "label": args.label,
+    }
+
+    records, agreements = [], []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for num_seqs in args.num_seqs:
+            cluster_dir = write_cluster(Path(temp_dir), num_seqs, args.num_codons, seed=args.seed)
+
+            timings = {}
+            lrts = {}
+
+            timings["tree_nj"] = run_nj(cluster_dir)
+            timings["tree_raxml"] = run_raxml(cluster_dir, args.bs_trees, env)
+
+            for path in ("nj", "raxml"):
+                timings[f"codeml_{path}"], lrts[path] = run_codeml(
+                    cluster_dir, cluster_dir / f"{path}_tree", path, args.num_proteins, args.codeml, env,
+                )
+
+            agreement = compare_lrts(lrts["nj"], lrts["raxml"])
+            agreement.update({
+                "num_seqs": num_seqs,
+                "rf_distance": robinson_foulds(cluster_dir / "nj_tree", cluster_dir / "raxml_tree"),
+                "tree_speedup": timings["tree_raxml"] / timings["tree_nj"],
+            })
+            agreements.append(agreement)
+
+            for stage, seconds in timings.items():
+                records.append(dict(
+                    run_info,
+                    stage=stage,
+                    num_seqs=num_seqs,
+                    num_codons=args.num_codons,
+                    repeats=1,
+                    min_s=seconds,
+                    median_s=seconds,
+                    max_s=seconds,
+                ))
+
+    agreement_df = pd.DataFrame(agreements)
+    print(agreement_df.to_string(index=False, float_format="%.3f"))
+    agreement_df.to_csv(args.agreement_output, sep="\t", index=False, float_format="%.4f")
+
+    with open(args.results, "a") as fh:
+        for record in records:
+            fh.write(json.dumps(record) + "\n")
+
+    print(f"Appended {len(records)} timings to {args.results}")
+
+
+def run_nj(cluster_dir):
+    """Build the NJ tree, return the wall time in seconds"""
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable, str(CLUSTER_ANALYSIS_DIR / "nj_tree.py"),
+            str(cluster_dir / "aligned_nts.fasta"),
+            str(cluster_dir / "nj_tree"),
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def run_raxml(cluster_dir, bs_trees, env):
+    """Select a model and build the bootstrapped tree as in automate_cluster_analysis.sh
+
+    Return the wall time in seconds
+    """
+    alignment = str(cluster_dir / "aligned_nts.fasta")
+    tree_dir = cluster_dir / "tree"
+    tree_dir.mkdir()
+
+    start = time.perf_counter()
+
+    def run(cmd):
+        subprocess.run(cmd, check=True, env=env, stdout=subprocess.DEVNULL, cwd=cluster_dir)
+
+    run(["modeltest-ng", "-i", alignment, "-d", "nt", "-o", str(cluster_dir / "modeltest_output")])
+    run([
+        sys.executable, str(CLUSTER_ANALYSIS_DIR / "get_model.py"),
+        str(cluster_dir / "modeltest_output.out"), str(cluster_dir / "bestmodel.txt"),
+    ])
+    model = (cluster_dir / "bestmodel.txt").read_text().strip()
+
+    for prefix, options in [
+        ("01_check", ["--check"]),
+        ("02_parse", ["--parse"]),
+        ("03_infer", ["--threads", "3", "--seed", "38745"]),
+        ("04_bootstrap", ["--bootstrap", "--threads", "3", "--seed", "38745", "--bs-trees", str(bs_trees)]),
+    ]:
+        run(["raxml-ng"] + options + ["--msa", alignment, "--model", model, "--prefix", str(tree_dir / prefix)])
+
+    run([
+        sys.executable, str(CLUSTER_ANALYSIS_DIR / "get_best_tree.py"),
+        str(tree_dir / "04_bootstrap.raxml.log"),
+        str(tree_dir / "04_bootstrap.raxml.bootstraps"),
+        str(cluster_dir / "raxml_tree"),
+    ])
+
+    return time.perf_counter() - start
+
+
+def run_codeml(cluster_dir, tree_path, path, num_proteins, codeml, env):
+    """Run the branch-site tests for the first proteins in the cluster on a tree
+
+    Return the wall time in seconds, and pandas df of the LRT of each protein
+    """
+    output_dir = cluster_dir / f"codeml_{path}"
+    output_dir.mkdir()
+
+    cluster_df = pd.read_csv(cluster_dir / "cluster_data.csv")
+    cluster_df.head(num_proteins).to_csv(output_dir / "cluster_data.csv")
+
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable, str(CLUSTER_ANALYSIS_DIR / "measure_selection.py"),
+            str(output_dir / "cluster_data.csv"),
+            str(tree_path),
+            str(cluster_dir / "aligned_nts.fasta"),
+            str(CLUSTER_ANALYSIS_DIR / "codeml_ctl.ctl"),
+            "--codeml", codeml,
+            "--summary_df", str(output_dir / "summary.tsv"),
+        ],
+        check=True,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    seconds = time.perf_counter() - start
+
+    summary = pd.read_csv(output_dir / "summary.tsv", sep="\t")
+    summary["lrt"] = 2 * (summary["lnl1"] - summary["lnl0"])
+
+    return seconds, summary[["accessions", "lrt", "p_value"]]
+
+
+def compare_lrts(nj_lrts, raxml_lrts):
+    """Compare the LRTs calculated on the NJ and RaxML-ng trees
+
+    Return dict
+    """
+    lrts = pd.merge(nj_lrts, raxml_lrts, on="accessions", suffixes=("_nj", "_raxml"))
+    significant_nj = lrts["p_value_nj"] <= SIGNIFICANCE_LEVEL
+    significant_raxml = lrts["p_value_raxml"] <= SIGNIFICANCE_LEVEL
+
+    return {
+        "proteins": len(lrts),
+        "significance_agreement": (significant_nj == significant_raxml).mean(),
+        "lrt_spearman": lrts["lrt_nj"].corr(lrts["lrt_raxml"], method="spearman"),
+        "max_lrt_difference": (lrts["lrt_nj"] - lrts["lrt_raxml"]).abs().max(),
+    }
+
+
+def robinson_foulds(tree_path1, tree_path2):
+    """Calculate the normalised Robinson-Foulds distance between two unrooted trees"""
+    splits = []
+
+    for tree_path in (tree_path1, tree_path2):
+        tree = Phylo.read(StringIO(tree_path.read_text()), "newick")
+        names = frozenset(leaf.name for leaf in tree.get_terminals())
+        tree_splits = set()
+        for clade in tree.get_nonterminals():
+            side = frozenset(leaf.name for leaf in clade.get_terminals())
+            if 1 < len(side) < len(names) - 1:
+                tree_splits.add(min(side, names - side, key=sorted))
+        splits.append(tree_splits)
+
+    total = len(splits[0]) + len(splits[1])
+
+    return len(splits[0] ^ splits[1]) / total if total else 0.0
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="compare_tree_paths.py",
+        description="Compare the NJ fast path against RaxML-ng on synthetic clusters",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--num_seqs",
+        type=int,
+        nargs="+",
+        default=[10, 50, 100],
+        help="Cluster sizes to compare",
+    )
+    parser.add_argument(
+        "--num_codons",
+        type=int,
+        default=400,
+        help="Alignment length in codons",
+    )
+    parser.add_argument(
+        "--num_proteins",
+        type=int,
+        default=5,
+        help="Number of proteins per cluster to run the branch-site tests for",
+    )
+    parser.add_argument(
+        "--bs-trees",
+        dest="bs_trees",
+        type=int,
+        default=100,
+        help="Number of RaxML-ng bootstrap trees",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="Random seed for the synthetic clusters",
+    )
+    parser.add_argument(
+        "--codeml",
+        type=str,
+        default="codeml",
+        help="CodeML executable",
+    )
+    parser.add_argument(
+        "--bin_dir",
+        type=Path,
+        default=None,
+        help="Dir added to the start of PATH, e.g. containing the stand-ins from stand_ins.py",
+    )
+    parser.add_argument(
+        "--results",
+        type=Path,
+        default=BENCHMARK_DIR / "benchmark_results.jsonl",
+        help="Path to JSONL results file, timings are appended",
+    )
+    parser.add_argument(
+        "--agreement_output",
+        type=Path,
+        default=Path("tree_path_agreement.tsv"),
+        help="Path to write out the LRT agreement and tree distance of each cluster",
+    )
+    parser.add_argument(
+        "--label",
+        type=str,
+        default=None,
+        help="Label for the run, used in place of the commit when comparing",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
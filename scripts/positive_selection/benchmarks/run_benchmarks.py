@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Time the stages of the positive selection screen on synthetic clusters, and compare timings between versions"""
+
+
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from datetime import datetime
+from pathlib import Path
+
+from synthetic_clusters import write_cluster
+
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+CLUSTER_ANALYSIS_DIR = BENCHMARK_DIR.parent / "cluster_analysis"
+sys.path.insert(0, str(CLUSTER_ANALYSIS_DIR))
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.subcommand == "run":
+        run_benchmarks(args)
+    else:
+        regressions = compare_results(args.results, args.base, args.head, args.threshold)
+        if not regressions.empty:
+            sys.exit(1)
+
+
+def get_version():
+    """Get the commit of the working tree, and if it contains uncommitted changes
+
+    Return str of commit (None if not in a git repo), bool
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BENCHMARK_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=BENCHMARK_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+    return commit, status != ""
+
+
+def build_stages(cluster_dir, work_dir):
+    """Build the stage functions to time for a synthetic cluster
+
+    Stages whose module cannot be imported (e.g. rpy2 or bioservices is not installed) are
+    left out, and reported.
+
+    :param cluster_dir: Path to synthetic cluster
+    :param work_dir: Path to dir for the output of the stages
+
+    Return dict {stage name: function taking no args}
+    """
+    stages = {}
+
+    names = pd.read_csv(cluster_dir / "cluster_data.csv")["GenBank_Accession"].tolist()
+    accession = names[len(names) // 2]
+
+    try:
+        import get_best_tree
+    except ImportError as err:
+        print(f"Skipping get_best_tree: {err}")
+    else:
+        tree_args = argparse.Namespace(
+            raxml_log=cluster_dir / "04_bootstrap.raxml.log",
+            boostraps_file=cluster_dir / "04_bootstrap.raxml.bootstraps",
+            tree_file=work_dir / "bestTree",
+        )
+        stages["get_best_tree_num"] = lambda: get_best_tree.get_best_tree_num(tree_args)
+
+    try:
+        from get_uniprot_cluster_of_interest import parse_mmseq
+    except ImportError as err:
+        print(f"Skipping parse_mmseq: {err}")
+    else:
+        stages["parse_mmseq"] = lambda: parse_mmseq(cluster_dir / "mmseqs_cluster.tsv")
+
+    try:
+        from codon_qc import read_alignment
+        from nj_tree import neighbour_joining, pairwise_distances
+    except ImportError as err:
+        print(f"Skipping nj_tree: {err}")
+    else:
+        def nj_tree():
+            names, matrix = read_alignment(cluster_dir / "aligned_nts.fasta")
+            neighbour_joining(pairwise_distances(matrix), names)
+
+        stages["nj_tree"] = nj_tree
+
+    try:
+        from ng86_prefilter import ng86_from_alignment, screen_proteins
+    except ImportError as err:
+        print(f"Skipping ng86_prefilter: {err}")
+    else:
+        stages["ng86_prefilter"] = lambda: screen_proteins(
+            *ng86_from_alignment(cluster_dir / "aligned_nts.fasta"),
+        )
+
+    try:
+        import measure_selection
+    except ImportError as err:
+        print(f"Skipping reorder_msa, label_tree, calculate_chisquared and write_summary: {err}")
+        return stages
+
+    summary_data = [
+        [cluster_dir.name, name, 0.5, -1000.0, 10.0, -1001.0, 9.0, name] for name in names
+    ]
+    summary_df = work_dir / "summary.tsv"
+
+    def write_summary():
+        # add the cluster to a summary already containing the same number of rows
+        if summary_df.exists():
+            summary_df.unlink()
+        measure_selection.write_summary(summary_data, summary_df)
+        measure_selection.write_summary(summary_data, summary_df)
+
+    stages["reorder_msa"] = lambda: measure_selection.reorder_msa(
+        cluster_dir / "aligned_nts.fasta", work_dir, accession,
+    )
+    stages["label_tree"] = lambda: measure_selection.label_tree(
+        cluster_dir / "bestTree", accession, work_dir / f"{accession}_labelled.tree",
+    )
+    stages["calculate_chisquared"] = lambda: measure_selection.calculate_chisquared(
+        cluster_dir / "alt_mdl_output", cluster_dir / "null_mdl_output",
+    )
+    stages["write_summary"] = write_summary
+
+    return stages
+
+
+def time_stage(func, repeats):
+    """Time a function, with one untimed warm-up call
+
+    :param func: function taking no args
+    :param repeats: int, number of timed calls
+
+    Return list of floats, seconds per call
+    """
+    func()
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def time_end_to_end(cluster_dir, work_dir, num_proteins):
+    """Time measure_selection.py run on a subset of proteins, using the CodeML stand-in
+
+    :param cluster_dir: Path to synthetic cluster
+    :param work_dir: Path to dir for the output
+    :param num_proteins: int, number of proteins to test for positive selection
+
+    Return float, seconds
+    """
+    e2e_dir = work_dir / "end_to_end"
+    if e2e_dir.exists():
+        shutil.rmtree(e2e_dir)
+    e2e_dir.mkdir()
+
+    cluster_df = pd.read_csv(cluster_dir / "cluster_data.csv")
+    cluster_df.head(num_proteins).to_csv(e2e_dir / "cluster_data.csv")
+
+    bin_dir = work_dir / "bin"
+    subprocess.run([sys.executable, str(BENCHMARK_DIR / "stand_ins.py"), "install", str(bin_dir)], check=True)
+
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable, str(CLUSTER_ANALYSIS_DIR / "measure_selection.py"),
+            str(e2e_dir / "cluster_data.csv"),
+            str(cluster_dir / "bestTree"),
+            str(cluster_dir / "aligned_nts.fasta"),
+            str(CLUSTER_ANALYSIS_DIR / "codeml_ctl.ctl"),
+            "--codeml", str(bin_dir / "codeml"),
+            "--summary_df", str(e2e_dir / "summary.tsv"),
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+    return time.perf_counter() - start
+
+
+def run_benchmarks(args):
+    """Generate synthetic clusters, time each stage and append the timings to the results file
+
+    :param args: cmd-line args parser
+
+    Return nothing
+    """
+    commit, dirty = get_version()
+    if dirty:
+        print("Warning: the working tree contains uncommitted changes")
+
+    run_info = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "label": args.label,
+    }
+
+    temp_dir = None
+    if args.cluster_dir is None:
+        temp_dir = tempfile.TemporaryDirectory()
+        cluster_parent = Path(temp_dir.name)
+    else:
+        cluster_parent = args.cluster_dir
+
+    records = []
+
+    try:
+        for num_seqs in args.num_seqs:
+            cluster_dir = cluster_parent / f"synthetic_{num_seqs}"
+            if not (cluster_dir / "null_mdl_output").exists():
+                write_cluster(cluster_parent, num_seqs, args.num_codons, args.num_bootstraps, args.seed)
+
+            with tempfile.TemporaryDirectory() as work_dir:
+                work_dir = Path(work_dir)
+
+                timings = {
+                    stage: time_stage(func, args.repeats)
+                    for stage, func in build_stages(cluster_dir, work_dir).items()
+                    if not args.stages or stage in args.stages
+                }
+                if args.end_to_end:
+                    timings["end_to_end"] = [time_end_to_end(cluster_dir, work_dir, args.end_to_end)]
+
+            for stage, stage_timings in timings.items():
+                record = dict(
+                    run_info,
+                    stage=stage,
+                    num_seqs=num_seqs,
+                    num_codons=args.num_codons,
+                    repeats=len(stage_timings),
+                    min_s=min(stage_timings),
+                    median_s=statistics.median(stage_timings),
+                    max_s=max(stage_timings),
+                )
+                records.append(record)
+                print(f"{stage:<22s}{num_seqs:>7d} seqs  median {record['median_s']:.4f} s")
+
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    args.results.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.results, "a") as fh:
+        for record in records:
+            fh.write(json.dumps(record) + "\n")
+
+    print(f"Appended {len(records)} timings to {args.results}")
+
+
+def compare_results(results_path, base=None, head=None, threshold=0.2):
+    """Compare the median timings of two versions and report regressions
+
+    Versions are matched by the start of the commit hash, or by label. By default the
+    latest run is compared to the run before it.
+
+    :param results_path: Path to JSONL results file
+    :param base: str, commit or label of the reference version
+    :param head: str, commit or label of the version to test
+    :param threshold: float, fractional slowdown reported as a regression
+
+    Return pandas df of regressions
+    """
+    results = pd.read_json(results_path, lines=True)
+    results["commit"] = results["commit"].fillna("unknown")
+    results["version"] = results["label"].fillna(results["commit"])
+
+    versions = results.drop_duplicates("timestamp", keep="last").sort_values("timestamp")["version"]
+    versions = list(dict.fromkeys(versions))  # keep order of first run
+
+    def select(version):
+        if version is None:
+            return None
+        matched = results[
+            (results["label"] == version) | results["commit"].str.startswith(version)
+        ]
+        if matched.empty:
+            print(f"No results for version {version} in {results_path}")
+            sys.exit(1)
+        return matched["version"].iloc[-1]
+
+    head = select(head) or versions[-1]
+    base = select(base) or (versions[-2] if len(versions) > 1 else None)
+    if base is None or base == head:
+        print("Need results for two versions to compare")
+        sys.exit(1)
+
+    # use the latest run of each stage for each version
+    latest = results.sort_values("timestamp").drop_duplicates(["version", "stage", "num_seqs"], keep="last")
+
+    comparison = pd.merge(
+        latest[latest["version"] == base][["stage", "num_seqs", "median_s"]],
+        latest[latest["version"] == head][["stage", "num_seqs", "median_s"]],
+        on=["stage", "num_seqs"],
+        suffixes=("_base", "_head"),
+    )
+    comparison["ratio"] = comparison["median_s_head"] / comparison["median_s_base"]
+    comparison["regression"] = comparison["ratio"] > 1 + threshold
+
+    print(f"Base: {base}\nHead: {head}\n")
+    print(comparison.sort_values(["stage", "num_seqs"]).to_string(index=False, float_format="%.4f"))
+
+    regressions = comparison[comparison["regression"]]
+    if not regressions.empty:
+        print(f"\n{len(regressions)} stage(s) slower by more than {threshold:.0%}")
+
+    return regressions
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="run_benchmarks.py",
+        description="Benchmark the positive selection screen on synthetic clusters",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    run_parser = subparsers.add_parser(
+        "run",
+        help="Time each stage and append the timings to the results file",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    run_parser.add_argument(
+        "--results",
+        type=Path,
+        default=BENCHMARK_DIR / "benchmark_results.jsonl",
+        help="Path to JSONL results file, timings are appended",
+    )
+    run_parser.add_argument(
+        "--num_seqs",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000],
+        help="Cluster sizes to benchmark, add 10000 for the largest scale",
+    )
+    run_parser.add_argument(
+        "--num_codons",
+        type=int,
+        default=400,
+        help="Alignment length in codons",
+    )
+    run_parser.add_argument(
+        "--num_bootstraps",
+        type=int,
+        default=100,
+        help="Number of RaxML-ng bootstrap trees",
+    )
+    run_parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="Random seed for the synthetic clusters",
+    )
+    run_parser.add_argument(
+        "--repeats",
+        type=int,
+        default=5,
+        help="Number of timed calls of each stage",
+    )
+    run_parser.add_argument(
+        "--stages",
+        nargs="+",
+        default=None,
+        help="Stages to time. Default: all",
+    )
+    run_parser.add_argument(
+        "--cluster_dir",
+        type=Path,
+        default=None,
+        help="Path to dir to write (or reuse) the synthetic clusters. Default: temporary dir",
+    )
+    run_parser.add_argument(
+        "--end_to_end",
+        type=int,
+        default=0,
+        help="Also time measure_selection.py for this number of proteins, using the CodeML stand-in",
+    )
+    run_parser.add_argument(
+        "--label",
+        type=str,
+        default=None,
+        help="Label for the run, used in place of the commit when comparing",
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare",
+        help="Compare the timings of two versions",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    compare_parser.add_argument(
+        "results",
+        type=Path,
+        help="Path to JSONL results file",
+    )
+    compare_parser.add_argument(
+        "--base",
+        type=str,
+        default=None,
+        help="Commit or label of the reference version. Default: version run before head",
+    )
+    compare_parser.add_argument(
+        "--head",
+        type=str,
+        default=None,
+        help="Commit or label of the version to test. Default: latest version run",
+    )
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Fractional slowdown reported as a regression",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
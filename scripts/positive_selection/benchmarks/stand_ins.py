@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Lightweight stand-ins for the external tools called by the positive selection screen.
+
+Each stand-in reads the same arguments as the real tool and writes output files of the
+same format, quickly, so the pipeline can be run end-to-end on synthetic clusters.
+"""
+
+
+import hashlib
+import os
+import sys
+import time
+
+import numpy as np
+
+from pathlib import Path
+
+from Bio import SeqIO
+from Bio.Data import CodonTable
+
+from synthetic_clusters import codeml_output, random_tree_template, raxml_bootstrap_files
+
+
+STAND_INS = ["mafft", "t_coffee", "ncfp", "modeltest-ng", "raxml-ng", "codeml"]
+
+# seconds to sleep in each stand-in, to mimic the run time of the real tool
+DELAY_ENV = "STAND_IN_DELAY"
+
+BACK_TRANSLATION = {}
+for _codon, _residue in CodonTable.unambiguous_dna_by_id[1].forward_table.items():
+    BACK_TRANSLATION.setdefault(_residue, _codon)
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in STAND_INS + ["install"]:
+        print(
+            "Usage: stand_ins.py install <bin dir>\n"
+            f"       stand_ins.py <tool> [tool args], where tool is one of {', '.join(STAND_INS)}"
+        )
+        sys.exit(1)
+
+    tool, tool_args = sys.argv[1], sys.argv[2:]
+
+    if tool == "install":
+        install(Path(tool_args[0]))
+        return
+
+    time.sleep(float(os.environ.get(DELAY_ENV, 0)))
+
+    STAND_IN_FUNCS[tool](tool_args)
+
+
+def install(bin_dir):
+    """Write an executable wrapper per stand-in, named after the real tool
+
+    Put bin_dir at the start of PATH to use the stand-ins in place of the real tools.
+
+    :param bin_dir: Path to dir to write the wrappers to
+
+    Return nothing
+    """
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    script = Path(__file__).resolve()
+
+    for tool in STAND_INS:
+        wrapper = bin_dir / tool
+        with open(wrapper, "w") as fh:
+            fh.write(f'#!/bin/sh\nexec "{sys.executable}" "{script}" {tool} "$@"\n')
+        wrapper.chmod(0o755)
+
+    print(f"Installed stand-ins for {', '.join(STAND_INS)} in {bin_dir}")
+
+
+def get_option(args, option, default=None):
+    """Get the value following an option in a list of cmd-line args"""
+    try:
+        return args[args.index(option) + 1]
+    except (ValueError, IndexError):
+        return default
+
+
+def seeded_rng(*values):
+    """Build a numpy Generator seeded from the given values, so reruns give the same output"""
+    digest = hashlib.blake2b("|".join(str(value) for value in values).encode(), digest_size=8)
+    return np.random.default_rng(int.from_bytes(digest.digest(), "little"))
+
+
+def read_names(msa_path):
+    """Read the seq names from a FASTA or phylip file"""
+    with open(msa_path, "r") as fh:
+        first_line = fh.readline()
+
+    if first_line.startswith(">"):
+        return [record.id for record in SeqIO.parse(msa_path, "fasta")]
+
+    with open(msa_path, "r") as fh:
+        lines = fh.read().splitlines()[1:]
+    return [line.split()[0] for line in lines if line.strip()]
+
+
+def mafft(args):
+    """Pad seqs to the same length, and write the 'alignment' to STDOUT
+
+    With --add and --keeplength the added seqs are padded or truncated to the length of the
+    existing alignment.
+    """
+    records = list(SeqIO.parse(args[-1], "fasta"))
+    length = max(len(record.seq) for record in records)
+
+    added = get_option(args, "--add")
+    if added is not None:
+        records += list(SeqIO.parse(added, "fasta"))
+
+    for record in records:
+        seq = str(record.seq)[:length]
+        sys.stdout.write(f">{record.id}\n{seq.ljust(length, '-')}\n")
+
+
+def t_coffee(args):
+    """Backthread CDSs onto aligned protein seqs, and write the codon alignment to STDOUT"""
+    cds_seqs = {record.id: str(record.seq) for record in SeqIO.parse(get_option(args, "-in"), "fasta")}
+
+    for record in SeqIO.parse(get_option(args, "-in2"), "fasta"):
+        cds = cds_seqs[record.id]
+        codons = []
+        position = 0
+        for residue in str(record.seq):
+            if residue == "-":
+                codons.append("---")
+            else:
+                codons.append(cds[position:position + 3])
+                position += 3
+        sys.stdout.write(f">{record.id}\n{''.join(codons)}\n")
+
+
+def ncfp(args):
+    """Back-translate the protein seqs, and write the CDSs to <output dir>/ncfp_nt.fasta"""
+    protein_path, output_dir = Path(args[0]), Path(args[1])
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    with open(output_dir / "ncfp_nt.fasta", "w") as fh:
+        for record in SeqIO.parse(protein_path, "fasta"):
+            cds = "".join(BACK_TRANSLATION.get(residue, "NNN") for residue in str(record.seq).replace("*", ""))
+            fh.write(f">{record.id}\n{cds}\n")
+
+
+def modeltest_ng(args):
+    """Write a modeltest-ng output file recommending the same model under each criterion"""
+    output_path = Path(get_option(args, "-o") + ".out")
+    msa_path = get_option(args, "-i")
+
+    lines = ["--------------------------------------------------------------------------------", ""]
+    for criterion in ("BIC", "AIC", "AICc"):
+        lines += [
+            f"Best model according to {criterion}",
+            "---------------------------",
+            "Model:              GTR+G4",
+            "Commands:",
+            f"  > raxml-ng --msa {msa_path} --model GTR+G4",
+            "",
+        ]
+
+    with open(output_path, "w") as fh:
+        fh.write("\n".join(lines))
+
+
+def raxml_ng(args):
+    """Write the RaxML-ng output files for --check, --parse, a tree search and --bootstrap"""
+    prefix = get_option(args, "--prefix")
+    msa_path = get_option(args, "--msa")
+    seed = get_option(args, "--seed", 0)
+
+    names = read_names(msa_path)
+    rng = seeded_rng(msa_path, seed)
+    tree_template = random_tree_template(len(names), rng)
+
+    num_bootstraps = int(get_option(args, "--bs-trees", 100)) if "--bootstrap" in args else 1
+    raxml_log, trees = raxml_bootstrap_files(names, tree_template, num_bootstraps, rng)
+
+    with open(f"{prefix}.raxml.log", "w") as fh:
+        fh.write(raxml_log)
+
+    if "--check" in args or "--parse" in args:
+        return
+
+    if "--bootstrap" in args:
+        with open(f"{prefix}.raxml.bootstraps", "w") as fh:
+            fh.write(trees)
+    else:
+        with open(f"{prefix}.raxml.bestTree", "w") as fh:
+            fh.write(trees)
+
+
+def codeml(args):
+    """Write a CodeML branch-site output file for the alt or null model set in the ctl file
+
+    The null model always has the lower log-likelihood.
+    """
+    ctl_path = Path(args[0]) if args else Path("codeml.ctl")
+
+    options = {}
+    with open(ctl_path, "r") as fh:
+        for line in fh:
+            line = line.split("*")[0]
+            if "=" in line:
+                key, value = line.split("=", 1)
+                options[key.strip()] = value.strip()
+
+    working_dir = ctl_path.parent
+    seq_path = working_dir / options["seqfile"]
+    alt = options.get("fix_omega", "0") == "0"
+
+    with open(seq_path, "r") as fh:
+        num_seqs, length = (int(value) for value in fh.readline().split()[:2])
+    names = read_names(seq_path)
+
+    rng = seeded_rng(seq_path.read_bytes())
+    tree_template = random_tree_template(num_seqs, rng)
+    lnl0 = -float(rng.uniform(1000, 1000 + 10 * num_seqs))
+    lnl = lnl0 + float(rng.exponential(2)) if alt else lnl0
+
+    ntime = 2 * num_seqs - 3
+    shape = np.empty((num_seqs, length // 3))
+    output = codeml_output(names, shape, tree_template, lnl, ntime + 4 + int(alt), alt=alt)
+
+    with open(working_dir / options["outfile"], "w") as fh:
+        fh.write(output)
+    with open(working_dir / "rst", "w") as fh:
+        fh.write(f"lnL = {lnl:.6f}\n")
+
+
+STAND_IN_FUNCS = {
+    "mafft": mafft,
+    "t_coffee": t_coffee,
+    "ncfp": ncfp,
+    "modeltest-ng": modeltest_ng,
+    "raxml-ng": raxml_ng,
+    "codeml": codeml,
+}
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Generate synthetic clusters, with the input and output files of each stage of the positive selection screen"""
+
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+
+BASES = "TCAG"
+CODONS = [a + b + c for a in BASES for b in BASES for c in BASES]
+SENSE_CODONS = np.array([codon for codon in CODONS if codon not in ("TAA", "TAG", "TGA")], dtype="S3")
+
+NG86_MAX_SEQS = 1000  # larger clusters are written without the pairwise NG86 matrix
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    for num_seqs in args.num_seqs:
+        cluster_dir = write_cluster(
+            args.output_dir, num_seqs, args.num_codons, args.num_bootstraps, args.seed,
+        )
+        print(f"Wrote synthetic cluster of {num_seqs} seqs to {cluster_dir}")
+
+
+def accession_names(num_seqs):
+    """Build GenBank-like accessions for synthetic proteins"""
+    return [f"SYN{index:07d}.1" for index in range(num_seqs)]
+
+
+def random_tree_template(num_leaves, rng):
+    """Build a random unrooted tree topology with branch lengths
+
+    Leaves are written as '{0}', '{1}' etc. so labels can be added with str.format.
+
+    :param num_leaves: int, number of leaves (at least 3)
+    :param rng: numpy Generator
+
+    Return str, Newick tree template
+    """
+    lengths = iter(rng.exponential(0.1, size=2 * num_leaves))
+    nodes = [f"{{{index}}}:{next(lengths):.6f}" for index in range(num_leaves)]
+
+    while len(nodes) > 3:
+        first, second = sorted(rng.choice(len(nodes), size=2, replace=False), reverse=True)
+        joined = f"({nodes.pop(first)},{nodes.pop(second)}):{next(lengths):.6f}"
+        nodes.append(joined)
+
+    return "(" + ",".join(nodes) + ");"
+
+
+def codon_alignment(num_seqs, num_codons, rng, mutation_rate=0.1, gap_rate=0.3):
+    """Build a codon alignment of sequences diverged from a common ancestor
+
+    No sequence contains a stop codon, and each sequence may contain one gapped block.
+
+    :param num_seqs: int
+    :param num_codons: int
+    :param rng: numpy Generator
+    :param mutation_rate: float, mean fraction of codons substituted per sequence
+    :param gap_rate: float, fraction of sequences containing a gapped block
+
+    Return numpy array of codons, sequences x codons
+    """
+    ancestor = rng.integers(len(SENSE_CODONS), size=num_codons)
+    codon_indices = np.tile(ancestor, (num_seqs, 1))
+
+    seq_rates = rng.uniform(0, 2 * mutation_rate, size=(num_seqs, 1))
+    mutated = rng.random((num_seqs, num_codons)) < seq_rates
+    codon_indices[mutated] = rng.integers(len(SENSE_CODONS), size=mutated.sum())
+
+    codons = SENSE_CODONS[codon_indices]
+
+    gapped_seqs = np.flatnonzero(rng.random(num_seqs) < gap_rate)
+    for seq_index in gapped_seqs:
+        start = rng.integers(num_codons)
+        length = rng.integers(1, max(2, num_codons // 20))
+        codons[seq_index, start:start + length] = b"---"
+
+    return codons
+
+
+def write_fasta(path, names, codons):
+    """Write an alignment of codons in FASTA format"""
+    with open(path, "w") as fh:
+        for name, row in zip(names, codons):
+            fh.write(f">{name}\n{b''.join(row).decode()}\n")
+
+
+def mmseqs_tsv(names, rng, mean_cluster_size=10):
+    """Build a MMseqs2 cluster tsv: representative and member, one row per member
+
+    :param names: list of accessions
+    :param rng: numpy Generator
+    :param mean_cluster_size: float
+
+    Return pandas df
+    """
+    num_clusters = max(1, len(names) // mean_cluster_size)
+    cluster_index = np.sort(rng.integers(num_clusters, size=len(names)))
+
+    members = pd.DataFrame({"cluster": cluster_index, "member": names})
+    members["representative"] = members.groupby("cluster")["member"].transform("first")
+
+    return members[["representative", "member"]]
+
+
+def raxml_bootstrap_files(names, tree_template, num_bootstraps, rng):
+    """Build the contents of a RaxML-ng bootstrap log and bootstraps file
+
+    :param names: list of accessions
+    :param tree_template: str, tree template from random_tree_template()
+    :param num_bootstraps: int
+    :param rng: numpy Generator
+
+    Return str of log, str of bootstrap trees
+    """
+    lnls = -rng.uniform(1000, 1000 + 10 * len(names), size=num_bootstraps)
+
+    log_lines = [
+        "RAxML-NG v. 1.1.0 released on 29.06.2022 by The Exelixis Lab.",
+        "",
+        f"Starting bootstrapping analysis with {num_bootstraps} replicates.",
+        "",
+    ]
+    trees = []
+
+    for tree_num, lnl in enumerate(lnls, start=1):
+        seconds = tree_num * 2
+        log_lines.append(
+            f"[{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}] "
+            f"[worker #{tree_num % 3}] Bootstrap tree #{tree_num}, logLikelihood: {lnl:.6f}"
+        )
+        trees.append(tree_template.format(*rng.permutation(names)))
+
+    return "\n".join(log_lines) + "\n", "\n".join(trees) + "\n"
+
+
+def codeml_output(names, codons, tree_template, lnl, num_params, alt=True):
+    """Build a CodeML branch-site model output file
+
+    :param names: list of accessions, the first is the foreground
+    :param codons: numpy array of codons, sequences x codons
+    :param tree_template: str, tree template from random_tree_template()
+    :param lnl: float, log-likelihood
+    :param num_params: int, number of parameters
+    :param alt: bool, write the alt model (True) or null model (False)
+
+    Return str
+    """
+    num_seqs, num_codons = codons.shape
+    ntime = 2 * num_seqs - 3
+
+    lines = [
+        "CODONML (in paml version 4.9, March 2015)  synthetic_msa.phylip",
+        "Model: several dN/dS ratios for branches for branches, ",
+        "Codon frequency model: F3x4",
+        "Site-class models:  PositiveSelection",
+        f"ns = {num_seqs:3d}  ls = {num_codons}",
+        "",
+    ]
+
+    if num_seqs <= NG86_MAX_SEQS:
+        lines += ["", "Nei & Gojobori 1986. dN/dS (dN, dS)", ""]
+        for row in range(num_seqs):
+            pairs = "".join(
+                f" {0.1 + (row * col) % 7 / 10:.4f} ({0.01 * (col % 9):.4f} {0.1 * (row % 5):.4f})"
+                for col in range(row)
+            )
+            lines.append(f"{names[row]:<20s}{pairs}")
+        lines.append("")
+
+    numbered_tree = tree_template.format(*range(1, num_seqs + 1))
+    named_tree = tree_template.format(*names)
+    w2 = "999.00000" if alt else "1.00000"
+
+    lines += [
+        "",
+        f"TREE #  1:  {numbered_tree}   MP score: {num_seqs * 10}",
+        f"lnL(ntime: {ntime}  np: {num_params}):  {lnl:.6f}      +0.000000",
+        "",
+        f"tree length =   {num_seqs * 0.1:.5f}",
+        "",
+        numbered_tree,
+        "",
+        named_tree,
+        "",
+        "Detailed output identifying parameters",
+        "",
+        "kappa (ts/tv) =  1.47416",
+        "",
+        "",
+        "MLEs of dN/dS (w) for site classes (K=4)",
+        "",
+        "site class             0        1       2a       2b",
+        "proportion       0.81889  0.16924  0.00983  0.00203",
+        "background w     0.08208  1.00000  0.08208  1.00000",
+        f"foreground w     0.08208  1.00000 {w2} {w2}",
+        "",
+    ]
+
+    if alt:
+        lines += [
+            "",
+            "Naive Empirical Bayes (NEB) analysis (please use the BEB results.)",
+            "Positive sites for foreground lineages Prob(w>1):",
+            "",
+            "   127 R 0.979*",
+            "   128 Y 1.000**",
+            "",
+            "Bayes Empirical Bayes (BEB) analysis (Yang, Wong & Nielsen 2005. Mol. Biol. Evol. 22:1107-1118)",
+            "Positive sites for foreground lineages Prob(w>1):",
+            "   127 R 0.686",
+            "   128 Y 0.997**",
+            "",
+            "",
+            "The grid (see ternary graph for p0-p1)",
+            "",
+        ]
+
+    lines += ["", "Time used:  3:45", ""]
+
+    return "\n".join(lines)
+
+
+def write_cluster(output_dir, num_seqs, num_codons=400, num_bootstraps=100, seed=1):
+    """Write the files of a synthetic cluster, named by its size
+
+    :param output_dir: Path to parent dir
+    :param num_seqs: int, number of sequences in the cluster
+    :param num_codons: int, alignment length in codons
+    :param num_bootstraps: int, number of RaxML-ng bootstrap trees
+    :param seed: int, random seed
+
+    Return Path to the cluster dir
+    """
+    rng = np.random.default_rng(seed + num_seqs)
+
+    cluster_dir = output_dir / f"synthetic_{num_seqs}"
+    cluster_dir.mkdir(parents=True, exist_ok=True)
+
+    names = accession_names(num_seqs)
+    codons = codon_alignment(num_seqs, num_codons, rng)
+    tree_template = random_tree_template(num_seqs, rng)
+
+    write_fasta(cluster_dir / "aligned_nts.fasta", names, codons)
+
+    with open(cluster_dir / "bestTree", "w") as fh:
+        fh.write(tree_template.format(*names) + "\n")
+
+    pd.DataFrame({"GenBank_Accession": names}).to_csv(cluster_dir / "cluster_data.csv", index=False)
+
+    mmseqs_tsv(names, rng).to_csv(
+        cluster_dir / "mmseqs_cluster.tsv", sep="\t", index=False, header=False,
+    )
+
+    raxml_log, bootstraps = raxml_bootstrap_files(names, tree_template, num_bootstraps, rng)
+    with open(cluster_dir / "04_bootstrap.raxml.log", "w") as fh:
+        fh.write(raxml_log)
+    with open(cluster_dir / "04_bootstrap.raxml.bootstraps", "w") as fh:
+        fh.write(bootstraps)
+
+    ntime = 2 * num_seqs - 3
+    lnl0 = -float(rng.uniform(1000, 1000 + 10 * num_seqs))
+    lnl1 = lnl0 + float(rng.exponential(2))
+
+    with open(cluster_dir / "alt_mdl_output", "w") as fh:
+        fh.write(codeml_output(names, codons, tree_template, lnl1, ntime + 5, alt=True))
+    with open(cluster_dir / "null_mdl_output", "w") as fh:
+        fh.write(codeml_output(names, codons, tree_template, lnl0, ntime + 4, alt=False))
+
+    return cluster_dir
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="synthetic_clusters.py",
+        description="Generate synthetic clusters for benchmarking",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "output_dir",
+        type=Path,
+        help="Path to dir to write the clusters to",
+    )
+    parser.add_argument(
+        "--num_seqs",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000],
+        help="Number of seqs in each cluster",
+    )
+    parser.add_argument(
+        "--num_codons",
+        type=int,
+        default=400,
+        help="Alignment length in codons",
+    )
+    parser.add_argument(
+        "--num_bootstraps",
+        type=int,
+        default=100,
+        help="Number of RaxML-ng bootstrap trees",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="Random seed",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -46,6 +46,8 @@
 # $3 email address
 # $4 Path to write out a summary tsv file
 # $5 Str 'dbcan' or 'all' or 'cazy' FASTA file of protein seqs to use for clusters
+# $6 Optional, str 'nj' to build a neighbour-joining tree in place of running modeltest-ng and
+#    RaxML-ng, for a fast first-pass screen. Default 'raxml'
 
 #
 # Get list of clusters of interest
@@ -57,8 +59,21 @@ echo "3: $3"
 echo "4: $4"
 echo "5: $5"
 
+TREE_METHOD=${6:-raxml}
+
 CLUSTERS=$(cat $1)
 
+# record the wall time, CPU time and peak memory of each stage and tool in a trace file
+# summarise with: python3 cluster_analysis/pipeline_trace.py summarise <trace file>
+export PIPELINE_TRACE=${PIPELINE_TRACE:-"$2/pipeline_trace.jsonl"}
+TRACE="python3 cluster_analysis/pipeline_trace.py run"
+
+# CDSs are retrieved from the local CDS index (scripts/genomes/build_cds_index.sh), ncfp is
+# only run for proteins not in the index. Exits if the index has not been built,
+# set ALLOW_NETWORK=1 to retrieve every CDS with ncfp instead
+CDS_INDEX=${CDS_INDEX:-"../../data/genomes/cds_index"}  # relative to scripts/positive_selection
+CDS_OPTS="--cds_index $CDS_INDEX${ALLOW_NETWORK:+ --allow_network}"
+
 for CLUSTER in $CLUSTERS
 do
     echo "--------Starting processing cluster $CLUSTER--------"
@@ -71,32 +86,16 @@ do
 
     echo "Protein seqs: $PROTEIN_SEQS"
 
+    export PIPELINE_CLUSTER=$CLUSTER
+    export PIPELINE_CLUSTER_SIZE=$(grep -c ">" $PROTEIN_SEQS)
+
     ALIGNED_PROTS="$CLUSTER_DIR/$CLUSTER-aligned_proteins.fasta"  # MSA of protein seqs
 
     echo "Protein alignment: $ALIGNED_PROTS"
 
-    # align proteins
+    CDS_DIR="$CLUSTER_DIR/$CLUSTER-cds"  # output dir for CDSs
 
-    mafft --thread 12 $PROTEIN_SEQS > $ALIGNED_PROTS 
-    
-    echo "---Aligned protein seqs---"
-
-    # get CDSs using ncfp
-    
-    CDS_DIR="$CLUSTER_DIR/$CLUSTER-cds"  # outpuit dir for ncfp
-
-    echo "Ncfp output dir: $CDS_DIR"
-    
-    ncfp \
-        $PROTEIN_SEQS \
-        $CDS_DIR \
-        $3 \
-        --use_protein_ids \
-        --drop_stop_codons
-
-    echo "---Retrieved CDSs---"
-
-    # backthread cds onto aligned proteins using t-coffee
+    echo "CDS dir: $CDS_DIR"
 
     NTS_FASTA="$CDS_DIR/ncfp_nt.fasta"
 
@@ -106,90 +105,152 @@ do
 
     echo "Nt alignemnt: $ALIGNED_NTS"
 
-    t_coffee -other_pg seq_reformat \
-        -in $NTS_FASTA \
-        -in2 $ALIGNED_PROTS \
-        -action +thread_dna_on_prot_aln \
-        -output fasta \
-        > $ALIGNED_NTS
+    if [ -f "$ALIGNED_PROTS" ] && [ -f "$ALIGNED_NTS" ]; then
+        # the cluster was aligned before, only add the new seqs to the existing alignments
+
+        python3 cluster_analysis/incremental_alignment.py \
+            $PROTEIN_SEQS \
+            $ALIGNED_PROTS \
+            $CDS_DIR \
+            $ALIGNED_NTS \
+            $3 \
+            $CDS_OPTS
+
+        echo "---Updated protein and nt alignments---"
+    else
+        # align proteins
+
+        $TRACE --stage align_proteins -- mafft --thread 12 $PROTEIN_SEQS > $ALIGNED_PROTS 
+
+        echo "---Aligned protein seqs---"
+
+        # get CDSs from the local CDS index, and using ncfp for misses
+
+        python3 cluster_analysis/get_local_cds.py \
+            $PROTEIN_SEQS \
+            $CDS_DIR \
+            $3 \
+            $CDS_OPTS
 
-    echo "---Backthreaded cds onto aligned proteins---"
+        echo "---Retrieved CDSs---"
+
+        # backthread cds onto aligned proteins using t-coffee
+
+        $TRACE --stage backthread -- t_coffee -other_pg seq_reformat \
+            -in $NTS_FASTA \
+            -in2 $ALIGNED_PROTS \
+            -action +thread_dna_on_prot_aln \
+            -output fasta \
+            > $ALIGNED_NTS
+
+        echo "---Backthreaded cds onto aligned proteins---"
+    fi
 
     # check backthread was ok
     if echo "$(cat $ALIGNED_NTS)" | grep -q -- "-M-"; then     echo "Incorrect backthread: $CLUSTER"; continue; fi
 
-    # run modeltest to get the best model
+    # collapse identical seqs, only representatives are used to build the tree and run CodeML
 
-    MODELTEST_OUT="$CLUSTER_DIR/modeltest_output"
+    ALL_ALIGNED_NTS=$ALIGNED_NTS
+    ALIGNED_NTS="$CLUSTER_DIR/$CLUSTER-aligned_nts_dedup.fasta"
+    MEMBER_MAP="$CLUSTER_DIR/$CLUSTER-member_map.tsv"
+
+    python3 cluster_analysis/dedup_alignment.py \
+        $ALL_ALIGNED_NTS \
+        $ALIGNED_NTS \
+        $MEMBER_MAP
+
+    echo "Deduplicated nt alignment: $ALIGNED_NTS"
+
+    # report gap/ambiguity fractions, internal stops and frame errors in the codon alignment
+    # add --filtered_output and --position_map (and thresholds) to remove poor seqs and columns
+
+    python3 cluster_analysis/codon_qc.py \
+        $ALIGNED_NTS \
+        "$CLUSTER_DIR/$CLUSTER-codon_qc"
+
+    BEST_TREE_FILE="$CLUSTER_DIR/bestTree"
+
+    if [ "$TREE_METHOD" = "nj" ]; then
+        # build a neighbour-joining tree from K80 distances, in place of modeltest-ng and RaxML-ng
+
+        python3 cluster_analysis/nj_tree.py \
+            $ALIGNED_NTS \
+            $BEST_TREE_FILE
+
+    else
+        # run modeltest to get the best model
+
+        MODELTEST_OUT="$CLUSTER_DIR/modeltest_output"
     
-    echo "modeltest output: $MODELTEST_OUT"
+        echo "modeltest output: $MODELTEST_OUT"
 
-    modeltest-ng -i $ALIGNED_NTS -d nt -o $MODELTEST_OUT
+        $TRACE --stage modeltest -- modeltest-ng -i $ALIGNED_NTS -d nt -o $MODELTEST_OUT
 
-    # get best model from modeltest output
+        # get best model from modeltest output
 
-    MODELTEST_LOG="$MODELTEST_OUT.out"
-    BEST_MODEL_FILE="$CLUSTER_DIR/bestmodel.txt"
+        MODELTEST_LOG="$MODELTEST_OUT.out"
+        BEST_MODEL_FILE="$CLUSTER_DIR/bestmodel.txt"
 
-    python3 cluster_analysis/get_model.py \
-        $MODELTEST_LOG \
-        $BEST_MODEL_FILE
+        python3 cluster_analysis/get_model.py \
+            $MODELTEST_LOG \
+            $BEST_MODEL_FILE
     
-    BEST_MODEL=$(cat $BEST_MODEL_FILE)
+        BEST_MODEL=$(cat $BEST_MODEL_FILE)
 
-    echo "Best model: $BEST_MODEL"
+        echo "Best model: $BEST_MODEL"
 
-    # build tree using raxml-ng and bootstrap tree
+        # build tree using raxml-ng and bootstrap tree
 
-    echo "---Building tree---"
+        echo "---Building tree---"
 
-    TREE_DIR="$CLUSTER_DIR/tree"
+        TREE_DIR="$CLUSTER_DIR/tree"
 
-    mkdir $TREE_DIR
+        mkdir $TREE_DIR
     
-    echo "Tree dir: $TREE_DIR"
+        echo "Tree dir: $TREE_DIR"
 
-    echo "RaxML-ng Check"
+        echo "RaxML-ng Check"
 
-    raxml-ng --check \
-    --msa $ALIGNED_NTS \
-    --model $BEST_MODEL \
-    --prefix $TREE_DIR/01_check
+        $TRACE --stage raxml_check -- raxml-ng --check \
+        --msa $ALIGNED_NTS \
+        --model $BEST_MODEL \
+        --prefix $TREE_DIR/01_check
 
-    echo "RaxML-ng Parse"
+        echo "RaxML-ng Parse"
 
-    raxml-ng --parse \
-    --msa $ALIGNED_NTS \
-    --model $BEST_MODEL \
-    --prefix $TREE_DIR/02_parse
+        $TRACE --stage raxml_parse -- raxml-ng --parse \
+        --msa $ALIGNED_NTS \
+        --model $BEST_MODEL \
+        --prefix $TREE_DIR/02_parse
 
-    echo "RaxML-ng Build"
+        echo "RaxML-ng Build"
 
-    raxml-ng \
-    --msa $ALIGNED_NTS \
-    --model $BEST_MODEL \
-    --threads 3 \
-    --seed 38745 \
-    --prefix $TREE_DIR/03_infer
+        $TRACE --stage raxml_infer -- raxml-ng \
+        --msa $ALIGNED_NTS \
+        --model $BEST_MODEL \
+        --threads 3 \
+        --seed 38745 \
+        --prefix $TREE_DIR/03_infer
 
-    echo "RaxML-ng Bootstrap"
+        echo "RaxML-ng Bootstrap"
 
-    raxml-ng --bootstrap \
-    --msa $ALIGNED_NTS \
-    --model $BEST_MODEL \
-    --threads 3 \
-    --seed 38745 \
-    --bs-trees 100 \
-    --prefix $TREE_DIR/04_bootstrap
+        # replicates are run as seed-shards spread over the available cores, then merged
+        python3 cluster_analysis/raxml_bootstrap.py \
+        --msa $ALIGNED_NTS \
+        --model $BEST_MODEL \
+        --threads 3 \
+        --seed 38745 \
+        --bs-trees 100 \
+        --prefix $TREE_DIR/04_bootstrap
 
-    # get best tree
-
-    BEST_TREE_FILE="$CLUSTER_DIR/bestTree"
+        # get best tree
 
-    python3 cluster_analysis/get_best_tree.py \
-        $TREE_DIR/04_bootstrap.raxml.log \
-        $TREE_DIR/04_bootstrap.raxml.bootstraps \
-        $BEST_TREE_FILE
+        python3 cluster_analysis/get_best_tree.py \
+            $TREE_DIR/04_bootstrap.raxml.log \
+            $TREE_DIR/04_bootstrap.raxml.bootstraps \
+            $BEST_TREE_FILE
+    fi
 
     BEST_TREE=$(cat $BEST_TREE_FILE)
 
@@ -205,6 +266,7 @@ do
         $BEST_TREE_FILE \
         $ALIGNED_NTS \
         cluster_analysis/codeml_ctl.ctl \
+        --member_map $MEMBER_MAP \
         --summary_df $4
 
 done
@@ -69,3 +69,7 @@ do
         --summary_df $3
 
 done
+
+# correct for multiple testing across all screened proteins and within each cluster
+
+python3 cluster_analysis/correct_multiple_testing.py $3
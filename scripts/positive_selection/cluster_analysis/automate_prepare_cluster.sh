@@ -59,6 +59,17 @@ echo "5: $5"
 
 CLUSTERS=$(cat $1)
 
+# record the wall time, CPU time and peak memory of each stage and tool in a trace file
+# summarise with: python3 cluster_analysis/pipeline_trace.py summarise <trace file>
+export PIPELINE_TRACE=${PIPELINE_TRACE:-"$2/pipeline_trace.jsonl"}
+TRACE="python3 cluster_analysis/pipeline_trace.py run"
+
+# CDSs are retrieved from the local CDS index (scripts/genomes/build_cds_index.sh), ncfp is
+# only run for proteins not in the index. Exits if the index has not been built,
+# set ALLOW_NETWORK=1 to retrieve every CDS with ncfp instead
+CDS_INDEX=${CDS_INDEX:-"../../data/genomes/cds_index"}  # relative to scripts/positive_selection
+CDS_OPTS="--cds_index $CDS_INDEX${ALLOW_NETWORK:+ --allow_network}"
+
 for CLUSTER in $CLUSTERS
 do
     echo "--------Starting processing cluster $CLUSTER--------"
@@ -71,32 +82,16 @@ do
 
     echo "Protein seqs: $PROTEIN_SEQS"
 
+    export PIPELINE_CLUSTER=$CLUSTER
+    export PIPELINE_CLUSTER_SIZE=$(grep -c ">" $PROTEIN_SEQS)
+
     ALIGNED_PROTS="$CLUSTER_DIR/$CLUSTER-aligned_proteins.fasta"  # MSA of protein seqs
 
     echo "Protein alignment: $ALIGNED_PROTS"
 
-    # align proteins
-
-    mafft --thread 12 $PROTEIN_SEQS > $ALIGNED_PROTS 
-    
-    echo "---Aligned protein seqs---"
-
-    # get CDSs using ncfp
-    
-    CDS_DIR="$CLUSTER_DIR/$CLUSTER-cds"  # outpuit dir for ncfp
-
-    echo "Ncfp output dir: $CDS_DIR"
-    
-    ncfp \
-        $PROTEIN_SEQS \
-        $CDS_DIR \
-        $3 \
-        --use_protein_ids \
-        --drop_stop_codons
-
-    echo "---Retrieved CDSs---"
+    CDS_DIR="$CLUSTER_DIR/$CLUSTER-cds"  # output dir for CDSs
 
-    # backthread cds onto aligned proteins using t-coffee
+    echo "CDS dir: $CDS_DIR"
 
     NTS_FASTA="$CDS_DIR/ncfp_nt.fasta"
 
@@ -106,14 +101,46 @@ do
 
     echo "Nt alignemnt: $ALIGNED_NTS"
 
-    t_coffee -other_pg seq_reformat \
-        -in $NTS_FASTA \
-        -in2 $ALIGNED_PROTS \
-        -action +thread_dna_on_prot_aln \
-        -output fasta \
-        > $ALIGNED_NTS
+    if [ -f "$ALIGNED_PROTS" ] && [ -f "$ALIGNED_NTS" ]; then
+        # the cluster was aligned before, only add the new seqs to the existing alignments
+
+        python3 cluster_analysis/incremental_alignment.py \
+            $PROTEIN_SEQS \
+            $ALIGNED_PROTS \
+            $CDS_DIR \
+            $ALIGNED_NTS \
+            $3 \
+            $CDS_OPTS
+
+        echo "---Updated protein and nt alignments---"
+    else
+        # align proteins
+
+        $TRACE --stage align_proteins -- mafft --thread 12 $PROTEIN_SEQS > $ALIGNED_PROTS 
+
+        echo "---Aligned protein seqs---"
+
+        # get CDSs from the local CDS index, and using ncfp for misses
+
+        python3 cluster_analysis/get_local_cds.py \
+            $PROTEIN_SEQS \
+            $CDS_DIR \
+            $3 \
+            $CDS_OPTS
+
+        echo "---Retrieved CDSs---"
+
+        # backthread cds onto aligned proteins using t-coffee
+
+        $TRACE --stage backthread -- t_coffee -other_pg seq_reformat \
+            -in $NTS_FASTA \
+            -in2 $ALIGNED_PROTS \
+            -action +thread_dna_on_prot_aln \
+            -output fasta \
+            > $ALIGNED_NTS
 
-    echo "---Backthreaded cds onto aligned proteins---"
+        echo "---Backthreaded cds onto aligned proteins---"
+    fi
 
     # check backthread was ok
     if echo "$(cat $ALIGNED_NTS)" | grep -q -- "-M-"; then     echo "Incorrect backthread: $CLUSTER"; continue; fi
@@ -124,7 +151,7 @@ do
     
     echo "modeltest output: $MODELTEST_OUT"
 
-    modeltest-ng -i $ALIGNED_NTS -d nt -o $MODELTEST_OUT
+    $TRACE --stage modeltest -- modeltest-ng -i $ALIGNED_NTS -d nt -o $MODELTEST_OUT
 
     # get best model from modeltest output
 
@@ -151,21 +178,21 @@ do
 
     echo "RaxML-ng Check"
 
-    raxml-ng --check \
+    $TRACE --stage raxml_check -- raxml-ng --check \
     --msa $ALIGNED_NTS \
     --model $BEST_MODEL \
     --prefix $TREE_DIR/01_check
 
     echo "RaxML-ng Parse"
 
-    raxml-ng --parse \
+    $TRACE --stage raxml_parse -- raxml-ng --parse \
     --msa $ALIGNED_NTS \
     --model $BEST_MODEL \
     --prefix $TREE_DIR/02_parse
 
     echo "RaxML-ng Build"
 
-    raxml-ng \
+    $TRACE --stage raxml_infer -- raxml-ng \
     --msa $ALIGNED_NTS \
     --model $BEST_MODEL \
     --threads 3 \
@@ -174,7 +201,8 @@ do
 
     echo "RaxML-ng Bootstrap"
 
-    raxml-ng --bootstrap \
+    # replicates are run as seed-shards spread over the available cores, then merged
+    python3 cluster_analysis/raxml_bootstrap.py \
     --msa $ALIGNED_NTS \
     --model $BEST_MODEL \
     --threads 3 \
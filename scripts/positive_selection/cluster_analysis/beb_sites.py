@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Parse NEB/BEB positively selected sites from CodeML output and store them in a columnar site-level table"""
+
+
+import argparse
+import re
+
+import pandas as pd
+
+from pathlib import Path
+
+from pipeline_trace import trace_stage
+
+
+SITE_COLUMNS = ["accession", "method", "site", "residue", "prob_w_gt_1", "post_mean_w", "post_mean_w_se"]
+SITES_FILE = "sites.parquet"
+
+# e.g. '   128 Y 0.997**' or '   128 Y 0.997**  4.512 +- 1.234'
+SITE_REGEX = re.compile(
+    r"^\s*(\d+)\s+(\S)\s+(\d*\.\d+)\**(?:\s+(-?\d*\.\d+)\s+\+-\s+(\d*\.\d+))?\s*$"
+)
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    sites_df = query_sites(
+        args.sites_store,
+        accessions=args.accessions,
+        clusters=args.clusters,
+        method=args.method,
+        min_prob=args.min_prob,
+    )
+
+    if args.output is None:
+        print(sites_df.to_string(index=False))
+    else:
+        sites_df.to_csv(args.output, sep="\t", index=False)
+        print(f"Wrote {len(sites_df)} sites to {args.output}")
+
+
+def parse_site_tables(output_path, accession):
+    """Parse the NEB and BEB tables of positively selected sites from a CodeML output file
+
+    The file is read line by line, and only the lines in the site tables are parsed.
+
+    :param output_path: path to CodeML output file for the alternative model
+    :param accession: str, GenBank accession of the protein of interest
+
+    Return list of tuples, one per site, with the values for SITE_COLUMNS
+    """
+    sites = []
+    method = None
+
+    with open(output_path, "r") as fh:
+        for line in fh:
+            if line.startswith("Naive Empirical Bayes (NEB)"):
+                method = "NEB"
+                continue
+            if line.startswith("Bayes Empirical Bayes (BEB)"):
+                method = "BEB"
+                continue
+            if method is None:
+                continue
+
+            match = SITE_REGEX.match(line)
+            if match is not None:
+                site, residue, prob, post_mean, post_mean_se = match.groups()
+                sites.append((
+                    accession,
+                    method,
+                    int(site),
+                    residue,
+                    float(prob),
+                    float(post_mean) if post_mean is not None else None,
+                    float(post_mean_se) if post_mean_se is not None else None,
+                ))
+
+            elif line.startswith("The grid") or line.startswith("Time used"):
+                method = None  # end of the site tables
+
+    return sites
+
+
+def write_sites(sites, sites_store, cluster):
+    """Write the sites for a cluster to the site-level store
+
+    The store is a dir of Parquet files partitioned by cluster (cluster=<name>/sites.parquet),
+    so rerunning a cluster replaces only its own partition.
+
+    :param sites: list of tuples, one per site, with the values for SITE_COLUMNS
+    :param sites_store: Path to dir containing the site-level store
+    :param cluster: str, name of the cluster
+
+    Return nothing
+    """
+    partition_dir = sites_store / f"cluster={cluster}"
+    partition_dir.mkdir(exist_ok=True, parents=True)
+
+    sites_df = pd.DataFrame(sites, columns=SITE_COLUMNS)
+    sites_df = sites_df.astype({
+        "accession": "category",
+        "method": "category",
+        "site": "int32",
+        "residue": "category",
+        "prob_w_gt_1": "float32",
+        "post_mean_w": "float32",
+        "post_mean_w_se": "float32",
+    })
+
+    temp_path = partition_dir / (SITES_FILE + ".tmp")
+    sites_df.to_parquet(temp_path, index=False)
+    temp_path.replace(partition_dir / SITES_FILE)
+
+
+def query_sites(sites_store, accessions=None, clusters=None, method="BEB", min_prob=0.0):
+    """Load sites from the site-level store, filtering while reading
+
+    :param sites_store: Path to dir containing the site-level store
+    :param accessions: list of GenBank accessions to retrieve, or None for all
+    :param clusters: list of clusters to retrieve, or None for all
+    :param method: str, 'BEB' or 'NEB', or None for both
+    :param min_prob: float, minimum posterior probability of w > 1
+
+    Return pandas df
+    """
+    filters = [("prob_w_gt_1", ">=", min_prob)]
+    if method is not None:
+        filters.append(("method", "==", method))
+    if accessions:
+        filters.append(("accession", "in", list(accessions)))
+    if clusters:
+        filters.append(("cluster", "in", list(clusters)))
+
+    sites_df = pd.read_parquet(sites_store, filters=filters)
+
+    return sites_df.sort_values(["cluster", "accession", "method", "site"], ignore_index=True)
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="beb_sites.py",
+        description="Query the positively selected sites across all clusters",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "sites_store",
+        type=Path,
+        help="Path to the site-level store written by get_codeml_results.py or measure_selection.py",
+    )
+    parser.add_argument(
+        "--accessions",
+        nargs="+",
+        default=None,
+        help="GenBank accessions of the proteins to retrieve sites for",
+    )
+    parser.add_argument(
+        "--clusters",
+        nargs="+",
+        default=None,
+        help="Clusters to retrieve sites for",
+    )
+    parser.add_argument(
+        "--method",
+        choices=["BEB", "NEB"],
+        default="BEB",
+        help="Empirical Bayes method",
+    )
+    parser.add_argument(
+        "--min_prob",
+        type=float,
+        default=0.0,
+        help="Minimum posterior probability of w > 1",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=None,
+        help="Path to write out a tsv file of sites. Default: print to the terminal",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    with trace_stage("beb_sites"):
+        main()
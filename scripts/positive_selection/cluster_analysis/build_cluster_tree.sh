@@ -73,7 +73,7 @@ raxml-ng \
   --prefix $2/03_infer
 
 echo "------------------BOOTSTRAP------------------"
-raxml-ng --bootstrap \
+python3 cluster_analysis/raxml_bootstrap.py \
   --msa $1 \
   --model $3 \
   --threads 3 \
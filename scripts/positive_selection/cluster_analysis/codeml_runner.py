@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Run CodeML under supervision, with time limits, stall detection and restarts from alternative starting values"""
+
+
+import os
+import re
+import resource
+import select
+import shutil
+import signal
+import subprocess
+import time
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ctl_template import derive_options, write_ctl
+from pipeline_trace import record_tool
+
+
+# alternative initial (omega, kappa) values used when restarting a model
+START_VALUES = [(0.5, 1.0), (1.5, 4.0), (4.0, 2.0), (1.0, 0.5), (8.0, 3.0), (0.2, 6.0)]
+
+# files written by CodeML while it is optimising the likelihood
+PROGRESS_FILES = ["rub", "lnf", "rst", "rst1"]
+
+POLL_INTERVAL = 2  # max seconds between checks on a running CodeML process
+FIRST_POLL_INTERVAL = 0.01  # seconds before the first check, doubled after each check up to POLL_INTERVAL
+
+LNL_PATTERN = re.compile(r"^lnL\(ntime:\s*\d+\s+np:\s*\d+\):\s*(-?\d+\.\d+)", re.MULTILINE)
+
+# a CodeML run: the dir it is run in, its input and output paths, and its ctl options
+CodemlJob = namedtuple("CodemlJob", ["working_dir", "alignment", "tree", "out_file", "options"])
+
+
+def run_model(job, ctl_file, args):
+    """Run a CodeML model, restarting it from alternative starting values if the run fails
+
+    :param job: CodemlJob, configured for the model
+    :param ctl_file: Path to write the control file to, in the working dir of the model
+    :param args: cmd-line args parser, with the limits and number of restarts
+
+    Return dict of the best attempt, and list of dicts of all attempts
+    """
+    write_job_ctl(job, ctl_file)
+
+    first_attempt = run_codeml(
+        job.working_dir,
+        ctl_file,
+        job.out_file,
+        args.wall_limit,
+        args.cpu_limit,
+        args.stall_limit,
+        args.codeml,
+    )
+    first_attempt.update({
+        "attempt": 0,
+        "omega": float(job.options["omega"]),
+        "kappa": float(job.options["kappa"]),
+    })
+
+    if args.verbose:
+        print("CodeML attempt:", first_attempt)
+
+    if first_attempt["status"] == "ok":
+        return first_attempt, [first_attempt]
+
+    print(
+        "CodeML run {} ({}), restarting from alternative starting values".format(
+            first_attempt["status"], job.out_file,
+        )
+    )
+
+    best_attempt, attempts = restart_model(job, args)
+
+    return best_attempt, [first_attempt] + attempts
+
+
+def restart_model(job, args, current_lnl=None, first_attempt=1):
+    """Rerun a model in parallel from alternative starting values, and keep the best likelihood
+
+    :param job: CodemlJob, configured for the model
+    :param args: cmd-line args parser, with the limits and number of restarts
+    :param current_lnl: float, lnL of the existing output, or None
+    :param first_attempt: int, number given to the first of these attempts
+
+    Return dict of the best attempt (None if no run improved the lnL), and list of dicts of all attempts
+    """
+    start_values = get_start_values(job, args.max_restarts)
+
+    return run_from_start_values(job, start_values, args, current_lnl, first_attempt)
+
+
+def multi_start_model(job, args):
+    """Run a model from several initial omega (and kappa) values at once, and keep the best likelihood
+
+    The template starting values are used for the first run. When omega is fixed (null model)
+    only the initial kappa differs between the runs.
+
+    :param job: CodemlJob, configured for the model
+    :param args: cmd-line args parser, with the number of starts
+
+    Return dict of the best attempt (None if no run completed), list of dicts of all attempts,
+        and the spread (max - min) of the lnL across the completed runs
+    """
+    template_values = (float(job.options["omega"]), float(job.options["kappa"]))
+    start_values = [template_values] + [
+        values for values in get_start_values(job, args.multi_start) if values != template_values
+    ]
+    start_values = start_values[:args.multi_start]
+
+    best_attempt, attempts = run_from_start_values(job, start_values, args, first_attempt=0)
+
+    lnls = [attempt["lnl"] for attempt in attempts if attempt["status"] == "ok"]
+    spread = max(lnls) - min(lnls) if len(lnls) != 0 else None
+
+    return best_attempt, attempts, spread
+
+
+def get_start_values(job, num_values):
+    """Build the list of alternative initial (omega, kappa) values for a model
+
+    :param job: CodemlJob, configured for the model
+    :param num_values: int, max number of values to return
+
+    Return list of tuples
+    """
+    omega_fixed = job.options.get("fix_omega") == "1"
+
+    start_values = []
+    for omega, kappa in START_VALUES:
+        if omega_fixed:  # only kappa can be varied
+            omega = float(job.options["omega"])
+        if (omega, kappa) not in start_values:
+            start_values.append((omega, kappa))
+
+    return start_values[:num_values]
+
+
+def run_from_start_values(job, start_values, args, current_lnl=None, first_attempt=1):
+    """Run a model from each set of starting values in parallel, and keep the best likelihood
+
+    Each run is performed in its own working dir. The output of the run with the greatest lnL
+    replaces the output file of the model if its lnL is greater than current_lnl.
+
+    :param job: CodemlJob, configured for the model
+    :param start_values: list of (omega, kappa) tuples
+    :param args: cmd-line args parser, with the limits and number of parallel runs
+    :param current_lnl: float, lnL of the existing output, or None
+    :param first_attempt: int, number given to the first of these attempts
+
+    Return dict of the best attempt (None if no run improved the lnL), and list of dicts of all attempts
+    """
+    out_file = job.out_file
+    model_dir = os.path.dirname(os.path.abspath(out_file))
+    out_name = os.path.basename(out_file)
+
+    jobs = {}
+    for attempt_num, (omega, kappa) in enumerate(start_values, start=first_attempt):
+        attempt_dir = os.path.join(model_dir, "{}_attempt_{}".format(out_name, attempt_num))
+        os.makedirs(attempt_dir, exist_ok=True)
+
+        attempt_job = job._replace(
+            working_dir=attempt_dir,
+            out_file=os.path.join(attempt_dir, out_name),
+            options=derive_options(job.options, omega=omega, kappa=kappa),
+        )
+        write_job_ctl(attempt_job, os.path.join(attempt_dir, "codeml.ctl"))
+
+        jobs[attempt_num] = (attempt_job, omega, kappa)
+
+    attempts = []
+
+    with ProcessPoolExecutor(max_workers=args.restart_workers) as executor:
+        futures = {
+            executor.submit(
+                run_codeml,
+                attempt_job.working_dir,
+                os.path.join(attempt_job.working_dir, "codeml.ctl"),
+                attempt_job.out_file,
+                args.wall_limit,
+                args.cpu_limit,
+                args.stall_limit,
+                args.codeml,
+            ): attempt_num
+            for attempt_num, (attempt_job, omega, kappa) in jobs.items()
+        }
+        for future in as_completed(futures):
+            attempt_num = futures[future]
+            attempt = future.result()
+            attempt.update({
+                "attempt": attempt_num,
+                "omega": jobs[attempt_num][1],
+                "kappa": jobs[attempt_num][2],
+            })
+            attempts.append(attempt)
+
+            if args.verbose:
+                print("CodeML attempt:", attempt)
+
+    attempts.sort(key=lambda attempt: attempt["attempt"])
+
+    completed = [attempt for attempt in attempts if attempt["status"] == "ok"]
+    best_attempt = max(completed, key=lambda attempt: attempt["lnl"], default=None)
+
+    if best_attempt is not None and (current_lnl is None or best_attempt["lnl"] > current_lnl):
+        best_dir = jobs[best_attempt["attempt"]][0].working_dir
+        shutil.copyfile(os.path.join(best_dir, out_name), out_file)
+        for file_name in ["rst", "rst1"]:
+            if os.path.exists(os.path.join(best_dir, file_name)):
+                shutil.copyfile(os.path.join(best_dir, file_name), os.path.join(model_dir, file_name))
+        print("Kept attempt {} (lnL {})".format(best_attempt["attempt"], best_attempt["lnl"]))
+
+    elif best_attempt is not None:
+        best_attempt = None  # the existing output has the greatest lnL
+
+    for attempt_job, omega, kappa in jobs.values():
+        shutil.rmtree(attempt_job.working_dir, ignore_errors=True)
+
+    return best_attempt, attempts
+
+
+def write_job_ctl(job, ctl_file):
+    """Render the control file of a job, with the file paths relative to its working dir
+
+    :param job: CodemlJob
+    :param ctl_file: path to write the control file to
+
+    Return nothing
+    """
+    write_ctl(job.options, ctl_file, job.working_dir, job.alignment, job.tree, job.out_file)
+
+
+def open_pidfd(pid):
+    """Open a file descriptor that becomes readable when a child process exits
+
+    :param pid: int, ID of the child process
+
+    Return int, or None where pidfds are not supported (e.g. not Linux)
+    """
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def run_codeml(working_dir, ctl_file, out_file, wall_limit=None, cpu_limit=None, stall_limit=None, command="codeml"):
+    """Run CodeML and kill it if it exceeds the wall-clock or CPU limit, or stops making progress
+
+    CodeML is considered stalled when none of its output or optimisation files (rub, lnf, rst)
+    and its log have been written to for stall_limit seconds.
+
+    :param working_dir: str or Path, dir to run CodeML in
+    :param ctl_file: str or Path, path to control file
+    :param out_file: str or Path, path to the CodeML output file named in the control file
+    :param wall_limit: int, max wall-clock time in seconds, or None
+    :param cpu_limit: int, max CPU time in seconds, or None
+    :param stall_limit: int, max seconds without any file being written, or None
+    :param command: str, CodeML executable
+
+    Return dict of status ('ok', 'wall_limit', 'cpu_limit', 'stalled', 'failed', 'no_lnl'),
+        return code, wall time, CPU time and lnL
+    """
+    working_dir = str(working_dir)
+    log_path = os.path.join(working_dir, "{}.log".format(os.path.basename(str(out_file))))
+
+    def set_cpu_limit():
+        if cpu_limit is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, (int(cpu_limit), int(cpu_limit) + 5))
+
+    start = time.monotonic()
+    status = None
+
+    with open(log_path, "w") as log_fh:
+        proc = subprocess.Popen(
+            [command, os.path.abspath(str(ctl_file))],
+            cwd=working_dir,
+            stdin=subprocess.DEVNULL,  # CodeML waits for a key press on some errors
+            stdout=log_fh,
+            stderr=subprocess.STDOUT,
+            preexec_fn=set_cpu_limit,
+        )
+
+        watched = [os.path.join(working_dir, name) for name in PROGRESS_FILES]
+        watched += [str(out_file), log_path]
+
+        # block until CodeML exits, waking every POLL_INTERVAL to check the limits. Without a
+        # pidfd, poll from FIRST_POLL_INTERVAL, backing off to POLL_INTERVAL, so short runs are
+        # not held up. The process is reaped with os.wait4 to collect its resource use
+        pidfd = open_pidfd(proc.pid)
+        poll_interval = FIRST_POLL_INTERVAL
+
+        while True:
+            pid, wait_status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid != 0:
+                break
+
+            if pidfd is not None:
+                select.select([pidfd], [], [], POLL_INTERVAL)
+            else:
+                time.sleep(poll_interval)
+                poll_interval = min(poll_interval * 2, POLL_INTERVAL)
+            now = time.monotonic()
+
+            if wall_limit is not None and now - start > wall_limit:
+                status = "wall_limit"
+
+            elif stall_limit is not None and now - start > stall_limit:
+                last_progress = max(
+                    (os.path.getmtime(path) for path in watched if os.path.exists(path)),
+                    default=None,
+                )
+                if last_progress is None or time.time() - last_progress > stall_limit:
+                    status = "stalled"
+
+            if status is not None:
+                proc.kill()
+                pid, wait_status, rusage = os.wait4(proc.pid, 0)
+                break
+
+        if pidfd is not None:
+            os.close(pidfd)
+
+    returncode = os.waitstatus_to_exitcode(wait_status)
+    proc.returncode = returncode  # the process was reaped by os.wait4
+
+    lnl = read_lnl(out_file)
+
+    record_tool(
+        os.path.basename(command),
+        "codeml_run",
+        time.monotonic() - start,
+        rusage,
+        returncode,
+        out_file=os.path.basename(str(out_file)),
+    )
+
+    if status is None:
+        if cpu_limit is not None and returncode in (-signal.SIGXCPU, -signal.SIGKILL):
+            status = "cpu_limit"
+        elif returncode != 0:
+            status = "failed"
+        elif lnl is None:
+            status = "no_lnl"
+        else:
+            status = "ok"
+
+    return {
+        "status": status,
+        "returncode": returncode,
+        "wall_time": round(time.monotonic() - start, 3),
+        "cpu_time": round(rusage.ru_utime + rusage.ru_stime, 3),
+        "lnl": lnl,
+    }
+
+
+def read_lnl(out_file):
+    """Retrieve the log-likelihood from a CodeML output file
+
+    :param out_file: path to CodeML output file
+
+    Return float, or None if the file or lnL line is missing
+    """
+    try:
+        with open(out_file, "r") as fh:
+            match = LNL_PATTERN.search(fh.read())
+    except FileNotFoundError:
+        return None
+
+    if match is None:
+        return None
+
+    return float(match.group(1))
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Check the quality of a codon alignment, and optionally remove poor sequences and codon columns"""
+
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from pipeline_trace import trace_stage
+
+
+GAP = ord("-")
+NUCLEOTIDES = np.frombuffer(b"ACGT", dtype=np.uint8)
+STOP_CODONS = ["TAA", "TAG", "TGA"]
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    seq_ids, matrix = read_alignment(args.alignment)
+
+    seq_qc, column_qc, codon_flags = codon_qc(matrix)
+    seq_qc.insert(0, "seq_id", seq_ids)
+
+    seq_qc.to_csv(f"{args.report_prefix}_sequences.tsv", sep="\t", index=False, float_format="%.4f")
+    column_qc.to_csv(f"{args.report_prefix}_columns.tsv", sep="\t", index=False, float_format="%.4f")
+
+    print(
+        f"{len(seq_ids)} seqs x {len(column_qc)} codons: "
+        f"{(seq_qc['internal_stops'] > 0).sum()} seqs with internal stops, "
+        f"{(seq_qc['frame_errors'] > 0).sum()} seqs with frame errors"
+    )
+
+    if args.filtered_output is None:
+        return
+
+    keep_seqs, keep_columns = select_alignment(
+        seq_qc,
+        codon_flags,
+        args.max_seq_gap,
+        args.max_column_gap,
+        args.drop_internal_stops,
+        args.drop_frame_errors,
+    )
+
+    write_filtered_alignment(
+        seq_ids, matrix, keep_seqs, keep_columns, args.filtered_output, args.position_map,
+    )
+
+    print(
+        f"Kept {keep_seqs.sum()}/{len(seq_ids)} seqs and {keep_columns.sum()}/{len(keep_columns)} "
+        f"codons, written to {args.filtered_output}"
+    )
+
+
+def read_alignment(alignment_path):
+    """Load an alignment into a sequences x nucleotides matrix
+
+    :param alignment_path: Path to aligned nucleotide seqs in FASTA format
+
+    Return list of seq IDs, and numpy uint8 array of upper case ASCII codes
+    """
+    seq_ids, seqs = [], []
+
+    for record in SeqIO.parse(alignment_path, "fasta"):
+        seq_ids.append(record.id)
+        seqs.append(str(record.seq).upper().encode())
+
+    lengths = {len(seq) for seq in seqs}
+    if len(lengths) != 1:
+        raise ValueError(f"Sequences in {alignment_path} are not all the same length")
+
+    matrix = np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(len(seqs), lengths.pop())
+
+    return seq_ids, matrix
+
+
+def codon_qc(matrix):
+    """Calculate the gap and ambiguity fractions, internal stops and frame errors of an alignment
+
+    A frame error is a codon that is only partially gapped, or a sequence whose ungapped length
+    is not a multiple of three. Ambiguous codons contain a character other than A, C, G, T or '-'.
+
+    :param matrix: numpy uint8 array, sequences x nucleotides
+
+    Return pandas df of per-sequence QC, pandas df of per-column QC, and dict of boolean
+        sequences x codons arrays ('gap', 'ambiguous', 'internal_stop', 'frame_error')
+    """
+    num_seqs, num_nts = matrix.shape
+    num_codons = num_nts // 3
+
+    codons = matrix[:, :num_codons * 3].reshape(num_seqs, num_codons, 3)
+
+    is_gap = codons == GAP
+    is_nt = np.isin(codons, NUCLEOTIDES)
+
+    gap_codon = is_gap.all(axis=2)
+    partial_gap = is_gap.any(axis=2) & ~gap_codon
+    ambiguous = (~is_nt & ~is_gap).any(axis=2)
+
+    # encode complete codons as integers 0-63 to find stop codons
+    base_index = np.zeros(256, dtype=np.uint8)
+    base_index[NUCLEOTIDES] = np.arange(4)
+    codon_index = base_index[codons].astype(np.uint16) @ np.array([16, 4, 1], dtype=np.uint16)
+    stop_indices = [
+        16 * "ACGT".index(codon[0]) + 4 * "ACGT".index(codon[1]) + "ACGT".index(codon[2])
+        for codon in STOP_CODONS
+    ]
+    is_stop = is_nt.all(axis=2) & np.isin(codon_index, stop_indices)
+
+    # a stop codon is internal if it is not the last non-gap codon in the sequence
+    occupied = ~gap_codon
+    last_codon = num_codons - 1 - np.argmax(occupied[:, ::-1], axis=1)
+    internal_stop = is_stop & (np.arange(num_codons)[np.newaxis, :] < last_codon[:, np.newaxis])
+
+    ungapped_length = (matrix != GAP).sum(axis=1)
+    frame_error = partial_gap
+
+    seq_qc = pd.DataFrame({
+        "length": ungapped_length,
+        "gap_fraction": gap_codon.mean(axis=1),
+        "ambiguous_fraction": ambiguous.mean(axis=1),
+        "internal_stops": internal_stop.sum(axis=1),
+        "frame_errors": frame_error.sum(axis=1) + (ungapped_length % 3 != 0) + (num_nts % 3 != 0),
+    })
+
+    column_qc = pd.DataFrame({
+        "codon": np.arange(1, num_codons + 1),
+        "gap_fraction": gap_codon.mean(axis=0),
+        "ambiguous_fraction": ambiguous.mean(axis=0),
+        "internal_stops": internal_stop.sum(axis=0),
+        "frame_errors": frame_error.sum(axis=0),
+    })
+
+    codon_flags = {
+        "gap": gap_codon,
+        "ambiguous": ambiguous,
+        "internal_stop": internal_stop,
+        "frame_error": frame_error,
+    }
+
+    return seq_qc, column_qc, codon_flags
+
+
+def select_alignment(seq_qc, codon_flags, max_seq_gap, max_column_gap, drop_internal_stops, drop_frame_errors):
+    """Select the sequences and codon columns that pass QC
+
+    Columns are assessed on the retained sequences only, and columns containing a partial codon
+    in a retained sequence are always removed.
+
+    :param seq_qc: pandas df of per-sequence QC
+    :param codon_flags: dict of boolean sequences x codons arrays
+    :param max_seq_gap: float, max fraction of gap codons in a sequence
+    :param max_column_gap: float, max fraction of gap codons in a column
+    :param drop_internal_stops: bool, remove sequences containing internal stop codons
+    :param drop_frame_errors: bool, remove sequences with frame errors
+
+    Return boolean numpy arrays of the sequences and columns to keep
+    """
+    keep_seqs = (seq_qc["gap_fraction"] <= max_seq_gap).to_numpy(copy=True)
+    if drop_internal_stops:
+        keep_seqs &= (seq_qc["internal_stops"] == 0).to_numpy()
+    if drop_frame_errors:
+        keep_seqs &= (seq_qc["frame_errors"] == 0).to_numpy()
+
+    gap = codon_flags["gap"][keep_seqs]
+    column_gap = gap.mean(axis=0) if len(gap) != 0 else np.ones(gap.shape[1])
+
+    keep_columns = (column_gap <= max_column_gap) & ~gap.all(axis=0)
+    keep_columns &= ~codon_flags["frame_error"][keep_seqs].any(axis=0)
+
+    return keep_seqs, keep_columns
+
+
+def write_filtered_alignment(seq_ids, matrix, keep_seqs, keep_columns, output_path, position_map_path):
+    """Write the retained sequences and columns, and the map back to the original codon positions
+
+    :param seq_ids: list of seq IDs
+    :param matrix: numpy uint8 array, sequences x nucleotides
+    :param keep_seqs: boolean numpy array, sequences to keep
+    :param keep_columns: boolean numpy array, codon columns to keep
+    :param output_path: Path to write out the filtered alignment
+    :param position_map_path: Path to write out the position map, or None
+
+    Return nothing
+    """
+    num_codons = len(keep_columns)
+    nt_columns = np.repeat(keep_columns, 3)
+
+    filtered = matrix[keep_seqs][:, :num_codons * 3][:, nt_columns]
+
+    records = (
+        SeqRecord(Seq(row.tobytes().decode()), id=seq_id, description="")
+        for seq_id, row in zip(np.array(seq_ids)[keep_seqs], filtered)
+    )
+    SeqIO.write(records, output_path, "fasta")
+
+    if position_map_path is not None:
+        position_map = pd.DataFrame({
+            "filtered_codon": np.arange(1, keep_columns.sum() + 1),
+            "original_codon": np.flatnonzero(keep_columns) + 1,
+        })
+        position_map.to_csv(position_map_path, sep="\t", index=False)
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="codon_qc.py",
+        description="QC and filter a codon alignment",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "alignment",
+        type=Path,
+        help="Path to aligned nucleotide seqs in FASTA format",
+    )
+    parser.add_argument(
+        "report_prefix",
+        type=str,
+        help="Prefix of the per-sequence (_sequences.tsv) and per-column (_columns.tsv) reports",
+    )
+    parser.add_argument(
+        "--filtered_output",
+        type=Path,
+        default=None,
+        help="Path to write out the alignment of the seqs and codon columns that pass QC",
+    )
+    parser.add_argument(
+        "--position_map",
+        type=Path,
+        default=None,
+        help="Path to write out a tsv file mapping filtered codon positions to the original positions",
+    )
+    parser.add_argument(
+        "--max_seq_gap",
+        type=float,
+        default=1.0,
+        help="Max fraction of gap codons in a retained sequence",
+    )
+    parser.add_argument(
+        "--max_column_gap",
+        type=float,
+        default=1.0,
+        help="Max fraction of gap codons in a retained codon column",
+    )
+    parser.add_argument(
+        "--drop_internal_stops",
+        dest="drop_internal_stops",
+        action="store_true",
+        default=False,
+        help="Remove sequences containing internal stop codons",
+    )
+    parser.add_argument(
+        "--drop_frame_errors",
+        dest="drop_frame_errors",
+        action="store_true",
+        default=False,
+        help="Remove sequences containing partial codons or an incomplete final codon",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    with trace_stage("codon_qc"):
+        main()
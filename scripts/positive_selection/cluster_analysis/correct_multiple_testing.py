@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Correct the CodeML LRT p-values for multiple testing, across all screened proteins and per cluster"""
+
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from pipeline_trace import trace_stage
+
+
+Q_VALUE_COLUMNS = ["q_bh_global", "q_storey_global", "q_bh_cluster", "q_storey_cluster"]
+CHUNK_SIZE = 100_000  # rows of the summary file written at a time
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    # only load the columns needed to calculate the q-values
+    p_value_df = pd.read_csv(args.summary_df, sep="\t", usecols=["cluster", "p_value"])
+
+    q_values = calculate_q_values(
+        p_value_df["p_value"].to_numpy(dtype=np.float64),
+        p_value_df["cluster"].astype(str).to_numpy(),
+        args.storey_lambda,
+    )
+
+    for column in Q_VALUE_COLUMNS:
+        n_significant = int(np.sum(q_values[column] <= args.fdr))
+        print(f"{column}: {n_significant} proteins with q <= {args.fdr}")
+
+    output_path = args.output if args.output is not None else args.summary_df
+    write_q_values(args.summary_df, output_path, q_values)
+
+    print(f"Wrote q-values for {len(p_value_df)} tests to {output_path}")
+
+
+def calculate_q_values(p_values, clusters, storey_lambda):
+    """Calculate BH and Storey q-values with all tests as one family, and with each cluster as a family
+
+    :param p_values: numpy array of p-values, NaN for proteins without a result
+    :param clusters: numpy array of the cluster of each test
+    :param storey_lambda: float, tuning parameter for estimating the proportion of true nulls
+
+    Return dict {column name: numpy array of q-values}
+    """
+    global_groups = np.zeros(len(p_values), dtype=np.int64)
+    cluster_groups, _ = pd.factorize(clusters)
+
+    q_values = {}
+    for scope, groups in [("global", global_groups), ("cluster", cluster_groups)]:
+        bh_q = grouped_bh(p_values, groups)
+        pi0 = grouped_pi0(p_values, groups, storey_lambda)
+
+        q_values[f"q_bh_{scope}"] = bh_q
+        q_values[f"q_storey_{scope}"] = np.minimum(bh_q * pi0[np.maximum(groups, 0)], 1.0)
+
+    return q_values
+
+
+def grouped_bh(p_values, groups):
+    """Calculate Benjamini-Hochberg adjusted p-values independently within each group
+
+    All groups are sorted together once, and the running minimum is then taken over the
+    contiguous segment of each group in the sorted p-values.
+
+    :param p_values: numpy array of p-values, NaN p-values are ignored
+    :param groups: numpy array of non-negative int group codes
+
+    Return numpy array of q-values (NaN where the p-value is NaN)
+    """
+    q_values = np.full(len(p_values), np.nan)
+
+    valid = np.flatnonzero(~np.isnan(p_values) & (groups >= 0))
+    if len(valid) == 0:
+        return q_values
+
+    p_valid = p_values[valid]
+    g_valid = groups[valid]
+
+    # sort by group, then by p-value within each group
+    order = np.lexsort((p_valid, g_valid))
+    p_sorted = p_valid[order]
+    g_sorted = g_valid[order]
+
+    group_sizes = np.bincount(g_sorted)
+    group_starts = np.concatenate([[0], np.cumsum(group_sizes)[:-1]])
+
+    ranks = np.arange(len(p_sorted)) - group_starts[g_sorted] + 1
+    adjusted = np.minimum(p_sorted * group_sizes[g_sorted] / ranks, 1.0)
+
+    # running minimum from the largest p-value down, within each group's segment
+    boundaries = np.flatnonzero(np.diff(g_sorted)) + 1
+    for start, end in zip(np.concatenate([[0], boundaries]), np.concatenate([boundaries, [len(g_sorted)]])):
+        adjusted[start:end] = np.minimum.accumulate(adjusted[start:end][::-1])[::-1]
+
+    # a BH q-value is never smaller than its p-value, whatever the group (up to rounding)
+    if (adjusted < p_sorted * (1 - 1e-9)).any():
+        raise ValueError("Benjamini-Hochberg q-value smaller than its p-value")
+
+    q_values[valid[order]] = adjusted
+
+    return q_values
+
+
+def grouped_pi0(p_values, groups, storey_lambda):
+    """Estimate the proportion of true null hypotheses in each group (Storey 2002)
+
+    :param p_values: numpy array of p-values, NaN p-values are ignored
+    :param groups: numpy array of non-negative int group codes
+    :param storey_lambda: float, tuning parameter
+
+    Return numpy array of pi0 per group code
+    """
+    valid = ~np.isnan(p_values) & (groups >= 0)
+    n_groups = int(groups.max()) + 1 if len(groups) else 0
+
+    group_sizes = np.bincount(groups[valid], minlength=n_groups)
+    above_lambda = np.bincount(
+        groups[valid], weights=(p_values[valid] > storey_lambda), minlength=n_groups,
+    )
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pi0 = above_lambda / (group_sizes * (1 - storey_lambda))
+
+    return np.clip(np.nan_to_num(pi0, nan=1.0), 0, 1.0)
+
+
+def write_q_values(summary_path, output_path, q_values):
+    """Add the q-value columns to the summary file, streaming the file in chunks
+
+    :param summary_path: Path to summary tsv file
+    :param output_path: Path to write the summary with q-values, can be the summary path
+    :param q_values: dict {column name: numpy array of q-values}
+
+    Return nothing
+    """
+    temp_path = output_path.with_name(output_path.name + ".tmp")
+
+    row = 0
+    with open(temp_path, "w") as fh:
+        for chunk_num, chunk in enumerate(
+            pd.read_csv(summary_path, sep="\t", index_col=0, chunksize=CHUNK_SIZE)
+        ):
+            # drop q-values from a previous run
+            chunk = chunk.drop(columns=[col for col in Q_VALUE_COLUMNS if col in chunk.columns])
+
+            for column in Q_VALUE_COLUMNS:
+                chunk[column] = q_values[column][row:row + len(chunk)]
+
+            chunk.to_csv(fh, sep="\t", header=(chunk_num == 0))
+            row += len(chunk)
+
+    os.replace(temp_path, output_path)
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="correct_multiple_testing.py",
+        description="Calculate BH and Storey q-values for the CodeML LRT p-values",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "summary_df",
+        type=Path,
+        help="Path to summary tsv file written by measure_selection.py or get_codeml_results.py",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=None,
+        help="Path to write out the summary with q-values. Default: overwrite the summary file",
+    )
+    parser.add_argument(
+        "--storey_lambda",
+        type=float,
+        default=0.5,
+        help="Tuning parameter used to estimate the proportion of true nulls for Storey q-values",
+    )
+    parser.add_argument(
+        "--fdr",
+        type=float,
+        default=0.05,
+        help="False discovery rate used to report the number of significant proteins",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    with trace_stage("correct_multiple_testing"):
+        main()
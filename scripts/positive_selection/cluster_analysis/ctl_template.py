@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Parse a CodeML control file once into an immutable template, and render control files from it"""
+
+
+import os
+
+from types import MappingProxyType
+
+
+# options naming files, which are set per job rather than by the template
+FILE_OPTIONS = ["seqfile", "treefile", "outfile"]
+
+
+def read_ctl_template(ctl_path):
+    """Parse the options from a CodeML control file
+
+    Values are kept as the strings written in the file, so rendering a control file from the
+    template reproduces the original values exactly.
+
+    :param ctl_path: path to CodeML control file
+
+    Return read-only mapping {option: value}, in the order found in the file
+    """
+    options = {}
+
+    with open(ctl_path, "r") as fh:
+        for line in fh:
+            uncommented = line.split("*", 1)[0].strip()
+            if uncommented == "":
+                continue
+
+            if "=" not in uncommented:
+                raise ValueError("Malformed line in control file {}:\n{}".format(ctl_path, line))
+
+            option, value = (field.strip() for field in uncommented.split("=", 1))
+
+            if option not in FILE_OPTIONS:
+                options[option] = value
+
+    return MappingProxyType(options)
+
+
+def derive_options(options, **changes):
+    """Create a variant of a template, leaving the template unchanged
+
+    :param options: read-only mapping of CodeML options
+    :param changes: options to add or replace
+
+    Return read-only mapping {option: value}
+    """
+    derived = dict(options)
+    derived.update({option: str(value) for option, value in changes.items()})
+
+    return MappingProxyType(derived)
+
+
+def render_ctl(options, seqfile, treefile, outfile):
+    """Render the contents of a CodeML control file
+
+    :param options: read-only mapping of CodeML options
+    :param seqfile: str, path to the alignment relative to the CodeML working dir
+    :param treefile: str, path to the tree relative to the CodeML working dir
+    :param outfile: str, path to the output file relative to the CodeML working dir
+
+    Return str
+    """
+    lines = [
+        "seqfile = {}".format(seqfile),
+        "treefile = {}".format(treefile),
+        "outfile = {}".format(outfile),
+    ]
+    lines += ["{} = {}".format(option, value) for option, value in options.items()]
+
+    return "\n".join(lines) + "\n"
+
+
+def write_ctl(options, ctl_path, working_dir, alignment, tree, out_file):
+    """Write a CodeML control file, with the file paths relative to the CodeML working dir
+
+    :param options: read-only mapping of CodeML options
+    :param ctl_path: path to write the control file to
+    :param working_dir: path to the dir CodeML will be run in
+    :param alignment: path to the codon alignment
+    :param tree: path to the labelled tree
+    :param out_file: path to the CodeML output file
+
+    Return nothing
+    """
+    ctl = render_ctl(
+        options,
+        os.path.relpath(alignment, working_dir),
+        os.path.relpath(tree, working_dir),
+        os.path.relpath(out_file, working_dir),
+    )
+
+    with open(ctl_path, "w") as fh:
+        fh.write(ctl)
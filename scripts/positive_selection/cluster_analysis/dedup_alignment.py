@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Collapse identical sequences in a codon alignment into one representative per set of duplicates"""
+
+
+import argparse
+import hashlib
+
+import pandas as pd
+
+from pathlib import Path
+
+from Bio import SeqIO
+
+from pipeline_trace import trace_stage
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    member_map = dedup_alignment(args.alignment, args.output, args.member_map)
+
+    num_reps = member_map["representative"].nunique()
+    print(
+        f"Collapsed {len(member_map)} sequences into {num_reps} representatives, "
+        f"written to {args.output}"
+    )
+
+
+def dedup_alignment(alignment_path, output_path, member_map_path):
+    """Write one representative of each set of identical aligned sequences
+
+    The first sequence in the alignment with a given sequence is used as the representative.
+
+    :param alignment_path: Path to aligned sequences in FASTA format
+    :param output_path: Path to write the representative sequences to
+    :param member_map_path: Path to write the tsv file mapping each sequence to its representative
+
+    Return pandas df of the member map
+    """
+    representatives = {}  # {sequence digest: accession of representative}
+    member_rows = []
+    rep_records = []
+
+    for record in SeqIO.parse(alignment_path, "fasta"):
+        digest = hashlib.blake2b(str(record.seq).upper().encode(), digest_size=16).hexdigest()
+
+        if digest not in representatives:
+            representatives[digest] = record.id
+            rep_records.append(record)
+
+        member_rows.append([representatives[digest], record.id])
+
+    SeqIO.write(rep_records, output_path, "fasta")
+
+    member_map = pd.DataFrame(member_rows, columns=["representative", "member"])
+    member_map.to_csv(member_map_path, sep="\t", index=False)
+
+    return member_map
+
+
+def load_duplicates(member_map_path):
+    """Load the members of each representative that were collapsed into it
+
+    :param member_map_path: Path to tsv file written by dedup_alignment()
+
+    Return dict {representative: [duplicate members]}, and set of duplicate members
+    """
+    member_map = pd.read_csv(member_map_path, sep="\t", dtype=str)
+    member_map = member_map[member_map["representative"] != member_map["member"]]
+
+    duplicates = member_map.groupby("representative")["member"].apply(list).to_dict()
+
+    return duplicates, set(member_map["member"])
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="dedup_alignment.py",
+        description="Collapse identical sequences in a codon alignment",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "alignment",
+        type=Path,
+        help="Path to aligned nucleotide seqs in FASTA format",
+    )
+    parser.add_argument(
+        "output",
+        type=Path,
+        help="Path to write out the representative seqs",
+    )
+    parser.add_argument(
+        "member_map",
+        type=Path,
+        help="Path to write out a tsv file mapping each seq to its representative",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    with trace_stage("dedup_alignment"):
+        main()
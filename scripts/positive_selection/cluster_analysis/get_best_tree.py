@@ -42,10 +42,13 @@
 
 
 import argparse
-import re
+import sys
 
 from pathlib import Path
 
+from pipeline_trace import trace_stage
+from raxml_bootstrap import BOOTSTRAP_REGEX
+
 
 def main():
     parser = build_parser()
@@ -56,37 +59,32 @@ def main():
     best_tree = get_best_tree(best_tree_num, args)
 
     if best_tree is None:
-        best_tree_num = retry_get_best_tree(args)
-
-        best_tree = get_best_tree(best_tree_num, args)
+        print(f"Could not find bootstrap tree #{best_tree_num} in {args.boostraps_file}")
+        sys.exit(1)
 
     with open(args.tree_file, 'w') as fh:
         fh.write(best_tree)
 
 
 def get_best_tree_num(args):
-    """Get the number of the best tree
+    """Get the number of the bootstrap tree with the greatest log likelihood
+
+    The log is read line by line. Lines listing several trees, written when RaxML-ng workers
+    log at the same time, are also parsed.
     
     :param args: cmd-line args parser
     
     Return str
     """
-    with open(args.raxml_log, 'r') as fh:
-        raxml_log = fh.read().splitlines()
-
-    bootstrap_dict = {}  # #tree: logLikelihood
-
-    for line in raxml_log:
-        if line.find("] Bootstrap tree #") != -1:
-            tree_number = line.split("#")[-1].split(",")[0].strip()
-            loglikelihood = line.split("#")[-1].split(",")[-1].split(":")[-1].strip()
-            bootstrap_dict[tree_number.strip()] = loglikelihood.strip()
+    best_tree = None
+    best_loglikelihood = None
 
-    tree_ranks = []
-    for tree, ml in sorted(bootstrap_dict.items(), key=lambda x: x[1], reverse=False):
-        tree_ranks.append(tree)
-    
-    best_tree = tree_ranks[0]
+    with open(args.raxml_log, 'r') as fh:
+        for line in fh:
+            for tree_number, loglikelihood in BOOTSTRAP_REGEX.findall(line):
+                if best_loglikelihood is None or float(loglikelihood) > best_loglikelihood:
+                    best_tree = tree_number
+                    best_loglikelihood = float(loglikelihood)
 
     print("Best tree num: ", best_tree)
 
@@ -94,7 +92,7 @@ def get_best_tree_num(args):
 
 
 def get_best_tree(best_tree_num, args):
-    """Get the best tree
+    """Get the best tree, tree n is on line n of the bootstraps file
     
     :param best_tree_num: str, number of the best tree
     :param args: cmd-line args parser
@@ -102,66 +100,11 @@ def get_best_tree(best_tree_num, args):
     Return str of best tree in newick format
     """
     with open(args.boostraps_file, 'r') as fh:
-        all_trees = fh.read().splitlines()
-
-    tree_num = 1
-
-    best_tree = None
-
-    for tree in all_trees:
-        if str(tree_num) == best_tree_num:
-            best_tree = tree
-            continue
-        else:
-            tree_num += 1
-
-    return best_tree
+        for tree_num, tree in enumerate(fh, start=1):
+            if str(tree_num) == best_tree_num:
+                return tree.rstrip("\n")
 
-
-def retry_get_best_tree(args):
-    """Retry getting the best tree"""
-    with open(args.raxml_log, 'r') as fh:
-        raxml_log = fh.read().splitlines()
-
-    bootstrap_dict = {}  # #tree: logLikelihood
-
-    for line in raxml_log:
-        if line.find("Bootstrap tree") != -1:
-            if len(re.findall("Bootstrap tree", line)) > 1:
-                # multiple bootstras in one line
-                if len(re.findall("logLikelihood", line)) > 1:
-                    separate_lines = line.split("worker")
-                    for new_line in separate_lines:
-                        if new_line.find("logLikelihood:") != -1:
-                            if new_line.find("Bootstrap tree") != -1:
-                                loglikelihood = new_line.split("-")
-                                loglikelihood = "-" + loglikelihood[-1][:11]
-
-                                tree_num = new_line.split("Bootstrap tree #")[1]
-                                tree_num = tree_num.split(",")[0]
-
-                                if loglikelihood.startswith("-"):
-                                    bootstrap_dict[tree_num.strip()] = loglikelihood.strip()
-
-                else:
-                    loglikelihood = line.split("-")
-                    loglikelihood = "-" + loglikelihood[-1][:11]
-
-                    tree_num = line.split("Bootstrap tree #")[1]
-                    tree_num = tree_num.split(",")[0]
-
-                    if loglikelihood.startswith("-"):
-                        bootstrap_dict[tree_num.strip()] = loglikelihood.strip()
-
-    tree_ranks = []
-    for tree, ml in sorted(bootstrap_dict.items(), key=lambda x: x[1], reverse=False):
-        tree_ranks.append(tree)
-    
-    best_tree = tree_ranks[0]
-
-    print("Best tree num: ", best_tree)
-
-    return best_tree
+    return None
 
 
 def build_parser():
@@ -196,5 +139,6 @@ def build_parser():
 
 
 if __name__ == "__main__":
-    main()
+    with trace_stage("get_best_tree"):
+        main()
 
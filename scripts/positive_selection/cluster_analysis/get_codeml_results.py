@@ -54,6 +54,9 @@ from Bio.Phylo.PAML import codeml
 from rpy2.robjects import packages as rpackages
 from tqdm import tqdm
 
+from beb_sites import parse_site_tables, write_sites
+from pipeline_trace import trace_stage
+
 # import R stats package
 rstats = rpackages.importr("stats")
 
@@ -70,6 +73,7 @@ def main():
     rerun = []
 
     summary_data = []
+    sites = []  # positively selected sites in significant proteins
 
     cluster_df = pd.read_csv(args.cluster_df_path)
 
@@ -122,6 +126,9 @@ def main():
         if p_value <= SIGNIFICANCE_LEVEL:
             print("Positive selection detected:", p_value, accession)
             positive_selection.append("{}\t{}".format(accession, p_value))
+
+            if args.sites_store is not None:
+                sites += parse_site_tables(alt_output, accession)
         else:
             no_positive_selection.append("{}\t{}".format(accession, p_value))
             print("Positive selection NOT detected:", p_value, accession)
@@ -138,6 +145,10 @@ def main():
         for accession in rerun:
             fh.write("{}\n".format(accession))
 
+    if args.sites_store is not None:
+        write_sites(sites, args.sites_store, parent_output_dir.name)
+        print("Wrote {} sites to {}".format(len(sites), args.sites_store))
+
     if args.summary_df is not None:  # add data to a summary df
         column_names = ["cluster", "accessions", "p_value", "lnl1", "np1", "lnl0", "np0"]
 
@@ -368,6 +379,15 @@ def build_parser():
         default=None,
         help="Path to write out summary df, or add data to an existing tsv file",
     )
+    parser.add_argument(
+        "--sites_store",
+        type=Path,
+        default=None,
+        help=(
+            "Path to dir of the site-level store, to which the NEB/BEB sites of "
+            "significant proteins are written"
+        ),
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -382,4 +402,5 @@ def build_parser():
 
 
 if __name__ == "__main__":
-    main()
+    with trace_stage("get_codeml_results"):
+        main()
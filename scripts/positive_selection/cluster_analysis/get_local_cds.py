@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Retrieve the CDSs of the proteins in a cluster from the local CDS index, using ncfp only for misses
+
+The CDSs are written to <output dir>/ncfp_nt.fasta, the same file as ncfp, so the rest of
+the pipeline is unchanged. The index is built by scripts/genomes/build_cds_index.py.
+"""
+
+
+import argparse
+import mmap
+import subprocess
+import sys
+
+import numpy as np
+
+from pathlib import Path
+
+from Bio import SeqIO
+
+from pipeline_trace import run_tool, trace_stage
+
+
+CDS_FILE = "ncfp_nt.fasta"
+BLOB_FILE = "cds.blob"
+INDEX_FILE = "cds_index.npy"
+# resolved from the repo root, so the default is found whichever dir the script is run from
+CDS_INDEX = Path(__file__).resolve().parents[3] / "data" / "genomes" / "cds_index"
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    protein_seqs = {record.id: str(record.seq) for record in SeqIO.parse(args.protein_seqs, "fasta")}
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    cds = get_cds(
+        protein_seqs,
+        list(protein_seqs),
+        args.cds_index,
+        args.output_dir,
+        args.email,
+        ncfp=args.ncfp,
+        offline=args.offline,
+        allow_network=args.allow_network,
+    )
+
+    write_cds(args.output_dir / CDS_FILE, [(seq_id, cds[seq_id]) for seq_id in protein_seqs if seq_id in cds])
+
+    print(f"Retrieved {len(cds)} of {len(protein_seqs)} CDSs")
+
+
+def get_cds(protein_seqs, seq_ids, index_dir, work_dir, email, ncfp="ncfp", offline=False, allow_network=False):
+    """Get the CDSs of proteins from the local CDS index, running ncfp for the proteins not in the index
+
+    :param protein_seqs: dict {seq id: str of protein seq}
+    :param seq_ids: list of IDs of the proteins to get the CDS of
+    :param index_dir: Path to the CDS index, or None to use only ncfp
+    :param work_dir: Path to dir for the ncfp input and output
+    :param email: str, email address, required by ncfp for Entrez
+    :param ncfp: str, ncfp executable
+    :param offline: bool, do not run ncfp for the proteins not in the index
+    :param allow_network: bool, run ncfp for every protein if the index does not exist, instead of exiting
+
+    Return dict {seq id: str of CDS}, without the proteins for which no CDS was found
+    """
+    cds = {}
+    if index_dir is not None and (index_dir / INDEX_FILE).exists():
+        cds = lookup_cds(index_dir, seq_ids)
+    elif index_dir is not None and not allow_network:
+        sys.exit(
+            f"No CDS index found in {index_dir}\n"
+            "Build it with scripts/genomes/build_cds_index.sh, pass the path to it with --cds_index, "
+            "or pass --allow_network to retrieve every CDS with ncfp"
+        )
+    elif index_dir is not None:
+        print(f"No CDS index found in {index_dir}, retrieving every CDS with ncfp")
+
+    missing_ids = [seq_id for seq_id in seq_ids if seq_id not in cds]
+
+    print(f"{len(cds)} CDSs found in the local index, {len(missing_ids)} missing")
+
+    if missing_ids and not offline:
+        missing_path = work_dir / "proteins_not_in_cds_index.fasta"
+        with open(missing_path, "w") as fh:
+            for seq_id in missing_ids:
+                fh.write(f">{seq_id}\n{protein_seqs[seq_id]}\n")
+
+        ncfp_dir = work_dir / "ncfp_output"
+        returncode = run_tool(
+            [
+                ncfp, str(missing_path), str(ncfp_dir), email,
+                "--use_protein_ids", "--drop_stop_codons",
+            ],
+            stage="get_cds_fallback",
+            stdout=subprocess.DEVNULL,
+            n_proteins=len(missing_ids),
+        )
+        if returncode != 0:
+            sys.exit(f"ncfp failed with exit status {returncode}")
+
+        for record in SeqIO.parse(ncfp_dir / CDS_FILE, "fasta"):
+            if record.id in protein_seqs:
+                cds[record.id] = str(record.seq)
+
+    return cds
+
+
+def lookup_cds(index_dir, seq_ids):
+    """Look up CDSs in the local CDS index, without loading the index into memory
+
+    :param index_dir: Path to the CDS index
+    :param seq_ids: list of protein IDs
+
+    Return dict {protein ID: str of CDS}, of the proteins in the index
+    """
+    index = np.load(index_dir / INDEX_FILE, mmap_mode="r")
+    keys = index["protein_id"]
+    max_id_length = keys.dtype.itemsize
+
+    # longer IDs would be truncated by numpy, and cannot be in the index
+    queries = [seq_id for seq_id in seq_ids if len(seq_id.encode()) <= max_id_length]
+    if len(queries) == 0 or len(index) == 0:
+        return {}
+
+    query_keys = np.array([seq_id.encode() for seq_id in queries], dtype=keys.dtype)
+    positions = np.searchsorted(keys, query_keys)
+    positions[positions == len(keys)] = 0  # past the end, checked below
+    found = keys[positions] == query_keys
+
+    cds = {}
+    with open(index_dir / BLOB_FILE, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as blob:
+        for seq_id, position in zip(np.array(queries)[found], positions[found]):
+            offset, length = int(index["offset"][position]), int(index["length"][position])
+            cds[str(seq_id)] = blob[offset:offset + length].decode()
+
+    return cds
+
+
+def write_cds(fasta_path, cds):
+    """Write CDSs to a FASTA file, replacing the file only once it is complete
+
+    :param fasta_path: Path to FASTA file
+    :param cds: list of tuples (seq id, str of CDS)
+
+    Return nothing
+    """
+    temp_path = Path(f"{fasta_path}.tmp")
+
+    with open(temp_path, "w") as fh:
+        for seq_id, seq in cds:
+            fh.write(f">{seq_id}\n{seq}\n")
+
+    temp_path.replace(fasta_path)
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="get_local_cds.py",
+        description="Retrieve the CDSs of proteins from the local CDS index, and from ncfp for misses",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "protein_seqs",
+        type=Path,
+        help="Path to FASTA file of protein seqs",
+    )
+    parser.add_argument(
+        "output_dir",
+        type=Path,
+        help=f"Path to output dir, the CDSs are written to {CDS_FILE}",
+    )
+    parser.add_argument(
+        "email",
+        type=str,
+        help="Email address, required by ncfp for Entrez",
+    )
+    parser.add_argument(
+        "--cds_index",
+        type=Path,
+        default=CDS_INDEX,
+        help="Path to the CDS index built by build_cds_index.py",
+    )
+    parser.add_argument(
+        "--ncfp",
+        type=str,
+        default="ncfp",
+        help="ncfp executable",
+    )
+    parser.add_argument(
+        "--offline",
+        dest="offline",
+        action="store_true",
+        default=False,
+        help="Do not run ncfp for proteins not in the CDS index",
+    )
+    parser.add_argument(
+        "--allow_network",
+        dest="allow_network",
+        action="store_true",
+        default=False,
+        help="Retrieve every CDS with ncfp if the CDS index does not exist, instead of exiting",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    with trace_stage("get_local_cds"):
+        main()
@@ -45,6 +45,8 @@ import argparse
 
 from pathlib import Path
 
+from pipeline_trace import trace_stage
+
 
 def main():
     parser = build_parser()
@@ -104,5 +106,6 @@ def build_parser():
 
 
 if __name__ == "__main__":
-    main()
+    with trace_stage("get_model"):
+        main()
 
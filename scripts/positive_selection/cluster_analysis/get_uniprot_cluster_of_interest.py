@@ -53,6 +53,8 @@ from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from tqdm import tqdm
 
+from pipeline_trace import trace_stage
+
 
 def main():
     parser = build_parser()
@@ -114,8 +116,8 @@ def parse_mmseq(mmseq_tsv):
     for index in tqdm(range(len(mmseq_output)), desc="Parsing MMseq tsv file"):
         row = mmseq_output.iloc[index]
 
-        cluster_acc = row[0]
-        member_acc = row[1]
+        cluster_acc = row.iloc[0]
+        member_acc = row.iloc[1]
 
         try:
             clusters[cluster_acc].add(member_acc)
@@ -169,5 +171,6 @@ def build_parser():
 
 
 if __name__ == "__main__":
-    main()
+    with trace_stage("get_uniprot_cluster_of_interest"):
+        main()
 
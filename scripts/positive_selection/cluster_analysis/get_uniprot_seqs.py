@@ -53,6 +53,8 @@ from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from tqdm import tqdm
 
+from pipeline_trace import trace_stage
+
 
 def main():
     parser = build_parser()
@@ -142,5 +144,6 @@ def build_parser():
 
 
 if __name__ == "__main__":
-    main()
+    with trace_stage("get_uniprot_seqs"):
+        main()
 
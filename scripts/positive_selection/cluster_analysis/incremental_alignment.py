@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Add new seqs to an existing cluster alignment, instead of realigning the cluster from scratch
+
+Only the new protein seqs are aligned (mafft --add), and only their CDSs are retrieved (get_local_cds)
+and backthreaded (t_coffee). Seqs no longer in the cluster are removed from the alignments.
+"""
+
+
+import argparse
+import sys
+
+import numpy as np
+
+from pathlib import Path
+
+from Bio import SeqIO
+
+from get_local_cds import CDS_INDEX, get_cds
+from pipeline_trace import run_tool, trace_stage
+
+
+GAP = ord("-")
+CDS_FILE = "ncfp_nt.fasta"  # CDSs of the cluster, kept as a cache
+NO_CDS_FILE = "no_cds.txt"  # seqs for which no CDS was found
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    work_dir = args.aligned_proteins.parent / "incremental_alignment"
+    work_dir.mkdir(exist_ok=True)
+
+    protein_seqs = {record.id: str(record.seq) for record in SeqIO.parse(args.protein_seqs, "fasta")}
+    aligned_proteins = read_fasta(args.aligned_proteins)
+    aligned_nts = read_fasta(args.aligned_nts)
+
+    # seqs for which no CDS was found in a previous run are not retried
+    no_cds_path = work_dir / NO_CDS_FILE
+    no_cds = set(no_cds_path.read_text().split()) if no_cds_path.exists() else set()
+
+    new_ids, removed_ids = compare_seqs(protein_seqs, aligned_proteins, aligned_nts)
+    new_ids = [seq_id for seq_id in new_ids if seq_id not in no_cds]
+
+    # retrieve the CDSs of only the new seqs, seqs without a CDS are not added
+    if new_ids:
+        new_cds_path, new_ids = get_new_cds(protein_seqs, new_ids, args.cds_dir, work_dir, args)
+
+    if len(new_ids) == 0 and len(removed_ids) == 0:
+        print("Alignment is up to date")
+        return
+
+    print(f"Adding {len(new_ids)} seqs, removing {len(removed_ids)} seqs")
+
+    kept_ids = [seq_id for seq_id in aligned_proteins if seq_id not in removed_ids]
+    if len(kept_ids) == 0:
+        sys.exit("No seqs of the existing alignment remain, realign the cluster from scratch")
+
+    kept_proteins, kept_nts = drop_seqs(aligned_proteins, aligned_nts, kept_ids)
+
+    if len(new_ids) == 0:
+        write_fasta(args.aligned_proteins, kept_ids, kept_proteins)
+        write_fasta(args.aligned_nts, kept_ids, kept_nts)
+        return
+
+    existing_path = work_dir / "existing_aligned_proteins.fasta"
+    new_path = work_dir / "new_proteins.fasta"
+    write_fasta(existing_path, kept_ids, kept_proteins)
+    write_fasta(new_path, new_ids, [protein_seqs[seq_id].encode() for seq_id in new_ids])
+
+    # align the new seqs to the existing alignment, which is kept, but may gain gap columns
+    added_path = work_dir / "aligned_proteins.fasta"
+    with open(added_path, "w") as fh:
+        returncode = run_tool(
+            [args.mafft, "--thread", str(args.threads), "--add", str(new_path), str(existing_path)],
+            stage="align_new_proteins",
+            stdout=fh,
+        )
+    if returncode != 0:
+        sys.exit(f"mafft --add failed with exit status {returncode}")
+
+    updated_proteins = read_fasta(added_path)
+
+    # backthread only the CDSs of the new seqs
+    new_aligned_path = work_dir / "new_aligned_proteins.fasta"
+    write_fasta(new_aligned_path, new_ids, [updated_proteins[seq_id] for seq_id in new_ids])
+
+    new_nts_path = work_dir / "new_aligned_nts.fasta"
+    with open(new_nts_path, "w") as fh:
+        returncode = run_tool(
+            [
+                args.t_coffee, "-other_pg", "seq_reformat",
+                "-in", str(new_cds_path),
+                "-in2", str(new_aligned_path),
+                "-action", "+thread_dna_on_prot_aln",
+                "-output", "fasta",
+            ],
+            stage="backthread_new_cds",
+            stdout=fh,
+        )
+    if returncode != 0:
+        sys.exit(f"t_coffee failed with exit status {returncode}")
+
+    new_nts = read_fasta(new_nts_path)
+
+    # insert the gap columns added by mafft into the existing codon alignment
+    inserted = inserted_columns(
+        to_matrix(kept_proteins),
+        to_matrix([updated_proteins[seq_id] for seq_id in kept_ids]),
+    )
+    regapped_nts = insert_codon_gaps(kept_nts, inserted)
+
+    all_ids = kept_ids + new_ids
+    write_fasta(args.aligned_proteins, all_ids, [updated_proteins[seq_id] for seq_id in all_ids])
+    write_fasta(args.aligned_nts, all_ids, regapped_nts + [new_nts[seq_id] for seq_id in new_ids])
+
+    print(f"Added {len(new_ids)} seqs to {args.aligned_proteins} and {args.aligned_nts}")
+
+
+def read_fasta(fasta_path):
+    """Read a FASTA file into a dict {seq id: bytes of the upper case seq}, in file order"""
+    return {record.id: str(record.seq).upper().encode() for record in SeqIO.parse(fasta_path, "fasta")}
+
+
+def to_matrix(seqs):
+    """Stack seqs (bytes) of the same length into a numpy uint8 array"""
+    return np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(len(seqs), -1)
+
+
+def write_fasta(fasta_path, seq_ids, seqs):
+    """Write seqs (bytes) to a FASTA file, replacing the file only once it is complete"""
+    temp_path = Path(f"{fasta_path}.tmp")
+
+    with open(temp_path, "w") as fh:
+        for seq_id, seq in zip(seq_ids, seqs):
+            fh.write(f">{seq_id}\n{seq.decode()}\n")
+
+    temp_path.replace(fasta_path)
+
+
+def compare_seqs(protein_seqs, aligned_proteins, aligned_nts):
+    """Find the seqs of the cluster that are not in the alignment, and the aligned seqs to remove
+
+    A seq whose protein seq has changed is both removed and added.
+
+    :param protein_seqs: dict {seq id: str of protein seq} of the cluster
+    :param aligned_proteins: dict {seq id: bytes} of the existing protein alignment
+    :param aligned_nts: dict {seq id: bytes} of the existing codon alignment
+
+    Return list of new seq IDs, in the order of protein_seqs, and set of seq IDs to remove
+    """
+    removed_ids = set(aligned_proteins) - set(protein_seqs)
+    missing_nts = set(aligned_proteins) - set(aligned_nts)  # e.g. no CDS was found
+
+    for seq_id, aligned_seq in aligned_proteins.items():
+        if seq_id in protein_seqs and aligned_seq.replace(b"-", b"") != protein_seqs[seq_id].upper().encode():
+            removed_ids.add(seq_id)
+
+    removed_ids |= missing_nts
+
+    new_ids = [
+        seq_id for seq_id in protein_seqs if seq_id not in aligned_proteins or seq_id in removed_ids
+    ]
+
+    return new_ids, removed_ids
+
+
+def drop_seqs(aligned_proteins, aligned_nts, kept_ids):
+    """Keep only the given seqs, and remove the columns that are then gaps in all seqs
+
+    :param aligned_proteins: dict {seq id: bytes} of the protein alignment
+    :param aligned_nts: dict {seq id: bytes} of the codon alignment
+    :param kept_ids: list of seq IDs to keep
+
+    Return list of bytes of the aligned proteins, list of bytes of the aligned codons
+    """
+    proteins = to_matrix([aligned_proteins[seq_id] for seq_id in kept_ids])
+    codons = to_matrix([aligned_nts[seq_id] for seq_id in kept_ids])
+
+    if codons.shape[1] != 3 * proteins.shape[1]:
+        raise ValueError("The codon alignment is not three times the length of the protein alignment")
+
+    keep_columns = (proteins != GAP).any(axis=0)
+    proteins = proteins[:, keep_columns]
+    codons = codons.reshape(len(kept_ids), -1, 3)[:, keep_columns].reshape(len(kept_ids), -1)
+
+    return [row.tobytes() for row in proteins], [row.tobytes() for row in codons]
+
+
+def inserted_columns(old_matrix, new_matrix):
+    """Find the gap columns inserted into an alignment when new seqs were added to it
+
+    :param old_matrix: numpy uint8 array, existing seqs x columns of the old alignment
+    :param new_matrix: numpy uint8 array, existing seqs x columns of the updated alignment
+
+    Return numpy bool array, True for each column of the updated alignment that was inserted
+    """
+    inserted = np.ones(new_matrix.shape[1], dtype=bool)
+    old_column = 0
+
+    for new_column in range(new_matrix.shape[1]):
+        if old_column < old_matrix.shape[1] and np.array_equal(
+            new_matrix[:, new_column], old_matrix[:, old_column]
+        ):
+            inserted[new_column] = False
+            old_column += 1
+        elif not (new_matrix[:, new_column] == GAP).all():
+            raise ValueError("The existing alignment was changed when adding new seqs")
+
+    if old_column != old_matrix.shape[1]:
+        raise ValueError("The existing alignment was changed when adding new seqs")
+
+    return inserted
+
+
+def insert_codon_gaps(aligned_nts, inserted):
+    """Insert gap codons into a codon alignment
+
+    :param aligned_nts: list of bytes of aligned codons
+    :param inserted: numpy bool array, True for each column of the updated alignment that is new
+
+    Return list of bytes of aligned codons
+    """
+    codons = to_matrix(aligned_nts).reshape(len(aligned_nts), -1, 3)
+
+    regapped = np.full((len(aligned_nts), len(inserted), 3), GAP, dtype=np.uint8)
+    regapped[:, ~inserted] = codons
+
+    return [row.tobytes() for row in regapped.reshape(len(aligned_nts), -1)]
+
+
+def get_new_cds(protein_seqs, new_ids, cds_dir, work_dir, args):
+    """Get the CDSs of the new seqs, from the cluster CDS cache, the local CDS index or ncfp
+
+    Retrieved CDSs are added to the cache, and seqs without a CDS are recorded so
+    they are not retried.
+
+    :param protein_seqs: dict {seq id: str of protein seq} of the cluster
+    :param new_ids: list of new seq IDs
+    :param cds_dir: Path to the CDS dir of the cluster
+    :param work_dir: Path to dir for temporary files
+    :param args: cmd-line args parser
+
+    Return Path to FASTA file of the CDSs of the new seqs, and list of IDs of new seqs with a CDS
+    """
+    cache_path = cds_dir / CDS_FILE
+    cached = read_fasta(cache_path) if cache_path.exists() else {}
+
+    missing_ids = [seq_id for seq_id in new_ids if seq_id not in cached]
+
+    if missing_ids:
+        retrieved = get_cds(
+            protein_seqs,
+            missing_ids,
+            args.cds_index,
+            work_dir,
+            args.email,
+            ncfp=args.ncfp,
+            allow_network=args.allow_network,
+        )
+        cached.update({seq_id: seq.upper().encode() for seq_id, seq in retrieved.items()})
+
+        cds_dir.mkdir(parents=True, exist_ok=True)
+        write_fasta(cache_path, list(cached), list(cached.values()))
+
+        no_cds = [seq_id for seq_id in missing_ids if seq_id not in cached]
+        if no_cds:
+            print(f"No CDS found for {len(no_cds)} new seqs, which are not added")
+            with open(work_dir / NO_CDS_FILE, "a") as fh:
+                fh.write("".join(f"{seq_id}\n" for seq_id in no_cds))
+
+    found_ids = [seq_id for seq_id in new_ids if seq_id in cached]
+
+    new_cds_path = work_dir / "new_cds.fasta"
+    write_fasta(new_cds_path, found_ids, [cached[seq_id] for seq_id in found_ids])
+
+    return new_cds_path, found_ids
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="incremental_alignment.py",
+        description="Add new seqs to the existing protein and codon alignments of a cluster",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "protein_seqs",
+        type=Path,
+        help="Path to FASTA file of all protein seqs in the cluster",
+    )
+    parser.add_argument(
+        "aligned_proteins",
+        type=Path,
+        help="Path to the existing protein alignment, which is updated",
+    )
+    parser.add_argument(
+        "cds_dir",
+        type=Path,
+        help=f"Path to the CDS dir of the cluster, containing {CDS_FILE}",
+    )
+    parser.add_argument(
+        "aligned_nts",
+        type=Path,
+        help="Path to the existing codon alignment, which is updated",
+    )
+    parser.add_argument(
+        "email",
+        type=str,
+        help="Email address, required by ncfp for Entrez",
+    )
+    parser.add_argument(
+        "--cds_index",
+        type=Path,
+        default=CDS_INDEX,
+        help="Path to the CDS index built by build_cds_index.py, ncfp is only run for CDSs not in the index",
+    )
+    parser.add_argument(
+        "--allow_network",
+        dest="allow_network",
+        action="store_true",
+        default=False,
+        help="Retrieve every CDS with ncfp if the CDS index does not exist, instead of exiting",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=12,
+        help="Number of threads for mafft",
+    )
+    parser.add_argument(
+        "--mafft",
+        type=str,
+        default="mafft",
+        help="mafft executable",
+    )
+    parser.add_argument(
+        "--ncfp",
+        type=str,
+        default="ncfp",
+        help="ncfp executable",
+    )
+    parser.add_argument(
+        "--t_coffee",
+        type=str,
+        default="t_coffee",
+        help="t_coffee executable",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    with trace_stage("incremental_alignment"):
+        main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Record the progress of each protein through measure_selection.py, so that runs can be resumed"""
+
+
+import hashlib
+import sqlite3
+
+from datetime import datetime
+
+
+LEDGER_NAME = "job_ledger.db"
+
+# stages in the order they are completed for each protein
+# 'm0_fitted' is completed once per cluster, and is recorded under CLUSTER_KEY
+STAGES = ["m0_fitted", "msa_prepared", "tree_labelled", "alt_done", "null_done", "lrt_computed"]
+CLUSTER_KEY = "cluster"
+RESULT_COLUMNS = ["p_value", "lnl1", "np1", "lnl0", "np0"]
+ATTEMPT_COLUMNS = [
+    "attempt", "omega", "kappa", "status", "returncode", "wall_time", "cpu_time", "lnl",
+]
+# models fitted per protein, 'm0' is fitted once per cluster
+BRANCH_SITE_MODELS = ["alt", "null"]
+
+
+def open_ledger(cluster_dir, inputs, restart=False, settings=None):
+    """Open (or create) the job ledger of a cluster
+
+    If the cluster inputs (MSA, tree, ctl file) or settings have changed since the ledger was
+    written, the recorded stages no longer describe the outputs on disk and the ledger is cleared.
+    CodeML attempts are kept, so time limits can be tuned from past runs, but are recorded under
+    a new generation, so the attempts of the current outputs can be told apart from older ones.
+
+    :param cluster_dir: Path to the cluster dir
+    :param inputs: dict {name: Path} of files the outputs of every protein depend on
+    :param restart: bool, clear the ledger and process all proteins again
+    :param settings: dict {name: value} of options the outputs of every protein depend on
+
+    Return sqlite3 connection
+    """
+    conn = sqlite3.connect(cluster_dir / LEDGER_NAME)
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS Inputs (name TEXT PRIMARY KEY, hash TEXT);
+        CREATE TABLE IF NOT EXISTS Stages (
+            accession TEXT,
+            stage TEXT,
+            output_hash TEXT,
+            completed TEXT,
+            PRIMARY KEY (accession, stage)
+        );
+        CREATE TABLE IF NOT EXISTS Results (
+            accession TEXT PRIMARY KEY,
+            p_value REAL,
+            lnl1 REAL,
+            np1 REAL,
+            lnl0 REAL,
+            np0 REAL
+        );
+        CREATE TABLE IF NOT EXISTS Attempts (
+            accession TEXT,
+            model TEXT,
+            attempt INTEGER,
+            omega REAL,
+            kappa REAL,
+            status TEXT,
+            returncode INTEGER,
+            wall_time REAL,
+            cpu_time REAL,
+            lnl REAL,
+            recorded TEXT,
+            generation INTEGER,
+            fix_blength INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS Generations (generation INTEGER PRIMARY KEY, started TEXT);
+        """
+    )
+
+    # ledgers written before generations and branch length settings were recorded
+    attempt_columns = [row[1] for row in conn.execute("PRAGMA table_info(Attempts)")]
+    for column in ["generation", "fix_blength"]:
+        if column not in attempt_columns:
+            with conn:
+                conn.execute(f"ALTER TABLE Attempts ADD COLUMN {column} INTEGER")
+
+    input_hashes = {name: hash_files([path]) for name, path in inputs.items()}
+    if settings is not None:
+        input_hashes.update({name: str(value) for name, value in settings.items()})
+    recorded_hashes = dict(conn.execute("SELECT name, hash FROM Inputs").fetchall())
+
+    invalidated = restart or (len(recorded_hashes) != 0 and recorded_hashes != input_hashes)
+
+    if invalidated:
+        if not restart:
+            print("Cluster inputs changed since the last run, clearing the job ledger")
+        with conn:
+            conn.execute("DELETE FROM Stages")
+            conn.execute("DELETE FROM Results")
+
+    if invalidated or current_generation(conn) is None:
+        with conn:
+            conn.execute(
+                "INSERT INTO Generations (started) VALUES (?)", (datetime.now().isoformat(timespec="seconds"),),
+            )
+
+    with conn:
+        conn.execute("DELETE FROM Inputs")
+        conn.executemany("INSERT INTO Inputs VALUES (?, ?)", list(input_hashes.items()))
+
+    return conn
+
+
+def current_generation(conn):
+    """Return int, the generation of the ledger the current outputs belong to, or None for a new ledger"""
+    return conn.execute("SELECT MAX(generation) FROM Generations").fetchone()[0]
+
+
+def hash_files(paths):
+    """Calculate the SHA256 digest of the contents of one or more files
+
+    :param paths: list of Paths
+
+    Return str, hex digest, or None if a file does not exist
+    """
+    digest = hashlib.sha256()
+
+    for path in paths:
+        try:
+            with open(path, "rb") as fh:
+                for chunk in iter(lambda: fh.read(1 << 20), b""):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            return None
+
+    return digest.hexdigest()
+
+
+def stage_done(conn, accession, stage, outputs=()):
+    """Check if a stage was completed and its outputs are unchanged
+
+    :param conn: sqlite3 connection to the ledger
+    :param accession: str, GenBank accession of the protein
+    :param stage: str, name of the stage
+    :param outputs: list of Paths written by the stage
+
+    Return bool
+    """
+    row = conn.execute(
+        "SELECT output_hash FROM Stages WHERE accession = ? AND stage = ?",
+        (accession, stage),
+    ).fetchone()
+
+    if row is None:
+        return False
+
+    if len(outputs) == 0:
+        return True
+
+    return row[0] == hash_files(outputs)
+
+
+def record_stage(conn, accession, stage, outputs=()):
+    """Record that a stage was completed, and invalidate the later stages that depend on it
+
+    :param conn: sqlite3 connection to the ledger
+    :param accession: str, GenBank accession of the protein
+    :param stage: str, name of the stage
+    :param outputs: list of Paths written by the stage
+
+    Return nothing
+    """
+    later_stages = STAGES[STAGES.index(stage) + 1:]
+
+    with conn:
+        conn.executemany(
+            "DELETE FROM Stages WHERE accession = ? AND stage = ?",
+            [(accession, later_stage) for later_stage in later_stages],
+        )
+        conn.execute("DELETE FROM Results WHERE accession = ?", (accession,))
+        conn.execute(
+            "INSERT OR REPLACE INTO Stages VALUES (?, ?, ?, ?)",
+            (
+                accession,
+                stage,
+                hash_files(outputs) if len(outputs) != 0 else None,
+                datetime.now().isoformat(timespec="seconds"),
+            ),
+        )
+
+
+def record_result(conn, accession, result):
+    """Store the LRT result of a protein and mark the protein as complete
+
+    :param conn: sqlite3 connection to the ledger
+    :param accession: str, GenBank accession of the protein
+    :param result: tuple, (p_value, lnl1, np1, lnl0, np0)
+
+    Return nothing
+    """
+    record_stage(conn, accession, "lrt_computed")
+
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO Results VALUES (?, ?, ?, ?, ?, ?)", (accession, *result))
+
+
+def get_result(conn, accession):
+    """Retrieve the stored LRT result of a protein
+
+    :param conn: sqlite3 connection to the ledger
+    :param accession: str, GenBank accession of the protein
+
+    Return tuple (p_value, lnl1, np1, lnl0, np0), or None if the LRT has not been computed
+    """
+    if not stage_done(conn, accession, "lrt_computed"):
+        return None
+
+    return conn.execute(
+        f"SELECT {', '.join(RESULT_COLUMNS)} FROM Results WHERE accession = ?", (accession,),
+    ).fetchone()
+
+
+def record_attempts(conn, accession, model, attempts, fix_blength=None):
+    """Store the outcome and timing of CodeML runs, so time limits can be tuned from past runs
+
+    :param conn: sqlite3 connection to the ledger
+    :param accession: str, GenBank accession of the protein
+    :param model: str, 'alt', 'null' or 'm0'
+    :param attempts: list of dicts, one per CodeML run, keyed by ATTEMPT_COLUMNS
+    :param fix_blength: int, CodeML fix_blength option the runs used
+
+    Return nothing
+    """
+    recorded = datetime.now().isoformat(timespec="seconds")
+    generation = current_generation(conn)
+    columns = ["accession", "model", *ATTEMPT_COLUMNS, "recorded", "generation", "fix_blength"]
+
+    with conn:
+        conn.executemany(
+            f"INSERT INTO Attempts ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            [
+                (
+                    accession,
+                    model,
+                    *[attempt[column] for column in ATTEMPT_COLUMNS],
+                    recorded,
+                    generation,
+                    fix_blength,
+                )
+                for attempt in attempts
+            ],
+        )
+
+
+def count_attempts(conn, accession, model):
+    """Count the CodeML runs recorded for a model in the current generation of the ledger
+
+    :param conn: sqlite3 connection to the ledger
+    :param accession: str, GenBank accession of the protein
+    :param model: str, 'alt' or 'null'
+
+    Return int
+    """
+    return conn.execute(
+        "SELECT COUNT(*) FROM Attempts WHERE accession = ? AND model = ? AND generation = ?",
+        (accession, model, current_generation(conn)),
+    ).fetchone()[0]
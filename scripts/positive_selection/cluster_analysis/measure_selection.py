@@ -42,6 +42,7 @@
 
 
 import argparse
+import random
 import re
 import pandas as pd
 import numpy as np
@@ -54,11 +55,34 @@ from Bio.Phylo.PAML import codeml
 from rpy2.robjects import packages as rpackages
 from tqdm import tqdm
 
+from beb_sites import parse_site_tables, write_sites
+from codeml_runner import CodemlJob, multi_start_model, read_lnl, restart_model, run_model
+from ctl_template import derive_options, read_ctl_template
+from dedup_alignment import load_duplicates
+from job_ledger import (
+    BRANCH_SITE_MODELS,
+    CLUSTER_KEY,
+    count_attempts,
+    current_generation,
+    get_result,
+    open_ledger,
+    record_attempts,
+    record_result,
+    record_stage,
+    stage_done,
+)
+from ng86_prefilter import ng86_from_alignment, screen_proteins, validate_min_omega
+from pipeline_trace import trace_stage
+
 # import R stats package
 rstats = rpackages.importr("stats")
 
 
 SIGNIFICANCE_LEVEL = 0.05
+LNL_TOLERANCE = 0.001  # lnL difference accepted as numerical noise between the alt and null models
+
+# fix_blength used for the alt and null models in each branch length mode
+BLENGTH_MODES = {"estimate": 0, "initial": 1, "fixed": 2}
 
 
 def main():
@@ -70,6 +94,7 @@ def main():
     rerun = []
 
     summary_data = []
+    sites = []  # positively selected sites in significant proteins
 
     cluster_df = pd.read_csv(args.cluster_df_path)
 
@@ -77,83 +102,179 @@ def main():
 
     parent_output_dir = args.cluster_df_path.parent
 
+    cluster_inputs = {
+        "seq_path": args.seq_path, "cluster_tree": args.cluster_tree, "ctl_file": args.ctl_file,
+    }
+
+    # record the progress of each protein, so a restart resumes where the last run stopped
+    ledger = open_ledger(
+        parent_output_dir,
+        cluster_inputs,
+        restart=args.restart,
+        settings={"blength_mode": args.blength_mode} if args.blength_mode != "estimate" else None,
+    )
+
+    # parse the ctl file once, and derive the alt and null models from it
+    ctl_options = read_ctl_template(args.ctl_file)
+    model_options = get_model_options(ctl_options, BLENGTH_MODES[args.blength_mode])
+
+    cluster_tree = args.cluster_tree
+
+    if args.blength_mode != "estimate":
+        # estimate the branch lengths once for the cluster, rather than once per protein
+        with trace_stage("codeml_m0"):
+            cluster_tree = fit_m0(parent_output_dir, ledger, ctl_options, args)
+
+        if cluster_tree is None:
+            print("Could not fit the M0 model to estimate branch lengths, terminating program")
+            sys.exit(1)
+
+        print("Using M0 branch lengths:", cluster_tree)
+
+    # results are only reported for the proteins of the cluster
+    cluster_members = set(cluster_accs)
+
+    # identical seqs were collapsed into a representative, which is tested on their behalf
+    duplicates, duplicate_members = {}, set()
+    if args.member_map is not None:
+        duplicates, duplicate_members = load_duplicates(args.member_map)
+
+        # the representative is the first of the identical seqs in the alignment, which may not be
+        # in the cluster df, so it is tested for the members that are
+        extra_reps = sorted(
+            rep for rep, members in duplicates.items()
+            if rep not in cluster_members and cluster_members.intersection(members)
+        )
+        if len(extra_reps) != 0:
+            print("Testing {} representatives of duplicate cluster proteins that are not in the cluster df".format(
+                len(extra_reps),
+            ))
+            cluster_accs = list(cluster_accs) + extra_reps
+
+    prefiltered = set()  # proteins without pairwise dN/dS signal, which are not tested
+    if args.prefilter or args.prefilter_min_omega is not None:
+        with trace_stage("ng86_prefilter"):
+            if args.prefilter_min_omega is not None:
+                # the signal is gene-wide, so only skip proteins at a threshold that keeps the known positives
+                validation = validate_min_omega(args.prefilter_min_omega)
+                if validation["skip"].any():
+                    print(validation.to_string(index=False))
+                    print("--prefilter_min_omega {} would skip known positives, use at most {:.4f}".format(
+                        args.prefilter_min_omega, validation["signal"].min(),
+                    ))
+                    sys.exit(1)
+
+            names, dn, ds = ng86_from_alignment(args.seq_path)
+            screen = screen_proteins(names, dn, ds, args.prefilter_min_omega)
+
+        screen.to_csv((parent_output_dir/"ng86_prefilter.tsv"), sep="\t", index=False, float_format="%.4f")
+
+        if args.prefilter_min_omega is not None:
+            prefiltered = set(screen.loc[screen["skip"], "accession"]) & set(cluster_accs)
+            print("{}/{} proteins have no pairwise dN/dS >= {}".format(
+                len(prefiltered), len(screen), args.prefilter_min_omega,
+            ))
+
+        # test the proteins with the strongest signal first
+        ranks = {accession: rank for rank, accession in enumerate(screen["accession"])}
+        cluster_accs = sorted(cluster_accs, key=lambda accession: ranks.get(accession, len(ranks)))
+
+    # write proteins to rerun as they are found, so the list survives the run being killed
+    rerun_fh = open((parent_output_dir/"rerun_proteins.out"), "w")
+
+    tested = set()  # representatives with an LRT result
+
     for accession in tqdm(cluster_accs, desc="Parse cluster proteins"):
         if type(accession) is float or accession is None:
             continue
+
+        if accession in duplicate_members:
+            continue  # the result of its representative is used
+
+        if accession in prefiltered:
+            continue
         
         # make output directory for the current working protein
         output_dir = parent_output_dir / accession
         output_dir.mkdir(exist_ok=True)
         print("Made output dir:", output_dir)
 
-        # bring protein of interest to top of MSA
-        msa_path = reorder_msa(args.seq_path, output_dir, accession)
+        alt_output = output_dir / "{}_alt_mdl_output".format(accession)
 
-        print("Reordered MSA in phylip format:", msa_path)
+        result = get_result(ledger, accession)
 
-        # label and write out tree
-        tree_name = accession + '_tree'
-        tree_path = output_dir / tree_name
+        if result is not None:
+            print("Using LRT from previous run:", accession)
 
-        tree_labelled = label_tree(args.cluster_tree, accession, tree_path)
-        print("Generated labelled tree:", tree_path)
-
-        if tree_labelled is False:
-            print("Could not generate tree for {}".format(accession))
-            continue
-            
-        # compile control file for alternative model
-        alt_model_cml, alt_output = prepare_codeml(
-            output_dir,
-            accession,
-            msa_path,
-            tree_path,
-            args,
-            alt=True,
-        )
-
-        print("Running alt model")
-
-        alt_results = alt_model_cml.run(verbose=args.verbose)
-
-        # compile control file for null model
-        null_model_cml, null_output = prepare_codeml(
-            output_dir,
-            accession,
-            msa_path,
-            tree_path,
-            args,
-            null=True,
-        )
-
-        print("Running null model")
-        
-        null_results = null_model_cml.run(verbose=args.verbose)
+        else:
+            result = run_codeml_models(accession, output_dir, ledger, model_options, cluster_tree, args)
 
-        # calculate LRT, the degrees of freedom, and the p-value using chisquared
-        p_value, lnl1, lnl0, np1, np0 = calculate_chisquared(alt_output, null_output)
-        
-        if p_value is None:
+        if result is None:
             print("Error occured when processing {}".format(accession))
             rerun.append(accession)
+            rerun_fh.write("{}\n".format(accession))
+            rerun_fh.flush()
             continue
 
+        p_value, lnl1, np1, lnl0, np0 = result
+        tested.add(accession)
+
+        rep_sites = []
         if p_value <= SIGNIFICANCE_LEVEL:
             print("Positive selection detected:", p_value, accession)
-            positive_selection.append("{}\t{}".format(accession, p_value))
+            if args.sites_store is not None:
+                rep_sites = parse_site_tables(alt_output, accession)
         else:
-            no_positive_selection.append("{}\t{}".format(accession, p_value))
             print("Positive selection NOT detected:", p_value, accession)
 
-        summary_data.append([
-            parent_output_dir,  # name of the cluster
-            accession,
-            p_value,
-            lnl1,
-            np1,
-            lnl0,
-            np0,
-        ])
+        # expand the result of the representative to its duplicates in the cluster
+        for member in [accession] + duplicates.get(accession, []):
+            if member not in cluster_members:
+                continue
+
+            if p_value <= SIGNIFICANCE_LEVEL:
+                positive_selection.append("{}\t{}".format(member, p_value))
+                sites += [(member,) + site[1:] for site in rep_sites]
+            else:
+                no_positive_selection.append("{}\t{}".format(member, p_value))
+
+            summary_data.append([
+                parent_output_dir,  # name of the cluster
+                member,
+                p_value,
+                lnl1,
+                np1,
+                lnl0,
+                np0,
+                accession,  # representative that was tested
+            ])
+
+    rerun_fh.close()
+
+    for rep, members in duplicates.items():
+        if rep not in tested and rep not in prefiltered and cluster_members.intersection([rep] + members):
+            print("No LRT for the duplicate set of {}: {}".format(
+                rep, ", ".join(sorted(cluster_members.intersection([rep] + members))),
+            ))
+
+    if args.multi_start > 1:  # report how much the lnL varied between starting values
+        # only the branch-site runs of this generation of the ledger, not runs on older inputs
+        spread_df = pd.read_sql_query(
+            (
+                "SELECT accession, model, COUNT(*) AS completed_runs, MAX(lnl) AS best_lnl, "
+                "MAX(lnl) - MIN(lnl) AS lnl_spread FROM Attempts WHERE status = 'ok' "
+                "AND generation = ? AND model IN ({}) GROUP BY accession, model"
+            ).format(", ".join("?" * len(BRANCH_SITE_MODELS))),
+            ledger,
+            params=(current_generation(ledger), *BRANCH_SITE_MODELS),
+        )
+        spread_df.to_csv((parent_output_dir/"multi_start_lnl_spread.tsv"), sep="\t", index=False)
+
+    if args.blength_mode != "estimate" and args.validate_blengths > 0:
+        with trace_stage("validate_blengths"):
+            validate_blengths(parent_output_dir, ledger, ctl_options, cluster_inputs, args)
+
+    ledger.close()
 
     with open((parent_output_dir/"positively_selected_proteins.out"), "w") as fh:
         for accession in positive_selection:
@@ -163,27 +284,347 @@ def main():
         for accession in no_positive_selection:
             fh.write("{}\n".format(accession))
 
-    with open((parent_output_dir/"rerun_proteins.out"), "w") as fh:
-        for accession in rerun:
-            fh.write("{}\n".format(accession))
+    if args.prefilter_min_omega is not None:
+        with open((parent_output_dir/"prefiltered_proteins.out"), "w") as fh:
+            for accession in sorted(prefiltered):
+                for member in [accession] + duplicates.get(accession, []):
+                    if member in cluster_members:
+                        fh.write("{}\n".format(member))
+
+    if args.sites_store is not None:
+        write_sites(sites, args.sites_store, parent_output_dir.name)
+        print("Wrote {} sites to {}".format(len(sites), args.sites_store))
 
     if args.summary_df is not None:  # add data to a summary df
-        column_names = ["cluster", "accessions", "p_value", "lnl1", "np1", "lnl0", "np0"]
+        with trace_stage("write_summary"):
+            write_summary(summary_data, args.summary_df)
+
+
+def write_summary(summary_data, summary_df):
+    """Add the results of the cluster to the summary tsv file
+
+    :param summary_data: list of lists, one per protein
+    :param summary_df: Path to summary tsv file, created if it does not exist
+
+    Return nothing
+    """
+    column_names = [
+        "cluster", "accessions", "p_value", "lnl1", "np1", "lnl0", "np0", "representative",
+    ]
+
+    new_data = pd.DataFrame(summary_data, columns=column_names)
+
+    if summary_df.exists():  # add data to existing file
+        summary_tsv = pd.read_csv(summary_df, sep="\t")
+        
+        # drop 'Unamed: 0' column
+        summary_tsv = summary_tsv.drop(['Unnamed: 0'], axis=1)
+
+        data = pd.concat([summary_tsv, new_data], ignore_index=True)
+
+        # a resumed or repeated run replaces the rows written for the cluster previously
+        data["cluster"] = data["cluster"].astype(str)
+        data = data.drop_duplicates(subset=["cluster", "accessions"], keep="last")
+
+    else:
+        data = new_data
+
+    data.to_csv(summary_df, sep="\t")
+
+
+def get_model_options(ctl_options, fix_blength):
+    """Derive the alt and null branch-site models from the ctl file template
+
+    :param ctl_options: read-only mapping of the options in the ctl file
+    :param fix_blength: int, 0: estimate branch lengths, 1: use tree lengths as initial values,
+        2: fix branch lengths at the tree lengths
+
+    Return dict {model: read-only mapping of ctl options}
+    """
+    return {
+        "alt": derive_options(ctl_options, fix_omega=0, fix_blength=fix_blength, Small_Diff=0.45e-6),
+        # the branch-site null model fixes omega of the foreground branch at 1
+        "null": derive_options(
+            ctl_options, fix_omega=1, omega=1, fix_blength=fix_blength, Small_Diff=0.45e-6,
+        ),
+    }
+
+
+def fit_m0(parent_output_dir, ledger, ctl_options, args):
+    """Fit the one-ratio model (M0) to the cluster, and write the tree with its branch lengths
+
+    The branch lengths are shared by the alt and null models of every protein in the cluster.
+
+    :param parent_output_dir: Path to cluster dir
+    :param ledger: sqlite3 connection to the cluster job ledger
+    :param ctl_options: read-only mapping of the options in the ctl file
+    :param args: cmd-line args parser
+
+    Return Path to tree with M0 branch lengths, or None if the model failed
+    """
+    m0_dir = parent_output_dir / "m0"
+    m0_dir.mkdir(exist_ok=True)
+
+    msa_path = m0_dir / "cluster_msa.phylip"
+    m0_output = m0_dir / "m0_mdl_output"
+    m0_tree = m0_dir / "m0_tree"
+
+    if stage_done(ledger, CLUSTER_KEY, "m0_fitted", [m0_output, m0_tree]):
+        print("Using M0 model from previous run")
+        return m0_tree
+
+    fasta2phy(args.seq_path, msa_path)
+
+    m0_job = CodemlJob(
+        working_dir=str(m0_dir),
+        alignment=str(msa_path),
+        tree=str(args.cluster_tree),
+        out_file=str(m0_output),
+        options=derive_options(ctl_options, model=0, NSsites=0, fix_omega=0, fix_blength=0),
+    )
+
+    print("Running M0 model")
+    best_attempt, attempts = run_model(m0_job, m0_dir / "m0_codeml.ctl", args)
+    record_attempts(ledger, CLUSTER_KEY, "m0", attempts, fix_blength=0)
+
+    if best_attempt is None:
+        return None
+
+    tree = read_codeml_tree(m0_output)
+    if tree is None:
+        return None
+
+    with open(m0_tree, "w") as fh:
+        fh.write(tree + "\n")
+
+    record_stage(ledger, CLUSTER_KEY, "m0_fitted", [m0_output, m0_tree])
+
+    return m0_tree
+
+
+def read_codeml_tree(output_file):
+    """Get the tree with the estimated branch lengths, labelled with seq names, from CodeML output
+
+    CodeML writes the tree twice after the tree length, first with the seq numbers and then
+    with the seq names.
+
+    :param output_file: path to CodeML output file
+
+    Return str, Newick tree, or None if not found
+    """
+    with open(output_file, "r") as fh:
+        lines = fh.read().splitlines()
+
+    trees = []
+    after_tree_length = False
+
+    for line in lines:
+        if line.startswith("tree length ="):
+            after_tree_length = True
+        elif after_tree_length and line.startswith("("):
+            trees.append(line)
+            if len(trees) == 2:
+                return re.sub(r"\s+", "", trees[1])
+
+    return None
+
+
+def validate_blengths(parent_output_dir, ledger, ctl_options, cluster_inputs, args):
+    """Compare the LRTs using M0 branch lengths against estimating the branch lengths per protein
+
+    A sample of the proteins tested in this run are rerun with branch lengths estimated by the
+    alt and null models. The runs are recorded in a separate job ledger, so they are resumed too.
 
-        new_data = pd.DataFrame(summary_data, columns=column_names)
+    :param parent_output_dir: Path to cluster dir
+    :param ledger: sqlite3 connection to the cluster job ledger
+    :param ctl_options: read-only mapping of the options in the ctl file
+    :param cluster_inputs: dict {name: Path} of the cluster input files
+    :param args: cmd-line args parser
+
+    Return nothing
+    """
+    validation_dir = parent_output_dir / "blength_validation"
+    validation_dir.mkdir(exist_ok=True)
+
+    tested = [row[0] for row in ledger.execute("SELECT accession FROM Results ORDER BY accession")]
+    sample = random.Random(parent_output_dir.name).sample(tested, min(args.validate_blengths, len(tested)))
+
+    validation_ledger = open_ledger(validation_dir, cluster_inputs, restart=args.restart)
+    full_options = get_model_options(ctl_options, BLENGTH_MODES["estimate"])
+
+    rows = []
+
+    for accession in tqdm(sample, desc="Validate M0 branch lengths"):
+        output_dir = validation_dir / accession
+        output_dir.mkdir(exist_ok=True)
+
+        full_result = get_result(validation_ledger, accession)
+        if full_result is None:
+            full_result = run_codeml_models(
+                accession, output_dir, validation_ledger, full_options, args.cluster_tree, args,
+            )
+        if full_result is None:
+            print("Could not validate {}".format(accession))
+            continue
+
+        m0_result = get_result(ledger, accession)
+
+        row = {"accession": accession}
+        for mode, result, conn, fix_blength in [
+            ("m0", m0_result, ledger, BLENGTH_MODES[args.blength_mode]),
+            ("full", full_result, validation_ledger, BLENGTH_MODES["estimate"]),
+        ]:
+            p_value, lnl1, np1, lnl0, np0 = result
+            row["lrt_{}".format(mode)] = 2 * (lnl1 - lnl0)
+            row["p_value_{}".format(mode)] = p_value
+            row["significant_{}".format(mode)] = p_value <= SIGNIFICANCE_LEVEL
+            # only the alt and null runs of the current outputs, with the branch lengths being compared
+            row["codeml_time_{}".format(mode)] = conn.execute(
+                "SELECT SUM(wall_time) FROM Attempts WHERE accession = ? AND generation = ? "
+                "AND fix_blength = ? AND model IN ({})".format(", ".join("?" * len(BRANCH_SITE_MODELS))),
+                (accession, current_generation(conn), fix_blength, *BRANCH_SITE_MODELS),
+            ).fetchone()[0]
+        rows.append(row)
+
+    validation_ledger.close()
+
+    if len(rows) == 0:
+        return
+
+    report = pd.DataFrame(rows)
+    report["lrt_difference"] = report["lrt_m0"] - report["lrt_full"]
+    report.to_csv((parent_output_dir/"blength_validation.tsv"), sep="\t", index=False)
+
+    agreement = (report["significant_m0"] == report["significant_full"]).mean()
+    speedup = report["codeml_time_full"].sum() / report["codeml_time_m0"].sum()
+    print(
+        "Validated M0 branch lengths for {} proteins: significance agreed for {:.0%}, "
+        "max |LRT difference| {:.3f}, CodeML {:.1f}x faster".format(
+            len(report), agreement, report["lrt_difference"].abs().max(), speedup,
+        )
+    )
 
-        if args.summary_df.exists():  # add data to existing file
-            summary_tsv = pd.read_csv(args.summary_df, sep="\t")
-            
-            # drop 'Unamed: 0' column
-            summary_tsv = summary_tsv.drop(['Unnamed: 0'], axis=1)
 
-            data = pd.concat([summary_tsv, new_data], ignore_index=True)
+def run_codeml_models(accession, output_dir, ledger, model_options, cluster_tree, args):
+    """Run the stages for a protein that were not completed in a previous run
+
+    :param accession: str, GenBank accession of the protein of interest
+    :param output_dir: Path to output dir for the protein
+    :param ledger: sqlite3 connection to the cluster job ledger
+    :param model_options: dict {model: read-only mapping of ctl options}
+    :param cluster_tree: Path to unlabelled tree, with M0 branch lengths if these are used
+    :param args: cmd-line args parser
+
+    Return tuple (p_value, lnl1, np1, lnl0, np0), or None if the LRT could not be calculated
+    """
+    msa_path = output_dir / "{}_msa.phylip".format(accession)
+    msa_outputs = [output_dir / "{}_msa.fasta".format(accession), msa_path]
+
+    if not stage_done(ledger, accession, "msa_prepared", msa_outputs):
+        # bring protein of interest to top of MSA
+        with trace_stage("reorder_msa", accession=accession):
+            msa_path = reorder_msa(args.seq_path, output_dir, accession)
+        record_stage(ledger, accession, "msa_prepared", msa_outputs)
+
+        print("Reordered MSA in phylip format:", msa_path)
+
+    # label and write out tree
+    tree_name = accession + '_tree'
+    tree_path = output_dir / tree_name
+
+    # the unlabelled tree is included, so the tree is relabelled if the M0 branch lengths change
+    if not stage_done(ledger, accession, "tree_labelled", [tree_path, cluster_tree]):
+        with trace_stage("label_tree", accession=accession):
+            tree_labelled = label_tree(cluster_tree, accession, tree_path)
+
+        if tree_labelled is False:
+            print("Could not generate tree for {}".format(accession))
+            return None
 
+        record_stage(ledger, accession, "tree_labelled", [tree_path, cluster_tree])
+        print("Generated labelled tree:", tree_path)
+
+    model_jobs = {}
+
+    for model, stage in [("alt", "alt_done"), ("null", "null_done")]:
+        # compile control file for the model
+        model_job, model_output = prepare_codeml(
+            output_dir,
+            accession,
+            msa_path,
+            tree_path,
+            model_options,
+            model,
+        )
+        model_jobs[model] = model_job
+
+        if model == "alt":
+            alt_output = model_output
         else:
-            data = pd.DataFrame(columns=column_names)
+            null_output = model_output
+
+        if stage_done(ledger, accession, stage, [model_output]):
+            print("Using {} model from previous run".format(model))
+            continue
+
+        print("Running {} model".format(model))
+
+        with trace_stage("codeml_{}".format(model), accession=accession):
+            if args.multi_start > 1:
+                best_attempt, attempts, spread = multi_start_model(model_job, args)
+                print("{} model lnL spread across {} starts: {}".format(model, len(attempts), spread))
+
+            else:
+                ctl_file = output_dir / "{}_{}_codeml.ctl".format(accession, model)
+                best_attempt, attempts = run_model(model_job, ctl_file, args)
+
+        record_attempts(ledger, accession, model, attempts, fix_blength=int(model_job.options["fix_blength"]))
+
+        if best_attempt is None:
+            print("CodeML {} model failed for {} after {} attempts".format(model, accession, len(attempts)))
+            return None
+
+        record_stage(ledger, accession, stage, [model_output])
+
+    # the alt model nests the null model, so a lower lnL means the alt model did not converge
+    lnl1, lnl0 = read_lnl(alt_output), read_lnl(null_output)
+
+    if lnl1 is not None and lnl0 is not None and lnl1 < lnl0 - LNL_TOLERANCE:
+        print("Alt model lnL ({}) < null model lnL ({}), restarting alt model".format(lnl1, lnl0))
+
+        best_attempt, attempts = restart_model(
+            model_jobs["alt"],
+            args,
+            current_lnl=lnl1,
+            first_attempt=count_attempts(ledger, accession, "alt"),
+        )
+        record_attempts(
+            ledger, accession, "alt", attempts, fix_blength=int(model_jobs["alt"].options["fix_blength"]),
+        )
+
+        if best_attempt is not None:
+            record_stage(ledger, accession, "alt_done", [alt_output])
+            record_stage(ledger, accession, "null_done", [null_output])
+            lnl1 = read_lnl(alt_output)
+
+        # a negative LRT is not a valid test, so the protein is rerun rather than reported with p = 1
+        if best_attempt is None or lnl1 is None or lnl1 < lnl0 - LNL_TOLERANCE:
+            print("Alt model lnL ({}) still < null model lnL ({}) after restarts, not calculating LRT".format(
+                lnl1, lnl0,
+            ))
+            return None
 
-        data.to_csv(args.summary_df, sep="\t")
+    # calculate LRT, the degrees of freedom, and the p-value using chisquared
+    with trace_stage("calculate_chisquared", accession=accession):
+        p_value, lnl1, lnl0, np1, np0 = calculate_chisquared(alt_output, null_output)
+
+    if p_value is None:
+        return None
+
+    result = (p_value, lnl1, np1, lnl0, np0)
+    record_result(ledger, accession, result)
+
+    return result
 
 
 def reorder_msa(seq_path, output_dir, accession):
@@ -279,42 +720,31 @@ def label_tree(cluster_tree, accession, labelled_tree_path):
     return True
 
 
-def prepare_codeml(output_dir, accession, msa_path, tree_path, args, alt=False, null=False):
+def prepare_codeml(output_dir, accession, msa_path, tree_path, model_options, model):
     """Prepare CodeML for run
     
     :param output_dir: path to output dir
     :param accession: str, GenBank accession of protein of interest
     :param msa_path: Path to nucleotide MSA
     :param tree_path: path to tree file labelled with the protein of interest
-    :param alt: bool, if true generate ctl file for alternative model
-    :param null: bool, if true generate ctl file for null model
+    :param model_options: dict {model: read-only mapping of ctl options}
+    :param model: str, 'alt' or 'null'
     
-    Return CodeML class instance, and path to the output file
+    Return CodemlJob, and path to the output file
     """
-    if alt:  # generate ctl for alternative model
-        output_path = output_dir / "{}_alt_mdl_output".format(accession)
-        fixed_omega = '0'
-        model='alt'
-
-    if null:  # generate ctl for null model
-        output_path = output_dir / "{}_null_mdl_output".format(accession)
-        fixed_omega = '1'
-        model='null'
+    output_path = output_dir / "{}_{}_mdl_output".format(accession, model)
 
     print("{} output file: {}".format(model, output_path))
 
-    cml = codeml.Codeml()
-
-    cml.read_ctl_file(args.ctl_file)
-    
-    cml.alignment = str(msa_path)
-    cml.tree = str(tree_path)
-    cml.out_file = str(output_path)
-    cml.working_dir = str(output_dir)
-    cml.set_options(fix_omega=fixed_omega)
-    cml.set_options(Small_Diff=0.45e-6)
+    job = CodemlJob(
+        working_dir=str(output_dir),
+        alignment=str(msa_path),
+        tree=str(tree_path),
+        out_file=str(output_path),
+        options=model_options[model],
+    )
 
-    return cml, output_path
+    return job, output_path
 
 
 def calculate_chisquared(alt_model_output, null_model_output):
@@ -333,7 +763,7 @@ def calculate_chisquared(alt_model_output, null_model_output):
     np1 = get_np(alt_model_output)
 
     if lnl1 is None or np1 is None:
-        return None
+        return None, None, None, None, None
 
     null_resuts = codeml.read(null_model_output)
     lnl0 = null_resuts.get("NSsites").get(2).get('lnL')
@@ -341,7 +771,7 @@ def calculate_chisquared(alt_model_output, null_model_output):
     np0 = get_np(null_model_output)
    
     if lnl0 is None or np0 is None:
-        return None
+        return None, None, None, None, None
 
     # calculate delta_LRT
     delta_lrt = 2*(lnl1 - lnl0)
@@ -416,13 +846,123 @@ def build_parser():
         default=None,
         help="Path to write out summary df, or add data to an existing tsv file",
     )
+    parser.add_argument(
+        "--member_map",
+        type=Path,
+        default=None,
+        help=(
+            "Path to tsv file mapping duplicate seqs to their representative (from "
+            "dedup_alignment.py). Only representatives are tested, and their results are "
+            "reported for all members"
+        ),
+    )
+    parser.add_argument(
+        "--sites_store",
+        type=Path,
+        default=None,
+        help=(
+            "Path to dir of the site-level store, to which the NEB/BEB sites of "
+            "significant proteins are written"
+        ),
+    )
+    parser.add_argument(
+        "--codeml",
+        type=str,
+        default="codeml",
+        help="CodeML executable",
+    )
+    parser.add_argument(
+        "--wall_limit",
+        type=int,
+        default=None,
+        help="Max wall-clock time (seconds) of a CodeML run",
+    )
+    parser.add_argument(
+        "--cpu_limit",
+        type=int,
+        default=None,
+        help="Max CPU time (seconds) of a CodeML run",
+    )
+    parser.add_argument(
+        "--stall_limit",
+        type=int,
+        default=3600,
+        help="Kill a CodeML run if it writes nothing for this many seconds",
+    )
+    parser.add_argument(
+        "--max_restarts",
+        type=int,
+        default=4,
+        help="Number of alternative starting omega/kappa values tried when a CodeML run fails",
+    )
+    parser.add_argument(
+        "--multi_start",
+        type=int,
+        default=1,
+        help=(
+            "Run each model from this many initial omega values in parallel, and use the run "
+            "with the greatest lnL"
+        ),
+    )
+    parser.add_argument(
+        "--restart_workers",
+        type=int,
+        default=4,
+        help="Number of restarted or multi-start CodeML runs to run in parallel",
+    )
+    parser.add_argument(
+        "--blength_mode",
+        choices=list(BLENGTH_MODES),
+        default="estimate",
+        help=(
+            "Branch lengths of the alt and null models. 'estimate': estimated for every protein. "
+            "'initial' or 'fixed': fit the one-ratio model (M0) once for the cluster, and use "
+            "its branch lengths as initial values or fix them"
+        ),
+    )
+    parser.add_argument(
+        "--validate_blengths",
+        type=int,
+        default=0,
+        help=(
+            "With --blength_mode initial or fixed, rerun this many proteins with branch "
+            "lengths estimated per protein, and write the LRTs of both to blength_validation.tsv"
+        ),
+    )
+    parser.add_argument(
+        "--prefilter",
+        dest="prefilter",
+        action="store_true",
+        default=False,
+        help=(
+            "Calculate pairwise NG86 dN/dS from the MSA, and test proteins in order of dN/dS "
+            "with their nearest neighbour. All proteins are still tested"
+        ),
+    )
+    parser.add_argument(
+        "--prefilter_min_omega",
+        type=float,
+        default=None,
+        help=(
+            "As --prefilter, and skip proteins with no pairwise dN/dS >= this value. Pairwise "
+            "dN/dS cannot detect episodic selection at a few sites, so the run stops if this "
+            "would skip a known positive (AIE38009.1, RKL00490.1). Default: test all proteins"
+        ),
+    )
+    parser.add_argument(
+        "--restart",
+        dest="restart",
+        action="store_true",
+        default=False,
+        help="Ignore the job ledger of a previous run and process all proteins again",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
         dest="verbose",
         action="store_true",
         default=False,
-        help="Print CodeML progress to terminal",
+        help="Print the status and timing of each CodeML run",
     )
 
 
@@ -430,4 +970,5 @@ def build_parser():
 
 
 if __name__ == "__main__":
-    main()
+    with trace_stage("measure_selection"):
+        main()
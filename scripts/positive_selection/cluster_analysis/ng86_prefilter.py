@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Screen proteins for pairwise dN/dS signal (Nei & Gojobori 1986) before the branch-site tests"""
+
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+from itertools import permutations
+from pathlib import Path
+
+from Bio.Data import CodonTable
+
+from codon_qc import read_alignment
+from pipeline_trace import trace_stage
+
+
+BASES = "ACGT"
+CODONS = [a + b + c for a in BASES for b in BASES for c in BASES]
+GENETIC_CODE = CodonTable.unambiguous_dna_by_id[1].forward_table  # stop codons are not keys
+
+NG86_FILES = {"dn": "2NG.dN", "ds": "2NG.dS", "t": "2NG.t"}
+
+# proteins with significant branch-site LRTs in this study, which a threshold to skip proteins must keep
+KNOWN_POSITIVES = ["AIE38009.1", "RKL00490.1"]
+KNOWN_POSITIVES_DIR = Path(__file__).resolve().parents[3] / "positive_selection_candidates"
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.min_omega is not None:
+        validation = validate_min_omega(args.min_omega, args.known_positives_dir, args.min_ds)
+        print(validation.to_string(index=False))
+        if validation["skip"].any():
+            sys.exit(
+                f"--min_omega {args.min_omega} would skip known positives, "
+                f"use at most {validation['signal'].min():.4f}"
+            )
+
+    if args.input.is_dir():  # use the matrices written by CodeML
+        names, matrices = read_2ng_matrices(args.input)
+        dn, ds = matrices["dn"], matrices["ds"]
+    else:
+        names, dn, ds = ng86_from_alignment(args.input)
+
+    screen = screen_proteins(names, dn, ds, args.min_omega, args.min_ds)
+    screen.to_csv(args.output, sep="\t", index=False, float_format="%.4f")
+
+    print(
+        f"{screen['skip'].sum()}/{len(screen)} proteins flagged to skip, "
+        f"ranked proteins written to {args.output}"
+    )
+
+
+def validate_min_omega(min_omega, known_positives_dir=KNOWN_POSITIVES_DIR, min_ds=0.01):
+    """Screen the known positives at a threshold, to check it would not skip them
+
+    The pairwise dN/dS signal of a protein is gene-wide, so it can miss episodic selection at
+    a few sites, which the branch-site test detects. A threshold is only safe to skip proteins
+    with if it keeps the proteins with significant LRTs in this study.
+
+    :param min_omega: float, threshold below which proteins would be skipped
+    :param known_positives_dir: Path to dir containing a <accession>/<accession>_msa.fasta
+        codon alignment of the cluster of each known positive
+    :param min_ds: float, minimum dS of a pair included in the max dN/dS
+
+    Return pandas df, one row per known positive, with its signal and whether it would be skipped
+    """
+    rows = []
+
+    for accession in KNOWN_POSITIVES:
+        msa_path = known_positives_dir / accession / f"{accession}_msa.fasta"
+        if not msa_path.exists():
+            raise FileNotFoundError(f"Cannot validate --min_omega, no alignment of {accession} at {msa_path}")
+
+        screen = screen_proteins(*ng86_from_alignment(msa_path), min_omega=min_omega, min_ds=min_ds)
+        row = screen.loc[screen["accession"] == accession].iloc[0]
+        rows.append([accession, row["signal"], row["skip"]])
+
+    return pd.DataFrame(rows, columns=["accession", "signal", "skip"])
+
+
+def read_2ng_matrix(matrix_path):
+    """Load a lower-triangular matrix written by CodeML (2NG.dN, 2NG.dS or 2NG.t)
+
+    The file lists the number of seqs, then one row per seq: the seq name followed by the
+    values for the preceding seqs. Negative values (not computable) are loaded as NaN.
+
+    :param matrix_path: Path to matrix file
+
+    Return list of seq names, and symmetric numpy array of floats
+    """
+    with open(matrix_path, "r") as fh:
+        lines = fh.read().split("\n")
+
+    num_seqs = int(lines[0].split()[0])
+    rows = [line.split() for line in lines[1:num_seqs + 1]]
+
+    names = [row[0] for row in rows]
+    values = np.array([value for row in rows for value in row[1:]], dtype=float)
+
+    if len(values) != num_seqs * (num_seqs - 1) // 2:
+        raise ValueError(f"Expected a lower-triangular matrix of {num_seqs} seqs in {matrix_path}")
+
+    values[values < 0] = np.nan
+
+    matrix = np.zeros((num_seqs, num_seqs))
+    lower = np.tril_indices(num_seqs, -1)  # row by row, as written by CodeML
+    matrix[lower] = values
+    matrix.T[lower] = values
+
+    return names, matrix
+
+
+def read_2ng_matrices(codeml_dir):
+    """Load the 2NG.dN, 2NG.dS and 2NG.t matrices written by CodeML in a dir
+
+    :param codeml_dir: Path to CodeML working dir
+
+    Return list of seq names, and dict {'dn', 'ds', 't': numpy array}
+    """
+    matrices = {}
+
+    for name, file_name in NG86_FILES.items():
+        names, matrices[name] = read_2ng_matrix(codeml_dir / file_name)
+
+    return names, matrices
+
+
+def build_ng86_tables():
+    """Count the synonymous sites of each codon, and the differences between each pair of codons
+
+    Differences between codons that differ at more than one position are averaged over the
+    mutational pathways that do not pass through a stop codon (Nei & Gojobori 1986).
+
+    Return numpy arrays: synonymous sites per codon (64), synonymous and nonsynonymous
+        differences per pair of codons (64 x 64). Values for stop codons are NaN.
+    """
+    syn_sites = np.full(64, np.nan)
+    syn_diffs = np.full((64, 64), np.nan)
+    nonsyn_diffs = np.full((64, 64), np.nan)
+
+    for index, codon in enumerate(CODONS):
+        if codon not in GENETIC_CODE:
+            continue
+        synonymous = 0
+        for position in range(3):
+            for base in BASES:
+                mutant = codon[:position] + base + codon[position + 1:]
+                if base != codon[position] and GENETIC_CODE.get(mutant) == GENETIC_CODE[codon]:
+                    synonymous += 1
+        syn_sites[index] = synonymous / 3
+
+    for index1, codon1 in enumerate(CODONS):
+        for index2, codon2 in enumerate(CODONS):
+            if codon1 not in GENETIC_CODE or codon2 not in GENETIC_CODE:
+                continue
+
+            positions = [position for position in range(3) if codon1[position] != codon2[position]]
+            pathway_counts = []
+
+            for order in permutations(positions):
+                steps = [codon1]
+                for position in order:
+                    previous = steps[-1]
+                    steps.append(previous[:position] + codon2[position] + previous[position + 1:])
+
+                if any(step not in GENETIC_CODE for step in steps):
+                    continue  # pathway passes through a stop codon
+
+                synonymous = sum(
+                    GENETIC_CODE[before] == GENETIC_CODE[after] for before, after in zip(steps, steps[1:])
+                )
+                pathway_counts.append((synonymous, len(positions) - synonymous))
+
+            if len(pathway_counts) == 0:
+                continue
+
+            syn_diffs[index1, index2], nonsyn_diffs[index1, index2] = np.mean(pathway_counts, axis=0)
+
+    return syn_sites, syn_diffs, nonsyn_diffs
+
+
+def codon_indices(matrix):
+    """Convert a nucleotide alignment into indices of CODONS
+
+    :param matrix: numpy uint8 array of ASCII codes, sequences x nucleotides
+
+    Return numpy int array, sequences x codons. Codons with gaps or ambiguous bases are -1
+    """
+    lookup = np.full(256, 4, dtype=np.int64)
+    for value, base in enumerate(BASES):
+        lookup[ord(base)] = value
+
+    num_seqs, num_nts = matrix.shape
+    bases = lookup[matrix[:, :num_nts // 3 * 3]].reshape(num_seqs, -1, 3)
+
+    indices = bases[:, :, 0] * 16 + bases[:, :, 1] * 4 + bases[:, :, 2]
+    indices[(bases == 4).any(axis=2)] = -1
+
+    return indices
+
+
+def jukes_cantor(proportion):
+    """Correct a proportion of differences for multiple hits, NaN when saturated"""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return -0.75 * np.log(1 - 4 * proportion / 3)
+
+
+def ng86_from_alignment(alignment_path):
+    """Calculate pairwise NG86 dN and dS from a codon alignment, without running CodeML
+
+    Each seq is compared against all preceding seqs in one batch. Codons with gaps, ambiguous
+    bases or stops are ignored, pairwise.
+
+    :param alignment_path: Path to aligned nucleotide seqs in FASTA format
+
+    Return list of seq names, and symmetric numpy arrays of dN and dS
+    """
+    names, matrix = read_alignment(alignment_path)
+    indices = codon_indices(matrix)
+
+    syn_sites, syn_diffs, nonsyn_diffs = build_ng86_tables()
+
+    # stop codons and gapped/ambiguous codons are both invalid
+    valid = indices >= 0
+    valid[valid] = ~np.isnan(syn_sites[indices[valid]])
+    indices[~valid] = 0
+
+    seq_syn_sites = np.where(valid, syn_sites[indices], 0)
+
+    # flattened 64 x 64 tables, indexed by codon1 * 64 + codon2. Invalid pairs are masked below
+    syn_diffs = np.nan_to_num(syn_diffs).ravel()
+    nonsyn_diffs = np.nan_to_num(nonsyn_diffs).ravel()
+
+    num_seqs = len(names)
+    dn = np.zeros((num_seqs, num_seqs))
+    ds = np.zeros((num_seqs, num_seqs))
+
+    for row in range(1, num_seqs):
+        shared = valid[:row] & valid[row]
+        pairs = indices[row] * 64 + indices[:row]
+
+        sites_syn = 0.5 * ((seq_syn_sites[row] + seq_syn_sites[:row]) * shared).sum(axis=1)
+        sites_nonsyn = 3 * shared.sum(axis=1) - sites_syn
+
+        diffs_syn = (syn_diffs[pairs] * shared).sum(axis=1)
+        diffs_nonsyn = (nonsyn_diffs[pairs] * shared).sum(axis=1)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ds[row, :row] = jukes_cantor(diffs_syn / sites_syn)
+            dn[row, :row] = jukes_cantor(diffs_nonsyn / sites_nonsyn)
+
+    dn += dn.T
+    ds += ds.T
+
+    return names, dn, ds
+
+
+def screen_proteins(names, dn, ds, min_omega=None, min_ds=0.01):
+    """Score the pairwise dN/dS signal of each protein, to rank the proteins for testing
+
+    The nearest neighbour (lowest dS) approximates the terminal branch of the protein, which
+    is the foreground branch in the branch-site test. Pairs with dS below min_ds are too close
+    to give a stable dN/dS, except for the nearest neighbour, where dS = 0 and dN > 0 gives an
+    infinite dN/dS.
+
+    :param names: list of seq names
+    :param dn: symmetric numpy array of pairwise dN
+    :param ds: symmetric numpy array of pairwise dS
+    :param min_omega: float, proteins with no pairwise dN/dS >= min_omega are flagged to skip,
+        or None to flag no proteins. The signal is gene-wide, so a threshold must be checked
+        with validate_min_omega
+    :param min_ds: float, minimum dS of a pair included in the max and median dN/dS
+
+    Return pandas df, one row per protein, ranked by the dN/dS with the nearest neighbour
+    """
+    num_seqs = len(names)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        omega = dn / ds
+    omega[(ds == 0) & (dn == 0)] = 0  # identical seqs
+    np.fill_diagonal(omega, np.nan)
+
+    ds_neighbours = ds.copy()
+    np.fill_diagonal(ds_neighbours, np.inf)
+    ds_neighbours[np.isnan(ds_neighbours)] = np.inf
+    nearest = ds_neighbours.argmin(axis=1)
+    rows = np.arange(num_seqs)
+
+    stable_omega = np.where(ds >= min_ds, omega, np.nan)
+    max_omega = np.fmax.reduce(np.where(np.isnan(stable_omega), -np.inf, stable_omega), axis=1)
+    max_omega[np.isneginf(max_omega)] = np.nan
+
+    screen = pd.DataFrame({
+        "accession": names,
+        "nearest_neighbour": [names[index] for index in nearest],
+        "dn_nearest": dn[rows, nearest],
+        "ds_nearest": ds[rows, nearest],
+        "omega_nearest": omega[rows, nearest],
+        "max_omega": max_omega,
+        "median_omega": pd.DataFrame(stable_omega).median(axis=1, skipna=True).to_numpy(),
+    })
+
+    # NaN (no comparable pairs) is not evidence against selection, so is not skipped
+    screen["signal"] = np.fmax(screen["omega_nearest"], screen["max_omega"])
+    screen["skip"] = screen["signal"] < min_omega if min_omega is not None else False
+
+    return screen.sort_values("omega_nearest", ascending=False, na_position="first", ignore_index=True)
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="ng86_prefilter.py",
+        description="Screen proteins for pairwise dN/dS signal before the branch-site tests",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "input",
+        type=Path,
+        help=(
+            "Path to codon alignment in FASTA format, or a CodeML working dir containing the "
+            "2NG.dN, 2NG.dS and 2NG.t matrices"
+        ),
+    )
+    parser.add_argument(
+        "output",
+        type=Path,
+        help="Path to write out the tsv file of pairwise dN/dS scores",
+    )
+    parser.add_argument(
+        "--min_omega",
+        type=float,
+        default=None,
+        help=(
+            "Flag proteins to skip when no pairwise dN/dS is at least this value, only if the "
+            "known positives are not flagged. Default: flag no proteins"
+        ),
+    )
+    parser.add_argument(
+        "--known_positives_dir",
+        type=Path,
+        default=KNOWN_POSITIVES_DIR,
+        help=f"Path to dir containing the alignments of the known positives ({', '.join(KNOWN_POSITIVES)})",
+    )
+    parser.add_argument(
+        "--min_ds",
+        type=float,
+        default=0.01,
+        help="Min dS of a pair of seqs included in the max and median dN/dS",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    with trace_stage("ng86_prefilter"):
+        main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Build a neighbour-joining tree from JC69 or K80 distances, as a fast alternative to RaxML-ng"""
+
+
+import argparse
+
+import numpy as np
+
+from pathlib import Path
+
+from codon_qc import read_alignment
+from pipeline_trace import trace_stage
+
+
+# one-hot columns of each base, purines and pyrimidines are adjacent so transitions are pairs
+BASES = "AGCT"
+TRANSITIONS = [(0, 1), (1, 0), (2, 3), (3, 2)]
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    names, matrix = read_alignment(args.alignment)
+
+    distances = pairwise_distances(matrix, args.model)
+    tree = neighbour_joining(distances, names)
+
+    with open(args.tree_file, "w") as fh:
+        fh.write(tree + "\n")
+
+    print(f"Wrote NJ tree of {len(names)} seqs ({args.model} distances) to {args.tree_file}")
+
+
+def one_hot(matrix):
+    """Encode an alignment as one boolean matrix per base
+
+    :param matrix: numpy uint8 array of ASCII codes, sequences x nucleotides
+
+    Return numpy float32 array, bases x sequences x nucleotides. Gaps and ambiguous bases
+        are all zero
+    """
+    return np.stack([matrix == ord(base) for base in BASES]).astype(np.float32)
+
+
+def pairwise_distances(matrix, model="k80", max_distance=5.0):
+    """Calculate JC69 or K80 distances between all pairs of seqs
+
+    Sites are compared pairwise, ignoring gaps and ambiguous bases. The counts of identical
+    sites, transitions and compared sites are all matrix products of the one-hot alignment.
+
+    :param matrix: numpy uint8 array of ASCII codes, sequences x nucleotides
+    :param model: str, 'jc69' or 'k80'
+    :param max_distance: float, distance of saturated pairs, or pairs without shared sites
+
+    Return symmetric numpy array of distances
+    """
+    encoded = one_hot(matrix)
+    valid = encoded.sum(axis=0)
+
+    compared = valid @ valid.T
+    identical = sum(encoded[base] @ encoded[base].T for base in range(4))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if model == "jc69":
+            p = 1 - identical / compared
+            distances = -0.75 * np.log(1 - 4 * p / 3)
+
+        else:
+            transitions = sum(encoded[first] @ encoded[second].T for first, second in TRANSITIONS)
+            ts = transitions / compared
+            tv = 1 - identical / compared - ts
+            distances = -0.5 * np.log(1 - 2 * ts - tv) - 0.25 * np.log(1 - 2 * tv)
+
+    distances = np.where(np.isfinite(distances), distances, max_distance).astype(float)
+    distances = np.minimum(np.maximum(distances, 0), max_distance)
+    np.fill_diagonal(distances, 0)
+
+    return distances
+
+
+def neighbour_joining(distances, names):
+    """Build an unrooted tree using the neighbour-joining algorithm (Saitou & Nei 1987)
+
+    A copy of the distance matrix is updated in place, with the joined node replacing the first
+    of the pair and the last active node moved into the place of the second. Negative branch
+    lengths are set to zero.
+
+    :param distances: symmetric numpy array of distances
+    :param names: list of seq names
+
+    Return str, tree in Newick format
+    """
+    distances = distances.astype(float, copy=True)
+    nodes = list(names)
+    active = len(nodes)
+
+    if active < 3:
+        raise ValueError("At least 3 seqs are needed to build a tree")
+
+    totals = distances.sum(axis=1)
+
+    while active > 3:
+        dist = distances[:active, :active]
+        q_matrix = (active - 2) * dist - totals[:active, None] - totals[None, :active]
+        np.fill_diagonal(q_matrix, np.inf)
+
+        first, second = divmod(int(q_matrix.argmin()), active)
+        if first > second:
+            first, second = second, first
+
+        length_first = 0.5 * dist[first, second] + (totals[first] - totals[second]) / (2 * (active - 2))
+        length_first = max(length_first, 0)
+        length_second = max(dist[first, second] - length_first, 0)
+
+        new_distances = 0.5 * (dist[first] + dist[second] - dist[first, second])
+
+        nodes[first] = f"({nodes[first]}:{length_first:.6f},{nodes[second]}:{length_second:.6f})"
+
+        # remove the second node, moving the last active node into its place
+        last = active - 1
+        if second != last:
+            nodes[second] = nodes[last]
+            distances[second, :active] = distances[last, :active]
+            distances[:active, second] = distances[:active, last]
+            distances[second, second] = 0
+            new_distances[second] = new_distances[last]
+        active -= 1
+
+        new_distances[first] = 0
+        distances[first, :active] = new_distances[:active]
+        distances[:active, first] = new_distances[:active]
+        totals[:active] = distances[:active, :active].sum(axis=1)
+
+    dist = distances[:3, :3]
+    lengths = [
+        max(0.5 * (dist[0, 1] + dist[0, 2] - dist[1, 2]), 0),
+        max(0.5 * (dist[0, 1] + dist[1, 2] - dist[0, 2]), 0),
+        max(0.5 * (dist[0, 2] + dist[1, 2] - dist[0, 1]), 0),
+    ]
+
+    return "(" + ",".join(f"{node}:{length:.6f}" for node, length in zip(nodes[:3], lengths)) + ");"
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="nj_tree.py",
+        description="Build a neighbour-joining tree for a cluster, in place of RaxML-ng",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "alignment",
+        type=Path,
+        help="Path to nucleotide MSA in FASTA format",
+    )
+    parser.add_argument(
+        "tree_file",
+        type=Path,
+        help="Path to output file",
+    )
+    parser.add_argument(
+        "--model",
+        choices=["jc69", "k80"],
+        default="k80",
+        help="Substitution model of the pairwise distances",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    with trace_stage("nj_tree"):
+        main()
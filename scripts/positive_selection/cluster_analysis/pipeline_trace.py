@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Record the wall time, CPU time and peak memory of pipeline stages and external tools in a trace file"""
+
+
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+
+TRACE_ENV = "PIPELINE_TRACE"  # path to the trace file, tracing is off when not set
+CLUSTER_ENV = "PIPELINE_CLUSTER"
+CLUSTER_SIZE_ENV = "PIPELINE_CLUSTER_SIZE"
+
+SIZE_BINS = [0, 10, 50, 100, 500, 1000, 5000, float("inf")]
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.subcommand == "run":
+        command = args.command[1:] if args.command[:1] == ["--"] else args.command
+        sys.exit(run_tool(command, args.stage))
+
+    summary = summarise_trace(args.trace)
+    if args.output is not None:
+        summary.to_csv(args.output, sep="\t", index=False, float_format="%.3f")
+    print(summary.head(args.top).to_string(index=False))
+
+
+def record_event(event):
+    """Append an event to the trace file named by the PIPELINE_TRACE environment variable
+
+    :param event: dict, the event, to which the cluster, host and time are added
+
+    Return nothing
+    """
+    trace_path = os.environ.get(TRACE_ENV)
+    if not trace_path:
+        return
+
+    event = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+        "cluster": os.environ.get(CLUSTER_ENV),
+        "cluster_size": int(os.environ[CLUSTER_SIZE_ENV]) if os.environ.get(CLUSTER_SIZE_ENV) else None,
+        **event,
+    }
+
+    # a single write to a file opened in append mode, so processes can share the trace file
+    with open(trace_path, "a") as fh:
+        fh.write(json.dumps(event, default=str) + "\n")
+
+
+@contextmanager
+def trace_stage(name, **fields):
+    """Record the wall time, CPU time (including child processes) and peak RSS of a block of code
+
+    Peak RSS is the high-water mark of the process (or its largest child) when the stage ends.
+    On Linux the peak RSS of a child process includes the memory of its parent when it was forked.
+
+    :param name: str, name of the stage
+    :param fields: additional fields to add to the event, e.g. accession
+
+    Return nothing
+    """
+    if not os.environ.get(TRACE_ENV):
+        yield
+        return
+
+    start_wall = time.perf_counter()
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    status = "ok"
+
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        end_self = resource.getrusage(resource.RUSAGE_SELF)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        cpu_time = sum(
+            getattr(end, field) - getattr(start, field)
+            for start, end in [(start_self, end_self), (start_children, end_children)]
+            for field in ["ru_utime", "ru_stime"]
+        )
+
+        record_event({
+            "type": "stage",
+            "name": name,
+            "status": status,
+            "wall_time": round(time.perf_counter() - start_wall, 4),
+            "cpu_time": round(cpu_time, 4),
+            "peak_rss_mb": round(max(end_self.ru_maxrss, end_children.ru_maxrss) / 1024, 1),
+            **fields,
+        })
+
+
+def record_tool(tool, stage, wall_time, rusage, returncode, **fields):
+    """Record a finished external tool process in the trace file
+
+    :param tool: str, name of the tool
+    :param stage: str, name of the pipeline stage the tool was run for
+    :param wall_time: float, seconds
+    :param rusage: resource usage of the process, from os.wait4
+    :param returncode: int, exit status of the process
+    :param fields: additional fields to add to the event
+
+    Return nothing
+    """
+    record_event({
+        "type": "tool",
+        "name": stage if stage is not None else tool,
+        "tool": tool,
+        "status": "ok" if returncode == 0 else "error",
+        "returncode": returncode,
+        "wall_time": round(wall_time, 4),
+        "cpu_time": round(rusage.ru_utime + rusage.ru_stime, 4),
+        "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+        **fields,
+    })
+
+
+def run_tool(command, stage=None, stdout=None, **fields):
+    """Run an external tool, passing through its stderr, and record its resource use
+
+    :param command: list of str, the tool and its arguments
+    :param stage: str, name of the pipeline stage, or None to use the name of the tool
+    :param stdout: file object or subprocess.DEVNULL to redirect stdout to, or None to pass through
+    :param fields: additional fields to add to the event
+
+    Return int, exit status of the tool
+    """
+    tool = os.path.basename(command[0])
+
+    start = time.perf_counter()
+    try:
+        proc = subprocess.Popen(command, stdout=stdout)
+    except FileNotFoundError:
+        print(f"Could not find {tool}", file=sys.stderr)
+        return 127
+
+    _, wait_status, rusage = os.wait4(proc.pid, 0)
+    returncode = os.waitstatus_to_exitcode(wait_status)
+    proc.returncode = returncode  # the process was reaped by os.wait4
+
+    record_tool(tool, stage, time.perf_counter() - start, rusage, returncode, **fields)
+
+    return returncode
+
+
+def summarise_trace(trace_path):
+    """Summarise the trace file by stage or tool, and cluster size
+
+    :param trace_path: Path to trace file
+
+    Return pandas df, ordered by total wall time
+    """
+    # imported here to keep the memory of the tool wrapper, which child processes inherit, small
+    import pandas as pd
+
+    trace = pd.read_json(trace_path, lines=True)
+
+    if "cluster_size" not in trace.columns:
+        trace["cluster_size"] = None
+    trace["cluster_size"] = pd.to_numeric(trace["cluster_size"], errors="coerce")
+
+    trace["size_bin"] = pd.cut(trace["cluster_size"], SIZE_BINS, right=True).astype(str)
+
+    summary = trace.groupby(["type", "name", "size_bin"], dropna=False).agg(
+        events=("wall_time", "size"),
+        clusters=("cluster", "nunique"),
+        total_wall=("wall_time", "sum"),
+        mean_wall=("wall_time", "mean"),
+        max_wall=("wall_time", "max"),
+        total_cpu=("cpu_time", "sum"),
+        max_rss_mb=("peak_rss_mb", "max"),
+        errors=("status", lambda status: (status != "ok").sum()),
+    ).reset_index()
+
+    # CPU time / wall time approximates the number of cores used
+    summary["mean_cores"] = summary["total_cpu"] / summary["total_wall"].where(summary["total_wall"] > 0)
+
+    # stages contain the tools they run, so only tools are compared with the total tool time
+    for event_type in ["stage", "tool"]:
+        is_type = summary["type"] == event_type
+        summary.loc[is_type, "wall_fraction"] = (
+            summary.loc[is_type, "total_wall"] / summary.loc[is_type, "total_wall"].sum()
+        )
+
+    return summary.sort_values("total_wall", ascending=False)
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="pipeline_trace.py",
+        description="Run and trace external tools, or summarise a pipeline trace file",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    run_parser = subparsers.add_parser(
+        "run",
+        help=f"Run an external tool and record it in the trace file named by ${TRACE_ENV}",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    run_parser.add_argument(
+        "--stage",
+        type=str,
+        default=None,
+        help="Name of the pipeline stage, defaults to the name of the tool",
+    )
+    run_parser.add_argument(
+        "command",
+        nargs=argparse.REMAINDER,
+        help="The tool and its arguments, after '--'",
+    )
+
+    summarise_parser = subparsers.add_parser(
+        "summarise",
+        help="Report the stages and tools that take the most time, by cluster size",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    summarise_parser.add_argument(
+        "trace",
+        type=Path,
+        help="Path to trace file",
+    )
+    summarise_parser.add_argument(
+        "--output",
+        type=Path,
+        default=None,
+        help="Path to write out the full summary as a tsv file",
+    )
+    summarise_parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="Number of rows of the summary to print",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
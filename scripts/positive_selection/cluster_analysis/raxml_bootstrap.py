@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Run RaxML-ng bootstrap replicates as seed-shards across the available cores, and merge the shards"""
+
+
+import argparse
+import math
+import os
+import re
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from job_ledger import hash_files
+from pipeline_trace import run_tool, trace_stage
+
+
+BOOTSTRAP_REGEX = re.compile(r"Bootstrap tree #(\d+), logLikelihood: (-?\d+(?:\.\d+)?)")
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    shards = plan_shards(args.bs_trees, args.seed, args.shards, args.threads, args.cores)
+    print(f"Running {args.bs_trees} bootstrap trees in {len(shards)} shards")
+
+    shard_dir = Path(f"{args.prefix}_shards")
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    workers = max(1, args.cores // args.threads)
+    msa_hash = hash_files([args.msa])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        returncodes = list(executor.map(
+            lambda shard: run_shard(shard, shard_dir, msa_hash, args),
+            shards,
+        ))
+
+    failed = [shard["index"] for shard, returncode in zip(shards, returncodes) if returncode != 0]
+    if failed:
+        raise SystemExit(f"RaxML-ng failed for bootstrap shards {failed}, rerun to retry them")
+
+    num_trees = merge_shards(
+        [shard_dir / f"shard_{shard['index']}" for shard in shards],
+        Path(f"{args.prefix}.raxml.bootstraps"),
+        Path(f"{args.prefix}.raxml.log"),
+    )
+
+    print(f"Merged {num_trees} bootstrap trees into {args.prefix}.raxml.bootstraps")
+
+
+def plan_shards(bs_trees, seed, num_shards=None, threads=3, cores=None):
+    """Split the bootstrap replicates into shards, each run with its own seed
+
+    :param bs_trees: int, total number of bootstrap trees
+    :param seed: int, seed of the first shard, subsequent shards use seed + shard index
+    :param num_shards: int, number of shards, or None to use one shard per 'threads' cores
+    :param threads: int, RaxML-ng threads per shard
+    :param cores: int, number of cores available, or None for all cores
+
+    Return list of dicts {'index', 'bs_trees', 'seed'}
+    """
+    if num_shards is None:
+        num_shards = max(1, (cores or os.cpu_count() or 1) // threads)
+    num_shards = min(num_shards, bs_trees)
+
+    shard_size = math.ceil(bs_trees / num_shards)
+    shards = []
+
+    for index in range(num_shards):
+        shard_trees = min(shard_size, bs_trees - index * shard_size)
+        if shard_trees <= 0:
+            break
+        shards.append({"index": index, "bs_trees": shard_trees, "seed": seed + index})
+
+    return shards
+
+
+def count_lines(path):
+    """Count the lines in a file, reading it in chunks. Return 0 if the file does not exist"""
+    try:
+        with open(path, "rb") as fh:
+            return sum(chunk.count(b"\n") for chunk in iter(lambda: fh.read(1 << 20), b""))
+    except FileNotFoundError:
+        return 0
+
+
+def get_shard_key(shard, msa_hash, model):
+    """Return str, the inputs of a shard, written to its marker file once the shard is complete"""
+    return f"msa={msa_hash}\tmodel={model}\tseed={shard['seed']}\tbs_trees={shard['bs_trees']}\n"
+
+
+def run_shard(shard, shard_dir, msa_hash, args):
+    """Run RaxML-ng for a shard, unless it was completed in a previous run with the same inputs
+
+    A marker file recording the MSA hash, model, seed and number of trees is written once the shard
+    completes, so the shard is rerun if any of these change.
+
+    :param shard: dict {'index', 'bs_trees', 'seed'}
+    :param shard_dir: Path to dir of the shard output
+    :param msa_hash: str, SHA256 digest of the MSA
+    :param args: cmd-line args parser
+
+    Return int, exit status of RaxML-ng
+    """
+    prefix = shard_dir / f"shard_{shard['index']}"
+    bootstraps = Path(f"{prefix}.raxml.bootstraps")
+    marker = Path(f"{prefix}.done")
+    shard_key = get_shard_key(shard, msa_hash, args.model)
+
+    if (
+        marker.exists()
+        and marker.read_text() == shard_key
+        and count_lines(bootstraps) == shard["bs_trees"]
+        and Path(f"{prefix}.raxml.log").exists()
+    ):
+        print(f"Using bootstrap shard {shard['index']} from previous run")
+        return 0
+
+    marker.unlink(missing_ok=True)
+
+    command = [
+        args.raxml,
+        "--bootstrap",
+        "--msa", str(args.msa),
+        "--model", args.model,
+        "--threads", str(args.threads),
+        "--seed", str(shard["seed"]),
+        "--bs-trees", str(shard["bs_trees"]),
+        "--prefix", str(prefix),
+        "--redo",  # overwrite the output of an incomplete run
+    ]
+
+    returncode = run_tool(
+        command,
+        stage="raxml_bootstrap_shard",
+        stdout=subprocess.DEVNULL,
+        shard=shard["index"],
+        bs_trees=shard["bs_trees"],
+    )
+
+    if returncode == 0:
+        marker.write_text(shard_key)
+
+    return returncode
+
+
+def merge_shards(shard_prefixes, bootstraps_path, log_path):
+    """Merge the bootstrap trees and logs of the shards, renumbering the trees consecutively
+
+    The files are streamed line by line, so the trees are never all held in memory. Tree n of a
+    shard becomes tree (n + number of trees in the preceding shards), which is also its line
+    number in the merged bootstraps file.
+
+    :param shard_prefixes: list of Paths, RaxML-ng prefixes of the shards, in order
+    :param bootstraps_path: Path to write the merged bootstrap trees to
+    :param log_path: Path to write the merged log to
+
+    Return int, total number of trees
+    """
+    offset = 0
+    temp_bootstraps = Path(f"{bootstraps_path}.tmp")
+    temp_log = Path(f"{log_path}.tmp")
+
+    with open(temp_bootstraps, "w") as trees_out, open(temp_log, "w") as log_out:
+        log_out.write(f"Merged RaxML-ng bootstrap log of {len(shard_prefixes)} shards\n")
+
+        for shard_index, prefix in enumerate(shard_prefixes):
+            shard_trees = 0
+            with open(f"{prefix}.raxml.bootstraps", "r") as fh:
+                for tree in fh:
+                    if tree.strip():
+                        trees_out.write(tree if tree.endswith("\n") else tree + "\n")
+                        shard_trees += 1
+
+            logged_trees = 0
+            with open(f"{prefix}.raxml.log", "r") as fh:
+                for line in fh:
+                    # several trees can be logged on one line when workers write at the same time
+                    for tree_number, loglikelihood in BOOTSTRAP_REGEX.findall(line):
+                        log_out.write(
+                            f"[shard {shard_index}] Bootstrap tree #{offset + int(tree_number)}, "
+                            f"logLikelihood: {loglikelihood}\n"
+                        )
+                        logged_trees += 1
+
+            if logged_trees != shard_trees:
+                print(f"Warning: shard {shard_index} logged {logged_trees} trees but wrote {shard_trees}")
+
+            offset += shard_trees
+
+    temp_bootstraps.replace(bootstraps_path)
+    temp_log.replace(log_path)
+
+    return offset
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="raxml_bootstrap.py",
+        description="Run RaxML-ng bootstrap replicates in parallel shards and merge the results",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    # Add positional arguments to parser
+
+    # Add path to input files
+    parser.add_argument(
+        "--msa",
+        type=Path,
+        required=True,
+        help="Path to nucleotide MSA",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        required=True,
+        help="Substitution model",
+    )
+    parser.add_argument(
+        "--prefix",
+        type=str,
+        required=True,
+        help=(
+            "Prefix of the merged output files (<prefix>.raxml.bootstraps and <prefix>.raxml.log). "
+            "Shards are written to <prefix>_shards/"
+        ),
+    )
+    parser.add_argument(
+        "--bs-trees",
+        dest="bs_trees",
+        type=int,
+        default=100,
+        help="Total number of bootstrap trees",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=38745,
+        help="Seed of the first shard, shard i uses seed + i",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=3,
+        help="RaxML-ng threads per shard",
+    )
+    parser.add_argument(
+        "--cores",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of cores to spread the shards over",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=None,
+        help="Number of shards. Default: one per --threads cores",
+    )
+    parser.add_argument(
+        "--raxml",
+        type=str,
+        default="raxml-ng",
+        help="RaxML-ng executable",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    with trace_stage("raxml_bootstrap"):
+        main()
@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2022
+# (c) University of Strathclyde 2022
+# (c) James Hutton Institute 2022
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Map positively selected sites onto the top-ranked ColabFold/AlphaFold model of each protein"""
+
+
+import argparse
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from Bio import SeqIO
+from Bio.Align import PairwiseAligner
+from Bio.Seq import Seq
+from tqdm import tqdm
+
+from beb_sites import query_sites
+from pipeline_trace import trace_stage
+
+
+THREE_TO_ONE = {
+    "ALA": "A", "ARG": "R", "ASN": "N", "ASP": "D", "CYS": "C", "GLN": "Q", "GLU": "E",
+    "GLY": "G", "HIS": "H", "ILE": "I", "LEU": "L", "LYS": "K", "MET": "M", "PHE": "F",
+    "PRO": "P", "SER": "S", "THR": "T", "TRP": "W", "TYR": "Y", "VAL": "V",
+}
+STOP_CODONS = [b"TAA", b"TAG", b"TGA"]
+CONTACT_RADIUS = 10.0  # Angstrom, used to count neighbouring residues
+INDEX_FILE = "index.tsv"
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.subcommand == "index":
+        build_structure_store(
+            args.candidates_dir,
+            args.structure_store,
+            args.cleandata,
+            args.force,
+            args.position_maps,
+        )
+
+    else:
+        annotated_df = annotate_sites(
+            args.structure_store, args.sites_store, args.method, args.min_prob,
+        )
+        annotated_df.to_csv(args.output, sep="\t", index=False, float_format="%.4g")
+        print(f"Wrote structural context for {len(annotated_df)} sites to {args.output}")
+
+
+def build_structure_store(candidates_dir, structure_store, cleandata, force=False, position_maps_path=None):
+    """Parse the top-ranked model and MSA of each protein once into a per-residue array store
+
+    :param candidates_dir: Path to dir containing one dir per protein (named by accession), each
+        containing the protein's MSA and an alphafold dir of ColabFold output
+    :param structure_store: Path to dir to write the per-residue arrays to
+    :param cleandata: bool, CodeML cleandata option, if True codon columns containing gaps,
+        ambiguous nucleotides or stop codons were removed by CodeML
+    :param force: bool, reparse models that are already in the store
+    :param position_maps_path: Path to tsv file listing the position map written by codon_qc.py
+        and the unfiltered alignment of each protein whose MSA was filtered, else None
+
+    Return nothing
+    """
+    structure_store.mkdir(exist_ok=True, parents=True)
+
+    position_maps = {}
+    if position_maps_path is not None:
+        position_maps = load_position_maps(position_maps_path)
+
+    index_rows = []
+
+    for accession_dir in tqdm(sorted(candidates_dir.iterdir()), desc="Indexing models"):
+        if not accession_dir.is_dir():
+            continue
+
+        accession = accession_dir.name
+        msa_path = accession_dir / f"{accession}_msa.fasta"
+        pdb_paths = sorted(accession_dir.glob("alph*/*_unrelaxed_rank_001_*.pdb"))
+
+        if len(pdb_paths) == 0 or not msa_path.exists():
+            continue
+
+        pdb_path = pdb_paths[0]
+        scores_paths = sorted(pdb_path.parent.glob("*_scores_rank_001_*.json"))
+        scores_path = scores_paths[0] if len(scores_paths) != 0 else None
+
+        store_path = structure_store / f"{accession}.npz"
+        index_rows.append([accession, store_path.name, str(pdb_path), str(msa_path)])
+
+        sources = [pdb_path, msa_path] + ([scores_path] if scores_path is not None else [])
+        position_map, full_seq, map_sources = position_maps.get(accession, (None, None, []))
+        sources += map_sources
+        if (
+            not force
+            and store_path.exists()
+            and store_path.stat().st_mtime >= max(path.stat().st_mtime for path in sources)
+        ):
+            continue  # already parsed
+
+        residues = parse_model(pdb_path, scores_path, accession)
+        mapping = map_sites_to_structure(
+            msa_path,
+            residues["residue_names"],
+            cleandata,
+            position_map,
+            full_seq,
+        )
+
+        temp_path = structure_store / f"{accession}.tmp.npz"
+        np.savez(temp_path, **residues, **mapping)
+        temp_path.replace(store_path)
+
+    index_df = pd.DataFrame(index_rows, columns=["accession", "store_file", "pdb", "msa"])
+    index_df.to_csv(structure_store / INDEX_FILE, sep="\t", index=False)
+
+    print(f"Indexed {len(index_df)} models in {structure_store}")
+
+
+def load_position_maps(position_maps_path):
+    """Load the position map and unfiltered seq of each protein whose MSA was filtered by codon_qc.py
+
+    Proteins from the same cluster share a position map and unfiltered alignment, so each file
+    is only read once.
+
+    :param position_maps_path: Path to tsv file with the columns 'accession', 'position_map' (Path
+        to the position map written by codon_qc.py for the cluster of the protein) and
+        'full_alignment' (Path to the cluster alignment before filtering)
+
+    Return dict {accession: (numpy array of original codon columns (0-based), str of the aligned
+        unfiltered seq, list of Paths to the source files)}
+    """
+    manifest_df = pd.read_csv(position_maps_path, sep="\t", dtype=str)
+
+    maps, alignments = {}, {}
+    position_maps = {}
+
+    for accession, map_path, alignment_path in manifest_df[
+        ["accession", "position_map", "full_alignment"]
+    ].itertuples(index=False):
+        if map_path not in maps:
+            maps[map_path] = pd.read_csv(map_path, sep="\t")["original_codon"].to_numpy() - 1
+        if alignment_path not in alignments:
+            alignments[alignment_path] = {
+                record.id: str(record.seq) for record in SeqIO.parse(alignment_path, "fasta")
+            }
+
+        if accession not in alignments[alignment_path]:
+            sys.exit(
+                f"{accession} is not in {alignment_path}, the unfiltered alignment listed for it "
+                f"in {position_maps_path}"
+            )
+
+        position_maps[accession] = (
+            maps[map_path], alignments[alignment_path][accession], [Path(map_path), Path(alignment_path)],
+        )
+
+    return position_maps
+
+
+def parse_model(pdb_path, scores_path=None, accession=None):
+    """Parse per-residue data from a PDB file and its ColabFold scores JSON file
+
+    The scores cover every residue of the modelled seq, so they are matched to the residues with
+    a CA atom in the PDB file by residue number.
+
+    :param pdb_path: Path to PDB file
+    :param scores_path: Path to ColabFold scores JSON file, or None
+    :param accession: str, accession of the protein, used in warnings
+
+    Return dict of numpy arrays, one element per residue
+    """
+    residue_numbers, residue_names, plddt = [], [], []
+    ca_coords, cb_coords = {}, {}
+
+    with open(pdb_path, "r") as fh:
+        for line in fh:
+            if line.startswith("ENDMDL"):
+                break  # only use the first model
+            if not line.startswith("ATOM"):
+                continue
+
+            atom = line[12:16].strip()
+            if atom not in ("CA", "CB"):
+                continue
+
+            residue_number = int(line[22:26])
+            coords = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+
+            if atom == "CA":
+                residue_numbers.append(residue_number)
+                residue_names.append(THREE_TO_ONE.get(line[17:20], "X"))
+                plddt.append(float(line[60:66]))  # ColabFold writes pLDDT to the B-factor column
+                ca_coords[residue_number] = coords
+            else:
+                cb_coords[residue_number] = coords
+
+    residue_numbers = np.array(residue_numbers, dtype=np.int32)
+    ca = np.array([ca_coords[num] for num in residue_numbers], dtype=np.float32)
+    # use the CA for glycine, which has no CB
+    cb = np.array([cb_coords.get(num, ca_coords[num]) for num in residue_numbers], dtype=np.float32)
+
+    contact_number = count_contacts(cb, CONTACT_RADIUS)
+    contact_range = max(contact_number.max() - contact_number.min(), 1)
+    relative_exposure = 1 - (contact_number - contact_number.min()) / contact_range
+
+    mean_pae = np.full(len(residue_numbers), np.nan, dtype=np.float32)
+    if scores_path is not None:
+        with open(scores_path, "r") as fh:
+            scores = json.load(fh)
+        pae = np.asarray(scores.get("pae", []), dtype=np.float32)
+        json_plddt = np.asarray(scores.get("plddt", []), dtype=np.float32)
+
+        if pae.ndim == 2 and pae.shape[0] != len(residue_numbers):
+            print(
+                f"Warning: PAE of {accession or pdb_path} covers {pae.shape[0]} residues, "
+                f"but {len(residue_numbers)} residues have a CA atom, matching them by residue number"
+            )
+
+        # residues are numbered from 1 in ColabFold models
+        if pae.ndim == 2 and residue_numbers.min() >= 1 and residue_numbers.max() <= pae.shape[0]:
+            mean_pae = pae.mean(axis=1)[residue_numbers - 1]
+        elif pae.ndim == 2:
+            print(
+                f"Warning: residue numbers of {accession or pdb_path} do not fit the PAE, mean PAE not recorded"
+            )
+
+        if len(json_plddt) != 0 and residue_numbers.min() >= 1 and residue_numbers.max() <= len(json_plddt):
+            plddt = json_plddt[residue_numbers - 1]
+
+    return {
+        "residue_numbers": residue_numbers,
+        "residue_names": np.array(residue_names, dtype="U1"),
+        "ca": ca,
+        "plddt": np.asarray(plddt, dtype=np.float32),
+        "contact_number": contact_number.astype(np.int16),
+        "relative_exposure": relative_exposure.astype(np.float32),
+        "mean_pae": mean_pae,
+    }
+
+
+def count_contacts(coords, radius):
+    """Count the residues within a radius of each residue, a proxy for solvent exposure
+
+    :param coords: numpy array (residues x 3)
+    :param radius: float, radius in Angstrom
+
+    Return numpy array of contact numbers
+    """
+    diff = coords[:, np.newaxis, :] - coords[np.newaxis, :, :]
+    sq_dist = np.einsum("ijk,ijk->ij", diff, diff)
+    return (sq_dist <= radius ** 2).sum(axis=1) - 1  # exclude the residue itself
+
+
+def map_sites_to_structure(msa_path, structure_seq, cleandata, position_map=None, full_seq=None):
+    """Build the index from CodeML site numbers to residues in the structure
+
+    The protein of interest is the first sequence in the MSA written by measure_selection.py.
+
+    :param msa_path: Path to codon MSA in FASTA format
+    :param structure_seq: array of one-letter residue names in the structure
+    :param cleandata: bool, CodeML cleandata option
+    :param position_map: numpy array of the original codon column (0-based) of each column in
+        the MSA, if codon columns were removed by codon_qc.py, else None
+    :param full_seq: str, aligned seq of the protein of interest in the unfiltered alignment,
+        required with position_map
+
+    Return dict of numpy arrays:
+        site_to_residue: residue number in the ungapped protein (1-based, -1 if gapped) for each
+            CodeML site (0-based index = site - 1)
+        residue_to_structure: index into the structure arrays (-1 if not modelled) for each
+            residue in the ungapped protein (0-based index = residue number - 1)
+    """
+    seqs = [str(record.seq).upper() for record in SeqIO.parse(msa_path, "fasta")]
+    n_codons = len(seqs[0]) // 3
+
+    codons = np.array(
+        [np.frombuffer(seq[:n_codons * 3].encode(), dtype="S3") for seq in seqs]
+    )  # sequences x codons
+
+    foreground = codons[0]
+    foreground_gap = foreground == b"---"
+
+    if cleandata:
+        is_nt = np.isin(
+            np.frombuffer(b"".join(codons.ravel()), dtype="S1"), [b"A", b"C", b"G", b"T"],
+        ).reshape(codons.shape[0], n_codons, 3).all(axis=2)
+        is_stop = np.isin(codons, STOP_CODONS)
+        kept_columns = np.flatnonzero((is_nt & ~is_stop).all(axis=0))
+    else:
+        kept_columns = np.arange(n_codons)
+
+    if position_map is not None and full_seq is None:
+        raise ValueError(f"No unfiltered seq given for the position map of {msa_path}")
+
+    if position_map is not None:  # number the residues using the unfiltered alignment
+        kept_columns = position_map[kept_columns]
+        foreground = np.frombuffer(full_seq[:len(full_seq) // 3 * 3].upper().encode(), dtype="S3")
+        foreground_gap = foreground == b"---"
+
+    residue_numbers = np.cumsum(~foreground_gap).astype(np.int32)
+    residue_numbers[foreground_gap] = -1
+    site_to_residue = residue_numbers[kept_columns]
+
+    protein_seq = str(Seq("".join(
+        codon.decode() for codon in foreground[~foreground_gap]
+    )).translate())
+
+    residue_to_structure = align_to_structure(protein_seq, "".join(structure_seq))
+
+    return {"site_to_residue": site_to_residue, "residue_to_structure": residue_to_structure}
+
+
+def align_to_structure(protein_seq, structure_seq):
+    """Align the protein sequence to the modelled sequence, e.g. when the signal peptide was not modelled
+
+    :param protein_seq: str, translated protein sequence
+    :param structure_seq: str, sequence of the residues in the structure
+
+    Return numpy array, index into the structure for each protein residue (-1 if not modelled)
+    """
+    residue_to_structure = np.full(len(protein_seq), -1, dtype=np.int32)
+
+    if protein_seq == structure_seq:
+        residue_to_structure[:] = np.arange(len(protein_seq))
+        return residue_to_structure
+
+    aligner = PairwiseAligner()
+    aligner.mode = "global"
+    aligner.match_score = 2
+    aligner.mismatch_score = -1
+    aligner.open_gap_score = -5
+    aligner.extend_gap_score = -0.5
+    aligner.end_gap_score = 0  # unmodelled termini are not penalised
+
+    alignment = aligner.align(protein_seq, structure_seq)[0]
+
+    for (prot_start, prot_end), (struct_start, struct_end) in zip(*alignment.aligned):
+        residue_to_structure[prot_start:prot_end] = np.arange(struct_start, struct_end)
+
+    return residue_to_structure
+
+
+def annotate_sites(structure_store, sites_store, method, min_prob):
+    """Add the structural context of each site in the site-level store
+
+    :param structure_store: Path to dir of per-residue arrays
+    :param sites_store: Path to the site-level store written by beb_sites.py
+    :param method: str, 'BEB' or 'NEB'
+    :param min_prob: float, minimum posterior probability of w > 1
+
+    Return pandas df
+    """
+    index_df = pd.read_csv(structure_store / INDEX_FILE, sep="\t")
+    sites_df = query_sites(
+        sites_store, accessions=list(index_df["accession"]), method=method, min_prob=min_prob,
+    )
+    sites_df["accession"] = sites_df["accession"].astype(str)
+
+    store_files = dict(zip(index_df["accession"], index_df["store_file"]))
+
+    annotated = []
+
+    for accession, acc_sites in sites_df.groupby("accession", sort=False):
+        with np.load(structure_store / store_files[accession]) as store:
+            arrays = {key: store[key] for key in store.files}
+
+        sites = acc_sites["site"].to_numpy() - 1
+        in_range = (sites >= 0) & (sites < len(arrays["site_to_residue"]))
+
+        residues = np.full(len(sites), -1, dtype=np.int32)
+        residues[in_range] = arrays["site_to_residue"][sites[in_range]]
+
+        structure_index = np.full(len(sites), -1, dtype=np.int32)
+        modelled = residues > 0
+        structure_index[modelled] = arrays["residue_to_structure"][residues[modelled] - 1]
+        in_structure = structure_index >= 0
+
+        acc_sites = acc_sites.copy()
+        acc_sites["residue_number"] = residues
+        for column, key in [
+            ("structure_residue_number", "residue_numbers"),
+            ("structure_residue", "residue_names"),
+            ("plddt", "plddt"),
+            ("contact_number", "contact_number"),
+            ("relative_exposure", "relative_exposure"),
+            ("mean_pae", "mean_pae"),
+        ]:
+            if key == "residue_names":
+                values = np.full(len(sites), None, dtype=object)
+            else:
+                values = np.full(len(sites), np.nan)
+            values[in_structure] = arrays[key][structure_index[in_structure]]
+            acc_sites[column] = values
+
+        annotated.append(acc_sites)
+
+    if len(annotated) == 0:
+        return sites_df
+
+    return pd.concat(annotated, ignore_index=True)
+
+
+def build_parser():
+    """Build cmd-line args parser"""
+
+    # Create parser object
+    parser = argparse.ArgumentParser(
+        prog="structure_sites.py",
+        description="Map positively selected sites onto predicted structures",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    index_parser = subparsers.add_parser(
+        "index",
+        help="Parse the top-ranked model of each protein into the structure store",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    index_parser.add_argument(
+        "candidates_dir",
+        type=Path,
+        help="Path to dir containing one dir per protein, named by its accession",
+    )
+    index_parser.add_argument(
+        "structure_store",
+        type=Path,
+        help="Path to dir to write the per-residue arrays to",
+    )
+    index_parser.add_argument(
+        "--no_cleandata",
+        dest="cleandata",
+        action="store_false",
+        default=True,
+        help="CodeML was run with cleandata = 0, so site numbers are MSA codon positions",
+    )
+    index_parser.add_argument(
+        "--position_maps",
+        type=Path,
+        default=None,
+        help=(
+            "Path to tsv file of the proteins whose MSAs were filtered by codon_qc.py, with the columns "
+            "'accession', 'position_map' (written by codon_qc.py for the cluster of the protein) and "
+            "'full_alignment' (the cluster alignment before filtering)"
+        ),
+    )
+    index_parser.add_argument(
+        "-f",
+        "--force",
+        dest="force",
+        action="store_true",
+        default=False,
+        help="Reparse models that are already in the store",
+    )
+
+    annotate_parser = subparsers.add_parser(
+        "annotate",
+        help="Add the structural context of each positively selected site",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    annotate_parser.add_argument(
+        "structure_store",
+        type=Path,
+        help="Path to dir of per-residue arrays",
+    )
+    annotate_parser.add_argument(
+        "sites_store",
+        type=Path,
+        help="Path to the site-level store",
+    )
+    annotate_parser.add_argument(
+        "output",
+        type=Path,
+        help="Path to write out a tsv file of annotated sites",
+    )
+    annotate_parser.add_argument(
+        "--method",
+        choices=["BEB", "NEB"],
+        default="BEB",
+        help="Empirical Bayes method",
+    )
+    annotate_parser.add_argument(
+        "--min_prob",
+        type=float,
+        default=0.0,
+        help="Minimum posterior probability of w > 1",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    with trace_stage("structure_sites"):
+        main()
@@ -1,24 +1,19 @@
 DB="data/cazome/cazome.db"
+SEQ_DB="data/cazy/all_cazy_2022_01_13.db"  # the CAZome database does not store seqs
 
-sqlite3 $DB "
-SELECT DISTINCT P.genbank_accession
-FROM Proteins AS P
-INNER JOIN Domains AS D ON P.protein_id = D.domain_id
-INNER JOIN Classifier AS C ON D.classifier_id = C.classifier_id
-WHERE C.classifier = 'CAZy'
-" > data/cazome/cazy_protein_ids
+# export the seqs of all CAZymes predicted by CAZy and by dbCAN in one pass over the database
+# seqs are read from the Genbanks table of the local CAZy database, joined on the GenBank accession
+# writes data/positive_selection/cazy_seqs.fasta and data/positive_selection/dbcan_seqs.fasta
 
-pyrewton extract_db_seqs $DB ata/cazome/cazy_protein_ids -o data/positive_selection/cazy_seqs.fasta
-
-sqlite3 $DB "
-SELECT DISTINCT P.genbank_accession
-FROM Proteins AS P
-INNER JOIN Domains AS D ON P.protein_id = D.domain_id
-INNER JOIN Classifier AS C ON D.classifier_id = C.classifier_id
-WHERE C.classifier = 'dbCAN'
-" > data/cazome/dbcan_protein_ids
-
-pyrewton extract_db_seqs $DB ata/cazome/cazy_protein_ids -o data/positive_selection/dbcan_seqs.fasta
+python3 scripts/cazomes/export_db_seqs.py \
+  $DB \
+  data/positive_selection \
+  --classifiers CAZy dbCAN \
+  --group_by classifier \
+  --seq_db $SEQ_DB \
+  --seq_table Genbanks \
+  --seq_column sequence \
+  --seq_key genbank_accession
 
 pyrewton get_cluster_summary \
   data/positive_selection/cazy_seqs.fasta \
@@ -28,9 +23,9 @@ pyrewton get_cluster_summary \
 pyrewton get_cluster_summary \
   data/positive_selection/cazy_seqs.fasta \
   data/positive_selection/dbcan_seqs.fasta \
-  data/positive_selection/ce_clusters/pl_clusters.csv 
+  data/positive_selection/pl_clusters/pl_clusters.csv 
 
 pyrewton get_cluster_summary \
   data/positive_selection/cazy_seqs.fasta \
   data/positive_selection/dbcan_seqs.fasta \
-  data/positive_selection/ce_clusters/gh_clusters.csv 
+  data/positive_selection/gh_clusters/gh_clusters.csv 
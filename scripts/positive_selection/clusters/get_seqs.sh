@@ -39,16 +39,20 @@
 # SOFTWARE.
 
 
-DB="data/cazy/all_cazy_2020_01_13.db"
-
-sqlite3 $DB "
-SELECT DISTINCT Proteins.genbank_accession
-FROM Proteins
-INNER JOIN Domains on Proteins.protein_id = Domains.protein_id
-INNER JOIN CazyFamilies on Domains.family_id = CazyFamilies.family_id
-INNER JOIN Classifiers on Domains.classifier_id = Classifiers.classifier_id
-WHERE CazyFamilies.family like 'PL%' and (Classifiers.classifier = 'dbCAN' OR Classifiers.classifier = 'CAZy')
-" > data/positive_selection/class_prot_ids/pl_ids
-
-# Extract protein sequences
-pyrewton extract_db_seqs $DB data/positive_selection/class_prot_ids/pl_ids -o data/positive_selection/class_seqs/pl_seqs.fasta
+DB="data/cazome/cazome.db"
+SEQ_DB="data/cazy/all_cazy_2022_01_13.db"  # the CAZome database does not store seqs
+
+# export the seqs of the PL, GH and CE CAZymes predicted by dbCAN or CAZy in one pass over the database
+# seqs are read from the Genbanks table of the local CAZy database, joined on the GenBank accession
+# writes pl_seqs.fasta, gh_seqs.fasta and ce_seqs.fasta
+
+python3 scripts/cazomes/export_db_seqs.py \
+    $DB \
+    data/positive_selection/class_seqs \
+    --classes PL GH CE \
+    --classifiers dbCAN CAZy \
+    --group_by class \
+    --seq_db $SEQ_DB \
+    --seq_table Genbanks \
+    --seq_column sequence \
+    --seq_key genbank_accession